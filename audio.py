@@ -22,9 +22,275 @@
 
 
 import numpy as np;
-from numpy.fft import fft;
-import wave;
+from numpy.fft import rfft;
+from numpy.lib.stride_tricks import as_strided;
+from collections import OrderedDict;
+import struct;
 import math;
+import mmap;
+
+import telemetry;
+
+# WAVE format tags understood by readWavHeader
+WAVE_FORMAT_PCM = 0x0001;
+WAVE_FORMAT_IEEE_FLOAT = 0x0003;
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE;
+
+# Channel selections accepted by decodeSamples, in addition to integer indices
+CHANNELS = { "left": 0, "right": 1, "mid": None };
+
+# Named windows accepted by windowFunction.  None is rectangular.
+WINDOWS = {
+    "rect": None,
+    "hann": np.hanning,
+    "hamming": np.hamming,
+    "blackman": np.blackman,
+    "bartlett": np.bartlett };
+
+# Version of the spectra computed by AudioFile, part of their cache keys.
+# Increment this when changes to decoding or the stft alter their values.
+SPECTRUM_VERSION = 1;
+
+# Number of frames transformed per rfft call, bounding the size of the
+# float64 temporaries numpy allocates along the way.
+FFT_BLOCK = 256;
+
+
+class WavInfo:
+    """Layout of the sample data in a wav file, as read by readWavHeader"""
+
+    def __init__(self, formatTag, numChannels, sampleRate, sampleWidth,
+            dataOffset, dataSize):
+        self.formatTag = formatTag;
+        self.numChannels = numChannels;
+        self.sampleRate = sampleRate;
+        # Bytes per sample, per channel
+        self.sampleWidth = sampleWidth;
+        # Location of the sample data within the file, in bytes
+        self.dataOffset = dataOffset;
+        self.dataSize = dataSize;
+
+    def frameWidth(self):
+        """Bytes per sample frame (one sample of every channel)"""
+        return self.numChannels * self.sampleWidth;
+
+    def numFrames(self):
+        """Number of complete sample frames in the data chunk"""
+        return self.dataSize // self.frameWidth();
+
+    def dtype(self):
+        """
+        The numpy dtype of a single sample, or None for 24 bit samples,
+        which numpy can't represent directly.
+        """
+        if self.formatTag == WAVE_FORMAT_IEEE_FLOAT:
+            return np.dtype("<f{0}".format(self.sampleWidth));
+        if self.sampleWidth == 1:
+            return np.dtype(np.uint8);
+        if self.sampleWidth == 3:
+            return None;
+        return np.dtype("<i{0}".format(self.sampleWidth));
+
+
+def _readExactly(inFile, size):
+    """Reads size bytes from inFile, which may be a pipe"""
+    data = inFile.read(size);
+    while len(data) < size:
+        more = inFile.read(size - len(data));
+        if len(more) == 0:
+            raise Exception("Unexpected end of file");
+        data += more;
+    return data;
+
+def readWavHeader(inFile):
+    """
+    Reads RIFF chunks from inFile up to the start of the sample data, and
+    returns a WavInfo describing it.  Only reads forward, so inFile may
+    be a pipe; on return it is positioned at the first sample.
+    """
+    riff, size, wave = struct.unpack("<4sI4s", _readExactly(inFile, 12));
+    if riff != b"RIFF" or wave != b"WAVE":
+        raise Exception("Not a wav file");
+    offset = 12;
+
+    fmt = None;
+    while True:
+        chunkId, chunkSize = struct.unpack("<4sI", _readExactly(inFile, 8));
+        offset += 8;
+        if chunkId == b"data":
+            break;
+
+        # Chunks are padded to an even length
+        body = _readExactly(inFile, chunkSize + (chunkSize & 1));
+        offset += len(body);
+        if chunkId == b"fmt ":
+            fmt = body;
+
+    if fmt is None:
+        raise Exception("Wav file has no fmt chunk");
+
+    formatTag, numChannels, sampleRate, _, _, bits = struct.unpack(
+            "<HHIIHH", fmt[:16]);
+    if formatTag == WAVE_FORMAT_EXTENSIBLE:
+        # The real format tag is the start of the subformat GUID
+        formatTag = struct.unpack("<H", fmt[24:26])[0];
+
+    if formatTag == WAVE_FORMAT_PCM:
+        if bits not in (8, 16, 24, 32):
+            raise Exception("Unsupported PCM sample size: {0}".format(bits));
+    elif formatTag == WAVE_FORMAT_IEEE_FLOAT:
+        if bits not in (32, 64):
+            raise Exception("Unsupported float sample size: {0}".format(bits));
+    else:
+        raise Exception("Unsupported wav format: {0:#x}".format(formatTag));
+
+    return WavInfo(formatTag, numChannels, sampleRate, bits // 8,
+            offset, chunkSize);
+
+def decodeSamples(data, info, channel="left"):
+    """
+    Decodes raw little-endian sample data laid out as described by info
+    (a WavInfo) into a float64 array holding a single channel.
+    channel is "left", "right", "mid" (the mean of all channels), or
+    an integer channel index.  A mono file's only channel is returned for
+    any channel; otherwise an index the file doesn't have raises
+    ValueError.  Integer samples keep their native scale, except that 8
+    bit samples are shifted to be signed.
+    """
+    width = info.sampleWidth;
+    numFrames = len(data) // info.frameWidth();
+    data = data[:numFrames * info.frameWidth()];
+
+    if width == 3:
+        # Assemble 24 bit ints from their bytes; the top byte carries the sign
+        raw = np.frombuffer(data, dtype=np.uint8).reshape((-1, 3));
+        samples = (raw[:,0].astype(np.int32) |
+                (raw[:,1].astype(np.int32) << 8) |
+                (raw[:,2].view(np.int8).astype(np.int32) << 16));
+    else:
+        samples = np.frombuffer(data, dtype=info.dtype());
+
+    samples = samples.reshape((numFrames, info.numChannels));
+
+    if channel in CHANNELS:
+        channel = CHANNELS[channel];
+    if channel is None:
+        wav = np.mean(samples, 1);
+    else:
+        # Mono files provide the same data for every channel
+        if info.numChannels == 1:
+            channel = 0;
+        elif not 0 <= channel < info.numChannels:
+            raise ValueError("No channel {0} in a file with {1} channels"
+                    .format(channel, info.numChannels));
+        wav = samples[:, channel].astype(np.float64);
+
+    if width == 1 and info.formatTag == WAVE_FORMAT_PCM:
+        wav -= 128;
+    return wav;
+
+
+def windowFunction(window, framesize):
+    """
+    Returns the weights to apply to each frame before its FFT, or None
+    for a rectangular window.  window may be None, a name in WINDOWS, or
+    an array of framesize weights.
+    """
+    if window is None:
+        return None;
+    if isinstance(window, str):
+        if window not in WINDOWS:
+            raise Exception("Unknown window: " + window);
+        if WINDOWS[window] is None:
+            return None;
+        return WINDOWS[window](framesize);
+
+    window = np.asarray(window, dtype=np.float64);
+    if window.shape != (framesize,):
+        raise Exception("Window length does not match framesize");
+    return window;
+
+def countFrames(numSamples, framesize, hop):
+    """Number of whole frames of framesize, hop samples apart, in numSamples"""
+    if numSamples < framesize:
+        return 0;
+    return 1 + (numSamples - framesize) // hop;
+
+def frameSignal(wav, framesize, hop):
+    """
+    Returns a read-only (frames x framesize) view of wav, in which row i
+    starts at sample i*hop.  Overlapping frames share memory.
+    """
+    wav = np.ascontiguousarray(wav);
+    return as_strided(wav,
+            shape=(countFrames(len(wav), framesize, hop), framesize),
+            strides=(hop*wav.strides[0], wav.strides[0]),
+            writeable=False);
+
+def spectrumStats(mags, framesize):
+    """
+    Mean and standard deviation of the magnitudes of each frame's full
+    FFT, given only the non-negative half spectrum (frames x bins).
+    The negative frequencies mirror the positive ones, so every bin but DC
+    (and Nyquist, if framesize is even) is counted twice.
+    """
+    weights = np.full(mags.shape[1], 2.0);
+    weights[0] = 1;
+    if framesize % 2 == 0:
+        weights[-1] = 1;
+
+    means = np.dot(mags, weights) / framesize;
+    squares = np.dot(np.square(mags), weights) / framesize;
+    return (means, np.sqrt(np.maximum(squares - np.square(means), 0)));
+
+def stft(wav, framesize, hop, window=None, magnitudes=False):
+    """
+    Computes the non-negative half spectrum of every frame of wav.
+    Returns a (frames x framesize/2+1) array, complex64 or, if magnitudes
+    is set, float32 magnitudes; along with the per-frame full spectrum
+    means and standard deviations from spectrumStats.
+    """
+    frames = frameSignal(wav, framesize, hop);
+    weights = windowFunction(window, framesize);
+    numBins = framesize // 2 + 1;
+
+    spectra = np.empty([len(frames), numBins],
+            dtype=np.float32 if magnitudes else np.complex64);
+    means = np.empty(len(frames));
+    stDevs = np.empty(len(frames));
+
+    for start in range(0, len(frames), FFT_BLOCK):
+        block = frames[start : start+FFT_BLOCK];
+        if weights is not None:
+            block = block * weights;
+        spectrum = rfft(block, axis=1);
+        mags = np.absolute(spectrum);
+
+        stop = start + len(block);
+        means[start:stop], stDevs[start:stop] = spectrumStats(mags, framesize);
+        spectra[start:stop] = mags if magnitudes else spectrum;
+
+    return (spectra, means, stDevs);
+
+def deviationsOf(spectra, means, stDevs):
+    """
+    Returns the deviation from the mean, in standard deviations, of each
+    bin of each frame of spectra, as float32.
+    """
+    deviations = np.absolute(spectra).astype(np.float32, copy=False);
+    deviations -= means[:, np.newaxis];
+    deviations /= stDevs[:, np.newaxis];
+    return deviations;
+
+def rmsOf(means, stDevs, framesize):
+    """
+    Returns the RMS level of each frame's (windowed) samples, given the
+    mean and standard deviation of its FFT magnitudes from spectrumStats.
+    By Parseval's theorem, the mean square FFT magnitude is framesize
+    times the mean square sample.
+    """
+    return np.sqrt((np.square(means) + np.square(stDevs)) / framesize);
+
 
 class AudioFile:
     """
@@ -33,93 +299,432 @@ class AudioFile:
     audio file.
     """
 
-    def __init__(self, filename, framesize):
+    def __init__(self, filename, framesize, hop=None, window=None,
+            channel="left", magnitudes=False, maxFrequency=None, cache=None):
+        """
+        Frames are framesize samples long and start every hop samples
+        (by default, hop is framesize, so frames don't overlap).  window
+        is passed to windowFunction.  If magnitudes is set, only float32
+        FFT magnitudes are kept in fftFrames, rather than complex64 values.
+        maxFrequency, if given, limits the bins kept in the deviation
+        spectrogram to those needed for analysis up to that frequency.
+        cache, a FeatureCache, saves the spectra between runs.
+        """
+        self.cache = cache;
+
         # Actually read the file
-        self._readWav(filename);
+        self._readWav(filename, channel);
 
         # Split into FFT frames and run FFTs
-        self.framesize = framesize;
-        self._fft(framesize);
-
-    def _readWav(self, filename):
-        """Reads the right channel of a wav file into a numpy array"""
-        inFile = wave.open(filename);
-
-        # Assuming 16bit dual-channel, there are 4 bytes per sample:
-        self.wav = np.empty(inFile.getnframes());
-
-        # Read file into array
-        for i in range(inFile.getnframes()):
-            frame = bytearray(inFile.readframes(1));
-            if len(frame) == 0:
-                raise Exception("Unexpected end of file");
-
-            # Frame is one sample, two channels, 16 bit, little endian.
-            # Right channel is first 2 bytes.
-            right = 0;
-            # Bash the little-endian signed int bytes into a python int
-            if (frame[1]&0x80) != 0:
-                # Negative, need some silliness to get signedness past python
-                right = int( ~0xffff | frame[0] | (frame[1]<<8) );
-            else:
-                right = frame[0] | (frame[1]<<8);
-
-            self.wav[i] = right;
-
-    def _fft(self, framesize):
-        """Calculates FFTs of individual audio frames"""
-        self.fftFrames = np.empty([len(self.wav)/framesize, framesize]);
-
-        # Split wav into frames, executing fft
-        for i in range(len(self.wav)/framesize):
-            self.fftFrames[i] = fft(self.wav[i*framesize : (i+1)*framesize]);
+        self.framesize = int(framesize);
+        self.hop = self.framesize if hop is None else int(hop);
+        self.window = window;
+        self.maxFrequency = maxFrequency;
+        if cache is None:
+            self._fft(self.framesize, magnitudes);
+        else:
+            self._cachedFft(channel, magnitudes);
+
+        # Built on first access by deviationSpectrogram
+        self._deviations = None;
+
+    @telemetry.timed("audio.readWav")
+    def _readWav(self, filename, channel):
+        """
+        Reads one channel of a wav file into a numpy array.
+        See decodeSamples for the meaning of channel.
+        """
+        inFile = open(filename, "rb");
+        try:
+            info = readWavHeader(inFile);
+            data = inFile.read(info.dataSize);
+        finally:
+            inFile.close();
+
+        if len(data) < info.dataSize:
+            raise Exception("Unexpected end of file");
+
+        self.sampleRate = info.sampleRate;
+        self.wav = decodeSamples(data, info, channel);
+        telemetry.count("audio.samples", len(self.wav));
+
+        if self.cache is not None:
+            self.contentHash = self.cache.key(info.formatTag,
+                    info.numChannels, info.sampleRate, info.sampleWidth, data);
+
+    @telemetry.timed("audio.fft")
+    def _fft(self, framesize, magnitudes=False):
+        """
+        Calculates FFTs of individual audio frames.  Only the non-negative
+        frequencies are kept, since the input is real.
+        """
+        self.fftFrames, self.fftMeans, self.fftStDevs = stft(self.wav,
+                framesize, self.hop, self.window, magnitudes);
+        telemetry.count("audio.frames", len(self.fftFrames));
 
         # Calculate the frequencies of all of the FFTs, in Hz
         # (Note that the index in the fft is also frequency, in cycles/frame)
-        self.fftFreqs = np.array(range(framesize));
-        self.fftFreqs = np.multiply(self.fftFreqs, 44100.0/framesize);
+        self.fftFreqs = np.arange(self.fftFrames.shape[1]) * (
+                float(self.sampleRate)/framesize);
+
+    def _spectraKey(self, channel, magnitudes):
+        """The cache key of the spectra"""
+        return self.cache.key("spectra", SPECTRUM_VERSION, self.contentHash,
+                channel, self.framesize, self.hop, self.window, magnitudes);
+
+    def _cachedFft(self, channel, magnitudes):
+        """Loads the FFTs of the audio frames from cache, or calculates them"""
+        self.cacheKey = self._spectraKey(channel, magnitudes);
 
-        # Calculate means and stdevs for all of the frames
-        self.fftMeans = np.array( [ np.mean(np.absolute(self.fftFrames[i]))
-                for i in range(len(self.fftFrames)) ] );
-        self.fftStDevs = np.array( [ np.std(np.absolute(self.fftFrames[i]))
-                for i in range(len(self.fftFrames)) ] );
+        arrays = self.cache.load(self.cacheKey);
+        if arrays is None:
+            self._fft(self.framesize, magnitudes);
+            self.cache.store(self.cacheKey, { "fftFrames": self.fftFrames,
+                    "fftMeans": self.fftMeans, "fftStDevs": self.fftStDevs });
+        else:
+            self.fftFrames = arrays["fftFrames"];
+            self.fftMeans = arrays["fftMeans"];
+            self.fftStDevs = arrays["fftStDevs"];
+            self.fftFreqs = np.arange(self.fftFrames.shape[1]) * (
+                    float(self.sampleRate)/self.framesize);
 
     def numFrames(self):
         """Returns the number of FFT frames the audio has been split into"""
         return len(self.fftFrames);
 
+    def frameRms(self, start, stop):
+        """Returns the RMS level of frames start to stop (see rmsOf)"""
+        return rmsOf(self.fftMeans[start:stop], self.fftStDevs[start:stop],
+                self.framesize);
+
     def indexOf(self, frequency):
         """
         Determine the index of a given frequency within FFT data.
         Index is floating point, with a fraction returned for frequencies
         between actual FFT data points.
         """
-        return float(frequency) * self.framesize / 44100;
+        return float(frequency) * self.framesize / self.sampleRate;
+
+    def numBins(self):
+        """
+        Returns the number of frequency bins in the deviation spectrogram.
+        This includes one bin past maxFrequency, for interpolation.
+        """
+        numBins = self.framesize // 2 + 1;
+        if self.maxFrequency is None:
+            return numBins;
+        return min(numBins, int(math.ceil(self.indexOf(self.maxFrequency)))+2);
+
+    def deviationSpectrogram(self):
+        """
+        Returns the deviation from the mean, in standard deviations, of every
+        bin of every frame, as a (numFrames() x numBins()) float32 array.
+        This is built on first access, and then kept: it takes
+        4*numFrames()*numBins() bytes.
+        """
+        if self._deviations is None:
+            numBins = self.numBins();
+            self._deviations = np.empty([self.numFrames(), numBins],
+                    dtype=np.float32);
+
+            for start in range(0, self.numFrames(), FFT_BLOCK):
+                stop = min(start + FFT_BLOCK, self.numFrames());
+                self._deviations[start:stop] = deviationsOf(
+                        self.fftFrames[start:stop, :numBins],
+                        self.fftMeans[start:stop], self.fftStDevs[start:stop]);
+
+        return self._deviations;
+
+    def deviationBlocks(self, active=None):
+        """
+        Generates (start, deviations) for consecutive blocks of frames
+        covering the whole file, where deviations holds the rows of the
+        deviation spectrogram from frame start onward.  If active (an array
+        of booleans, one per frame) is given, blocks holding no active
+        frames may be skipped; here, there's only one block.
+        """
+        yield (0, self.deviationSpectrogram());
+
+    def mapBlocks(self, function, active=None):
+        """
+        Generates function(start, deviations) for each block deviationBlocks
+        generates, in frame order.
+        """
+        for start, deviations in self.deviationBlocks(active):
+            yield function(start, deviations);
+
+    def _bracket(self, inx, length):
+        """
+        Returns the indices either side of inx (which may be fractional, or
+        an array of indices) and the fraction of the way from one to the other.
+        """
+        lower = np.floor(inx).astype(int);
+        upper = np.minimum(lower + 1, length - 1);
+        return (lower, upper, inx - lower);
+
+    def _spectrum(self, frame):
+        """The FFT of a frame, or its magnitude"""
+        return self.fftFrames[frame];
 
     def magnitude(self, frame, inx):
         """
         Get the magnitude of the FFT for a given index.
         If the index is fractional, magnitude is interpolated.
         """
-        lower = np.absolute(self.fftFrames[frame, math.floor(inx)]);
-        upper = np.absolute(self.fftFrames[frame, math.ceil(inx)]);
-
-        ret = lower + (inx - math.floor(inx))*(upper-lower);
-
-        return ret;
+        row = self._spectrum(frame);
+        lower, upper, fraction = self._bracket(inx, len(row));
+        lowerMag = np.absolute(row[lower]);
+        return lowerMag + fraction*(np.absolute(row[upper]) - lowerMag);
 
     def deviation(self, frame, inx):
         """
         Return the interpolated deviation from the mean, in standard deviations,
         at a given index.  Result is interpolated if inx is fractional.
         """
-        mag = self.magnitude(frame, inx);
-        return (mag - self.fftMeans[frame]) / self.fftStDevs[frame];
+        row = self.deviations(frame);
+        lower, upper, fraction = self._bracket(inx, len(row));
+        return row[lower] + fraction*(row[upper] - row[lower]);
 
     def deviations(self, frame):
-        """Convenience returningg deviations for all frequencies in FFT"""
-        return [ (i - self.fftMeans[frame]) / self.fftStDevs[frame] for
-           i in self.fftFrames[frame] ];
+        """Convenience returning deviations for all frequencies in FFT"""
+        return self.deviationSpectrogram()[frame];
+
+
+class SampleAudioFile(AudioFile):
+    """
+    An AudioFile analysing samples which have already been decoded, so
+    that one recording can be analysed many ways without reading it again.
+    """
+
+    def __init__(self, samples, sampleRate, framesize, hop=None, window=None,
+            magnitudes=False, maxFrequency=None):
+        """
+        samples is a single channel, as AudioFile keeps in wav; it isn't
+        copied.  See AudioFile for the analysis parameters.
+        """
+        self._samples = samples;
+        self._sampleRate = sampleRate;
+        AudioFile.__init__(self, None, framesize, hop, window,
+                magnitudes=magnitudes, maxFrequency=maxFrequency);
+
+    def _readWav(self, filename, channel):
+        self.sampleRate = self._sampleRate;
+        self.wav = self._samples;
+
+
+class MappedAudioFile(AudioFile):
+    """
+    An AudioFile for long recordings, which memory-maps the wav file's
+    sample data rather than reading it, and computes spectra a block of
+    frames at a time as they're needed.  Only the maxBlocks most recently
+    used blocks are kept, so memory use doesn't depend on the length of
+    the recording.  fftFrames, fftMeans, fftStDevs and wav aren't available;
+    use frameStats and samples instead.
+    With threads, mapBlocks computes blocks on that many threads at once,
+    so one long recording can use several cores.
+    """
+
+    def __init__(self, filename, framesize, hop=None, window=None,
+            channel="left", maxFrequency=None, blockFrames=FFT_BLOCK,
+            maxBlocks=4, threads=1):
+        """
+        See AudioFile for the analysis parameters.  Each block holds
+        blockFrames frames.
+        """
+        self.cache = None;
+        self.framesize = int(framesize);
+        self.hop = self.framesize if hop is None else int(hop);
+        self.window = window;
+        self.channel = channel;
+        self.maxFrequency = maxFrequency;
+        self.blockFrames = blockFrames;
+        self.maxBlocks = maxBlocks;
+        self.threads = threads;
+
+        self._file = open(filename, "rb");
+        self.info = readWavHeader(self._file);
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ);
+        self.sampleRate = self.info.sampleRate;
+        self.numSamples = min(self.info.numFrames(),
+                (len(self._map) - self.info.dataOffset) //
+                self.info.frameWidth());
 
+        self.fftFreqs = np.arange(self.framesize // 2 + 1) * (
+                float(self.sampleRate)/self.framesize);
 
+        # Recently used blocks, by index, least recent first
+        self._blocks = OrderedDict();
+
+    def close(self):
+        """Unmaps and closes the wav file"""
+        self._blocks.clear();
+        self._map.close();
+        self._file.close();
+
+    def samples(self, start, stop):
+        """
+        Decodes samples start to stop of the selected channel, as AudioFile
+        stores them in wav.
+        """
+        frameWidth = self.info.frameWidth();
+        begin = self.info.dataOffset + start*frameWidth;
+        end = self.info.dataOffset + stop*frameWidth;
+        wav = decodeSamples(self._map[begin:end], self.info, self.channel);
+
+        # The decoded copy is all that's needed: let the kernel drop the
+        # mapped pages, rather than have them count against this process.
+        if hasattr(self._map, "madvise"):
+            page = begin - begin % mmap.PAGESIZE;
+            self._map.madvise(mmap.MADV_DONTNEED, page, end - page);
+        return wav;
+
+    def numFrames(self):
+        """Returns the number of FFT frames the audio has been split into"""
+        return countFrames(self.numSamples, self.framesize, self.hop);
+
+    def _block(self, index):
+        """
+        Returns (magnitudes, means, stDevs, deviations) for the frames in
+        the given block, computing them if they aren't kept.
+        """
+        if index in self._blocks:
+            block = self._blocks.pop(index);
+        else:
+            block = self._computeBlock(index);
+            if len(self._blocks) >= self.maxBlocks:
+                self._blocks.popitem(last=False);
+
+        self._blocks[index] = block;
+        return block;
+
+    @telemetry.timed("audio.fft")
+    def _computeBlock(self, index):
+        """Computes the block _block returns, from the mapped samples"""
+        start = index * self.blockFrames;
+        stop = min(start + self.blockFrames, self.numFrames());
+        wav = self.samples(start*self.hop, (stop-1)*self.hop + self.framesize);
+        mags, means, stDevs = stft(wav, self.framesize, self.hop,
+                self.window, True);
+        telemetry.count("audio.frames", len(mags));
+        return (mags, means, stDevs,
+                deviationsOf(mags[:, :self.numBins()], means, stDevs));
+
+    def frameStats(self, start, stop):
+        """
+        Returns the spectrum means and stdevs of frames start to stop, as
+        AudioFile keeps in fftMeans and fftStDevs.
+        """
+        means = np.empty(stop - start);
+        stDevs = np.empty(stop - start);
+        for begin, index, offset, length in self._span(start, stop):
+            block = self._block(index);
+            means[begin-start : begin-start+length] = \
+                    block[1][offset : offset+length];
+            stDevs[begin-start : begin-start+length] = \
+                    block[2][offset : offset+length];
+        return (means, stDevs);
+
+    def frameRms(self, start, stop):
+        """
+        Returns the RMS level of frames start to stop, as AudioFile gives.
+        This is found from the samples, so no spectra are computed.
+        """
+        weights = windowFunction(self.window, self.framesize);
+        rms = np.empty(stop - start);
+        for begin in range(start, stop, self.blockFrames):
+            end = min(begin + self.blockFrames, stop);
+            frames = frameSignal(self.samples(begin*self.hop,
+                        (end-1)*self.hop + self.framesize),
+                    self.framesize, self.hop);
+            if weights is not None:
+                frames = frames * weights;
+            rms[begin-start : end-start] = np.sqrt(np.mean(np.square(frames),
+                        1));
+        return rms;
+
+    def _span(self, start, stop):
+        """
+        Generates (frame, block index, offset in block, frame count) for
+        the runs of frames from start to stop lying in each block.
+        """
+        frame = start;
+        while frame < stop:
+            index = frame // self.blockFrames;
+            offset = frame - index*self.blockFrames;
+            length = min(self.blockFrames - offset, stop - frame);
+            yield (frame, index, offset, length);
+            frame += length;
+
+    def deviationSpectrogram(self):
+        """
+        Returns the whole deviation spectrogram.  This is only sensible for
+        short recordings: it isn't kept, and costs 4*numFrames()*numBins()
+        bytes.  Prefer deviationBlocks.
+        """
+        return np.concatenate([np.empty([0, self.numBins()], np.float32)] +
+                [deviations for start, deviations in self.deviationBlocks()]);
+
+    def deviationBlocks(self, active=None):
+        """
+        Generates (start, deviations) for consecutive blocks of frames
+        covering the whole file, where deviations holds the rows of the
+        deviation spectrogram from frame start onward.  If active (an array
+        of booleans, one per frame) is given, blocks holding no active
+        frames are skipped, without computing their spectra.
+        """
+        for start in range(0, self.numFrames(), self.blockFrames):
+            if active is not None and \
+                    not np.any(active[start : start+self.blockFrames]):
+                continue;
+            yield (start, self._block(start // self.blockFrames)[3]);
+
+    def _mapBlock(self, function, index):
+        # The recently used blocks aren't shared between threads: each
+        # block's spectra are used once, then dropped
+        return function(index * self.blockFrames,
+                self._computeBlock(index)[3]);
+
+    def mapBlocks(self, function, active=None):
+        """
+        Generates function(start, deviations) for each block deviationBlocks
+        generates, in frame order.  With more than one thread, blocks'
+        spectra and function are computed on a pool of threads (numpy's FFTs
+        and array operations let other threads run), keeping at most two
+        blocks per thread in progress, so memory use stays bounded.
+        """
+        if self.threads <= 1:
+            for start, deviations in self.deviationBlocks(active):
+                yield function(start, deviations);
+            return;
+
+        from concurrent.futures import ThreadPoolExecutor;
+        from collections import deque;
+
+        indices = [start // self.blockFrames
+                for start in range(0, self.numFrames(), self.blockFrames)
+                if active is None or
+                    np.any(active[start : start+self.blockFrames])];
+        executor = ThreadPoolExecutor(self.threads);
+        pending = deque();
+        try:
+            for index in indices:
+                pending.append(executor.submit(self._mapBlock, function,
+                            index));
+                if len(pending) >= 2*self.threads:
+                    yield pending.popleft().result();
+            while pending:
+                yield pending.popleft().result();
+        finally:
+            for future in pending:
+                future.cancel();
+            executor.shutdown(True);
+
+    def _spectrum(self, frame):
+        """The magnitude of the FFT of a frame"""
+        block = self._block(frame // self.blockFrames);
+        return block[0][frame % self.blockFrames];
+
+    def deviations(self, frame):
+        """Convenience returning deviations for all frequencies in FFT"""
+        block = self._block(frame // self.blockFrames);
+        return block[3][frame % self.blockFrames];
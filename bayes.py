@@ -19,28 +19,131 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>
 
-import random;
 import math;
+import json;
 import numpy as np;
 from sys import stdout;
 
-def gauss(x, u, v):
+import telemetry;
+
+# Version of the model files written by NaiveBayes.save.  Increment this
+# when changing what they hold.
+MODEL_VERSION = 1;
+
+def logGaussNorm(v):
+    """
+    Log of the normalizing constant of a product of gaussians with
+    variances v: the log of the density at the mean.
+    """
+    return -0.5*np.sum(np.log(np.multiply(2*math.pi, v)));
+
+def splitMask(length, ratio, random):
+    """
+    Returns a boolean mask selecting a random round(ratio*length) of
+    length items, drawn from random (a numpy RandomState).
+    """
+    mask = np.zeros(length, dtype=bool);
+    mask[random.permutation(length)[:int(round(ratio*length))]] = True;
+    return mask;
+
+def rocCurve(memberScores, nonMemberScores):
+    """
+    Computes the ROC and precision/recall curves of classifying items as
+    members where their score (e.g. log-likelihood ratio) is at least a
+    threshold, for every distinct threshold, with a single sort.
+    Returns arrays of thresholds, in decreasing order, and the true
+    positive rate (recall), false positive rate and precision at each.
+    The first threshold is infinite, where nothing is a member.
+    """
+    scores = np.concatenate([memberScores, nonMemberScores]);
+    isMember = np.concatenate([np.ones(len(memberScores), dtype=bool),
+            np.zeros(len(nonMemberScores), dtype=bool)]);
+    order = np.argsort(-scores, kind="mergesort");
+    scores = scores[order];
+    truePositives = np.cumsum(isMember[order]);
+    falsePositives = np.arange(1, len(scores)+1) - truePositives;
+
+    # Items with equal scores are classified together: keep the last of each
+    last = np.concatenate([scores[1:] != scores[:-1], [True]]);
+    thresholds = np.concatenate([[np.inf], scores[last]]);
+    truePositives = np.concatenate([[0], truePositives[last]]);
+    falsePositives = np.concatenate([[0], falsePositives[last]]);
+
+    positives = np.maximum(truePositives + falsePositives, 1);
+    return (thresholds,
+            truePositives / float(max(len(memberScores), 1)),
+            falsePositives / float(max(len(nonMemberScores), 1)),
+            np.where(truePositives + falsePositives > 0,
+                truePositives / positives.astype(np.float64), 1.0));
+
+def rocArea(truePositiveRates, falsePositiveRates):
+    """The area under an ROC curve from rocCurve, by the trapezoid rule"""
+    return float(np.sum(np.diff(falsePositiveRates) *
+            (truePositiveRates[1:] + truePositiveRates[:-1])) / 2);
+
+def checkPrior(memberPrior):
+    """
+    Raises an exception unless memberPrior is a probability strictly
+    between 0 and 1, whose log odds are finite.
+    """
+    if not 0 < memberPrior < 1:
+        raise Exception("memberPrior must be between 0 and 1 exclusive, "
+                "not {0}".format(memberPrior));
+
+
+class FeatureStats:
     """
-    Compute the elementwise gaussian probability density of x,
-    for means u and variances v.
+    Running count, mean and sum of squared deviations (M2) of each feature,
+    updated a batch of rows at a time with Chan et al.'s parallel form of
+    Welford's algorithm.  Memory use doesn't depend on the number of rows,
+    and statistics gathered separately can be merged exactly.
     """
-    exp = np.subtract(x, u);
-    exp = np.power(exp, 2);
-    exp = np.divide(exp, np.multiply(v, 2));
-    exp = np.multiply(exp, -1);
-    exp = np.power(math.e, exp);
-    den = np.multiply(2*math.pi, v);
-    den = np.sqrt(den);
-    return np.divide(exp, den);
+
+    def __init__(self, featureLen):
+        self.count = 0;
+        self.mean = np.zeros(featureLen);
+        self.m2 = np.zeros(featureLen);
+
+    def _combine(self, count, mean, m2):
+        """Adds the statistics of another set of rows to these"""
+        if count == 0:
+            return;
+        total = self.count + count;
+        delta = mean - self.mean;
+        self.mean = self.mean + delta * (float(count) / total);
+        self.m2 = self.m2 + m2 + np.square(delta) * (
+                float(self.count) * count / total);
+        self.count = total;
+
+    def add(self, rows):
+        """Adds the rows of an N x featureLen array"""
+        rows = np.asarray(rows, dtype=np.float64);
+        if len(rows) == 0:
+            return;
+        mean = np.mean(rows, 0);
+        self._combine(len(rows), mean, np.sum(np.square(rows - mean), 0));
+
+    def merge(self, other):
+        """Adds the statistics of other, a FeatureStats, to these"""
+        self._combine(other.count, other.mean, other.m2);
+
+    def variance(self):
+        """The (population) variance of each feature, as np.var gives"""
+        return self.m2 / self.count;
 
 
 class NaiveBayes:
-    def __init__(self):
+    def __init__(self, memberPrior=0.5):
+        """
+        memberPrior is the prior probability that a note is a member,
+        used by predict() unless it's given another.  It must be strictly
+        between 0 and 1.
+        """
+        checkPrior(memberPrior);
+        self.memberPrior = memberPrior;
+        # Statistics of the features learnt from, see partialFit
+        self.memberStats = None;
+        self.nonMemberStats = None;
         self.learnMembers = None;
         self.learnNonMembers = None;
         self.testMembers = None;
@@ -53,11 +156,10 @@ class NaiveBayes:
         if self.learnNonMembers is None:
             self.learnNonMembers = np.empty([0, noteSets[0].featureLen()]);
 
-        for noteSet in noteSets:
-            self.learnMembers = np.concatenate((self.learnMembers,
-                    noteSet.memberFeatures()));
-            self.learnNonMembers = np.concatenate((self.learnNonMembers,
-                    notSet.nonMemberFeatures()));
+        self.learnMembers = np.concatenate([self.learnMembers] +
+                [noteSet.memberFeatures() for noteSet in noteSets]);
+        self.learnNonMembers = np.concatenate([self.learnNonMembers] +
+                [noteSet.nonMemberFeatures() for noteSet in noteSets]);
 
     def addTestingData(self, noteSets):
         """Add a list of NoteSet instances to the training dataset."""
@@ -66,19 +168,21 @@ class NaiveBayes:
         if self.testNonMembers is None:
             self.testNonMembers = np.empty([0, noteSets[0].featureLen()]);
 
-        for noteSet in noteSets:
-            self.testMembers = np.concatenate((self.testMembers,
-                    noteSet.memberFeatures()));
-            self.testNonMembers = np.concatenate((self.testNonMembers,
-                    notSet.nonMemberFeatures()));
+        self.testMembers = np.concatenate([self.testMembers] +
+                [noteSet.memberFeatures() for noteSet in noteSets]);
+        self.testNonMembers = np.concatenate([self.testNonMembers] +
+                [noteSet.nonMemberFeatures() for noteSet in noteSets]);
 
-    def addLabelledData(self, noteSets):
+    def addLabelledData(self, noteSets, learnRatio=0.5, seed=None):
         """
         Add labelled data to be used for learning and testing. Each item
         of labelled data will be randomly assigned to either the learning
         or the testing data sets.
         noteSets should be a list of NoteSet instances which provide known
         member and nonMember note lists
+        learnRatio is the fraction of each NoteSet's members, and of its
+        nonMembers, assigned to learning.  Given a seed, the assignment is
+        reproducible.
         """
         featureLen = noteSets[0].featureLen();
         if self.learnMembers is None:
@@ -90,27 +194,29 @@ class NaiveBayes:
         if self.testNonMembers is None:
             self.testNonMembers = np.empty([0, featureLen]);
 
+        random = np.random.RandomState(seed);
+        learnMembers = [self.learnMembers];
+        learnNonMembers = [self.learnNonMembers];
+        testMembers = [self.testMembers];
+        testNonMembers = [self.testNonMembers];
+
         for noteSet in noteSets:
-            for i in range(len(noteSet.memberFeatures())):
-                if random.random() < 0.5:
-                    self.learnMembers = np.concatenate((
-                            self.learnMembers,
-                            noteSet.memberFeatures()[i].reshape((1,featureLen))));
-                else:
-                    self.testMembers = np.concatenate((
-                            self.testMembers,
-                            noteSet.memberFeatures()[i].reshape((1,featureLen))));
-
-            for i in range(len(noteSet.nonMemberFeatures())):
-                if random.random() < 0.5:
-                    self.learnNonMembers = np.concatenate((
-                            self.learnNonMembers,
-                            noteSet.nonMemberFeatures()[i].reshape((1,featureLen))));
-                else:
-                    self.testNonMembers = np.concatenate((
-                            self.testNonMembers,
-                            noteSet.nonMemberFeatures()[i].reshape((1,featureLen))));
+            members = noteSet.memberFeatures();
+            learn = splitMask(len(members), learnRatio, random);
+            learnMembers.append(members[learn]);
+            testMembers.append(members[~learn]);
+
+            nonMembers = noteSet.nonMemberFeatures();
+            learn = splitMask(len(nonMembers), learnRatio, random);
+            learnNonMembers.append(nonMembers[learn]);
+            testNonMembers.append(nonMembers[~learn]);
 
+        self.learnMembers = np.concatenate(learnMembers);
+        self.learnNonMembers = np.concatenate(learnNonMembers);
+        self.testMembers = np.concatenate(testMembers);
+        self.testNonMembers = np.concatenate(testNonMembers);
+
+    @telemetry.timed("bayes.learn")
     def learn(self):
         """Train the naive bayes classifier from available labelled data"""
 
@@ -120,42 +226,190 @@ class NaiveBayes:
             raise Exception("Learning failed: no negative cases.");
 
         # Calculate mean/var for all features and both cases
-        self.memberMeans = np.mean(self.learnMembers, 0);
-        self.memberVars = np.var(self.learnMembers, 0);
-        self.nonMemberMeans = np.mean(self.learnNonMembers, 0);
-        self.nonMemberVars = np.var(self.learnNonMembers, 0);
+        self.memberStats = None;
+        self.nonMemberStats = None;
+        self.partialFit(self.learnMembers, self.learnNonMembers);
+        self.printResults();
+
+    @telemetry.timed("bayes.partialFit")
+    def partialFit(self, members, nonMembers):
+        """
+        Adds member and nonMember feature vectors (N x featureLen arrays)
+        to what the classifier has learnt, without keeping them: only the
+        running statistics of each feature are kept.  The classifier can
+        be used once it has seen both members and nonMembers.
+        """
+        featureLen = np.shape(members)[-1];
+        if self.memberStats is None:
+            self.memberStats = FeatureStats(featureLen);
+            self.nonMemberStats = FeatureStats(featureLen);
+
+        self.memberStats.add(members);
+        self.nonMemberStats.add(nonMembers);
+        self._fromStats();
+        telemetry.count("bayes.learntVectors", len(members) + len(nonMembers));
+
+    def merge(self, other):
+        """
+        Adds what another NaiveBayes has learnt to what this one has, as if
+        this one had been given all of its learning data too.  Classifiers
+        trained on separate shards of data (in separate processes, say)
+        can be combined this way.  Only learnt statistics are merged, not
+        the other's learning or testing data.
+        """
+        if other.memberStats is None:
+            return;
+        if self.memberStats is None:
+            self.memberStats = FeatureStats(len(other.memberStats.mean));
+            self.nonMemberStats = FeatureStats(len(other.memberStats.mean));
+
+        self.memberStats.merge(other.memberStats);
+        self.nonMemberStats.merge(other.nonMemberStats);
+        self._fromStats();
 
-        # Print out learning results:
+    def _fromStats(self):
+        """Sets the model from the learnt statistics, once it has both cases"""
+        if self.memberStats.count == 0 or self.nonMemberStats.count == 0:
+            return;
+        self.memberMeans = self.memberStats.mean;
+        self.memberVars = self.memberStats.variance();
+        self.nonMemberMeans = self.nonMemberStats.mean;
+        self.nonMemberVars = self.nonMemberStats.variance();
+        self._precompute();
+
+    def save(self, filename, settings=None):
+        """
+        Saves what the classifier has learnt to a .npz file, along with
+        settings: a dict (of JSON-serializable values) describing how the
+        features it learnt from were found, for whoever loads it.
+        Learning and testing data aren't saved.
+        """
+        if self.memberStats is None:
+            raise Exception("Can't save a classifier which hasn't learnt");
+        with open(filename, "wb") as outFile:
+            np.savez(outFile, version=MODEL_VERSION,
+                    memberPrior=self.memberPrior,
+                    settings=json.dumps(settings or {}),
+                    memberCount=self.memberStats.count,
+                    memberMean=self.memberStats.mean,
+                    memberM2=self.memberStats.m2,
+                    nonMemberCount=self.nonMemberStats.count,
+                    nonMemberMean=self.nonMemberStats.mean,
+                    nonMemberM2=self.nonMemberStats.m2);
+
+    def printResults(self):
+        """Prints out the learnt means and variances"""
         print("Learning Results:");
         print("Member:    Mean {0}, Var {1}".format(
                     self.memberMeans, self.memberVars));
         print("NonMember: Mean {0}, Var {1}".format(
                     self.nonMemberMeans, self.nonMemberVars));
 
-    def isMember(self, feature):
-        """Classify the given feature vector"""
+    def _precompute(self):
+        """Precomputes the terms of the log densities used to classify"""
+        self.memberLogNorm = logGaussNorm(self.memberVars);
+        self.nonMemberLogNorm = logGaussNorm(self.nonMemberVars);
+        self.memberInvVars = 0.5 / self.memberVars;
+        self.nonMemberInvVars = 0.5 / self.nonMemberVars;
 
-        # Compute the probabilites of each hypothesis, with the assumption that
-        # the hypotheses have equal prior probabilities.
-        pMember = np.product(
-                gauss(feature, self.memberMeans, self.memberVars));
-        pNonMember = np.product(
-                gauss(feature, self.nonMemberMeans, self.nonMemberVars));
+    def logLikelihoodRatio(self, features):
+        """
+        Returns the log of the ratio of the member and nonMember likelihoods
+        of each row of features (an N x featureLen array).  These are
+        computed as log densities, so don't underflow on extreme features.
+        """
+        features = np.atleast_2d(np.asarray(features, dtype=np.float64));
+
+        logMember = self.memberLogNorm - np.dot(
+                np.square(features - self.memberMeans), self.memberInvVars);
+        logNonMember = self.nonMemberLogNorm - np.dot(
+                np.square(features - self.nonMemberMeans),
+                self.nonMemberInvVars);
+        return logMember - logNonMember;
 
-        # Is the feature a member?
-        return pMember >= pNonMember;
+    def logOdds(self, features, memberPrior=None):
+        """
+        Returns the posterior log odds that each row of features (an N x
+        featureLen array) is a member, given the prior probability
+        memberPrior (by default, the classifier's).
+        """
+        if memberPrior is None:
+            memberPrior = self.memberPrior;
+        checkPrior(memberPrior);
+
+        logOdds = self.logLikelihoodRatio(features);
+        if memberPrior != 0.5:
+            logOdds += math.log(memberPrior) - math.log(1 - memberPrior);
+        return logOdds;
+
+    @telemetry.timed("bayes.predict")
+    def predict(self, features, memberPrior=None, threshold=None):
+        """
+        Classify each row of features (an N x featureLen array), returning
+        an array of N booleans, true for members.  memberPrior defaults to
+        the classifier's.  Given a threshold (e.g. from operatingPoint),
+        rows are members where their log-likelihood ratio is at least
+        threshold, and no prior is used.
+        """
+        if threshold is not None:
+            if memberPrior is not None:
+                raise Exception("Give predict a memberPrior or a threshold, "
+                        "not both");
+            scores = self.logLikelihoodRatio(features) - threshold;
+        else:
+            # Compare posterior log odds, rather than the probabilities
+            scores = self.logOdds(features, memberPrior);
+        telemetry.count("bayes.classifiedVectors", len(scores));
+        return scores >= 0;
+
+    def testingScores(self):
+        """
+        Returns the log-likelihood ratios of the testing members and of the
+        testing nonMembers, computed in one pass each.
+        """
+        return (self.logLikelihoodRatio(self.testMembers),
+                self.logLikelihoodRatio(self.testNonMembers));
+
+    def testingRoc(self):
+        """The ROC and precision/recall curves on testing data, see rocCurve"""
+        return rocCurve(*self.testingScores());
+
+    def operatingPoint(self, maxFalsePositiveRate):
+        """
+        Finds the lowest threshold on the testing data's log-likelihood
+        ratios whose false positive rate is at most maxFalsePositiveRate.
+        Returns that threshold (to pass to predict), and its true and false
+        positive rates on the testing data.
+        """
+        thresholds, truePositiveRates, falsePositiveRates, precisions = \
+                self.testingRoc();
+        meeting = np.flatnonzero(falsePositiveRates <= maxFalsePositiveRate);
+        if len(meeting) == 0:
+            raise Exception("No threshold has a false positive rate of at "
+                    "most {0}".format(maxFalsePositiveRate));
+        inx = meeting[-1];
+
+        # Put the threshold halfway to the next lower score, so rounding
+        # can't change how the items at this one are classified
+        threshold = thresholds[inx];
+        if inx == 0:
+            threshold = np.max(np.concatenate(self.testingScores())) + 1;
+        elif inx + 1 < len(thresholds):
+            threshold = (threshold + thresholds[inx+1]) / 2;
+        else:
+            threshold -= 1;
+        return (float(threshold), truePositiveRates[inx],
+                falsePositiveRates[inx]);
+
+    def isMember(self, feature):
+        """Classify the given feature vector"""
+        return bool(self.predict(feature)[0]);
 
     def _accuracy(self, members, nonMembers):
         """Find the accuracy of the classifier when classifying the given dataset"""
-        corMembers = 0;
-        for i in range(len(members)):
-            if self.isMember(members[i]):
-                corMembers += 1;
-
-        corNonMembers = 0;
-        for i in range(len(nonMembers)):
-            if not self.isMember(nonMembers[i]):
-                corNonMembers += 1;
+        corMembers = int(np.count_nonzero(self.predict(members)));
+        corNonMembers = len(nonMembers) - int(np.count_nonzero(
+                self.predict(nonMembers)));
 
         return (corMembers, corNonMembers);
 
@@ -181,3 +435,33 @@ class NaiveBayes:
         return (accuracy[0], len(self.testMembers),
                 accuracy[1], len(self.testNonMembers));
 
+
+def loadModel(filename):
+    """
+    Loads a classifier saved by NaiveBayes.save, returning the NaiveBayes
+    and its settings dict.  The classifier can go on learning, or be
+    merged with others.
+    """
+    data = np.load(filename);
+    try:
+        version = int(data["version"]);
+        if version != MODEL_VERSION:
+            raise Exception("Unsupported model version {0} in {1}".format(
+                    version, filename));
+
+        nb = NaiveBayes(float(data["memberPrior"]));
+        featureLen = len(data["memberMean"]);
+        nb.memberStats = FeatureStats(featureLen);
+        nb.memberStats.count = int(data["memberCount"]);
+        nb.memberStats.mean = data["memberMean"];
+        nb.memberStats.m2 = data["memberM2"];
+        nb.nonMemberStats = FeatureStats(featureLen);
+        nb.nonMemberStats.count = int(data["nonMemberCount"]);
+        nb.nonMemberStats.mean = data["nonMemberMean"];
+        nb.nonMemberStats.m2 = data["nonMemberM2"];
+        settings = json.loads(str(data["settings"]));
+    finally:
+        data.close();
+
+    nb._fromStats();
+    return (nb, settings);
@@ -0,0 +1,448 @@
+#!/usr/bin/python
+#
+#  bench.py
+#
+#  Benchmarks for the audio analysis pipeline, run against the bundled test
+#  corpora: a suite timing each stage, which saves JSON baselines and
+#  compares runs against them, and microbenchmarks of older code.
+#
+#  This program is distributed under the of the GNU Lesser Public License.
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+import os;
+import sys;
+import glob;
+import json;
+import time;
+import wave;
+import platform;
+import numpy as np;
+
+from audio import AudioFile, stft;
+from sdft import SlidingDFTAudioFile;
+from notes import bandLimit;
+from bayes import NaiveBayes;
+from testsets import allSets, setPath, c3freq, testNoteCount;
+
+try:
+    import tracemalloc;
+except ImportError:
+    # Python 2: peak memory isn't measured
+    tracemalloc = None;
+
+# The stages of the pipeline timed by the suite, in order, with the unit
+# each one's throughput is counted in
+STAGES = [("readWav", "samples"), ("fft", "frames"), ("features", "frames"),
+        ("learn", "vectors"), ("classify", "vectors")];
+
+# Bump when the stages or their counts change, so old baselines aren't
+# compared with new runs
+SUITE_VERSION = 1;
+
+def legacyReadWav(filename):
+    """
+    The original per-sample wav reader, kept as a baseline: reads the first
+    channel of a 16 bit stereo file one sample at a time.
+    """
+    inFile = wave.open(filename);
+    wav = np.empty(inFile.getnframes());
+    for i in range(inFile.getnframes()):
+        frame = bytearray(inFile.readframes(1));
+        if (frame[1]&0x80) != 0:
+            wav[i] = int( ~0xffff | frame[0] | (frame[1]<<8) );
+        else:
+            wav[i] = frame[0] | (frame[1]<<8);
+    return wav;
+
+def legacyFft(wav, framesize):
+    """
+    The original per-frame FFT loop, kept as a baseline.  Returns the full
+    complex spectra (which the original then truncated to real values)
+    and the per-frame means and stdevs of their magnitudes.
+    """
+    numFrames = len(wav) // framesize;
+    frames = np.empty([numFrames, framesize], dtype=np.complex128);
+    for i in range(numFrames):
+        frames[i] = np.fft.fft(wav[i*framesize : (i+1)*framesize]);
+    means = np.array( [ np.mean(np.absolute(frames[i]))
+            for i in range(numFrames) ] );
+    stDevs = np.array( [ np.std(np.absolute(frames[i]))
+            for i in range(numFrames) ] );
+    return (frames, means, stDevs);
+
+def readWav(filename):
+    """Reads a wav file with AudioFile._readWav, without any FFT work"""
+    audioFile = AudioFile.__new__(AudioFile);
+    audioFile.cache = None;
+    audioFile._readWav(filename, "left");
+    return audioFile.wav;
+
+def timeReads(reader, filenames):
+    """Returns the seconds taken to read all filenames, and the sample count"""
+    samples = 0;
+    start = time.time();
+    for filename in filenames:
+        samples += len(reader(filename));
+    return (time.time() - start, samples);
+
+def benchReadWav(corpora):
+    """Compares the legacy and vectorized wav readers on each corpus"""
+    for corpus in corpora:
+        filenames = sorted(glob.glob(corpus + "/*.wav"));
+
+        # Both readers must agree before their timings mean anything
+        for filename in filenames:
+            if not np.array_equal(legacyReadWav(filename), readWav(filename)):
+                raise Exception("Readers disagree on " + filename);
+
+        legacy, samples = timeReads(legacyReadWav, filenames);
+        current, _ = timeReads(readWav, filenames);
+        print("{0}: {1} files, {2} samples".format(
+                    corpus, len(filenames), samples));
+        print("  legacy:     {0:.3f}s ({1:.3g} samples/s)".format(
+                    legacy, samples/legacy));
+        print("  vectorized: {0:.3f}s ({1:.3g} samples/s)".format(
+                    current, samples/current));
+        print("  speedup:    {0:.0f}x".format(legacy/current));
+
+def benchFft(corpora, framesize, hop):
+    """Compares the legacy per-frame FFT loop with the batched stft"""
+    for corpus in corpora:
+        wavs = [readWav(f) for f in sorted(glob.glob(corpus + "/*.wav"))];
+
+        start = time.time();
+        legacy = [legacyFft(wav, framesize) for wav in wavs];
+        legacyTime = time.time() - start;
+
+        start = time.time();
+        current = [stft(wav, framesize, framesize) for wav in wavs];
+        currentTime = time.time() - start;
+
+        start = time.time();
+        overlapped = [stft(wav, framesize, hop, "hann", True) for wav in wavs];
+        overlappedTime = time.time() - start;
+
+        for old, new in zip(legacy, current):
+            if not (np.allclose(old[1], new[1]) and
+                    np.allclose(old[2], new[2])):
+                raise Exception("FFT statistics disagree in " + corpus);
+
+        frames = sum(len(spectra[0]) for spectra in current);
+        print("{0}: {1} frames of {2}".format(corpus, frames, framesize));
+        print("  legacy:  {0:.4f}s, {1:.3g} MB".format(legacyTime,
+                    sum(old[0].real.nbytes for old in legacy) / 1e6));
+        print("  batched: {0:.4f}s, {1:.3g} MB ({2:.0f}x faster)".format(
+                    currentTime,
+                    sum(new[0].nbytes for new in current) / 1e6,
+                    legacyTime/currentTime));
+        print("  hop {0}, hann, magnitudes: {1} frames in {2:.4f}s, "
+                "{3:.3g} MB".format(hop,
+                    sum(len(o[0]) for o in overlapped), overlappedTime,
+                    sum(o[0].nbytes for o in overlapped) / 1e6));
+
+def timeSpectra(audioFile):
+    """
+    Returns the seconds taken to recompute an AudioFile's spectra and its
+    deviation spectrogram.
+    """
+    start = time.time();
+    audioFile._fft(audioFile.framesize);
+    audioFile._deviations = None;
+    audioFile.deviationSpectrogram();
+    return time.time() - start;
+
+def benchSlidingDft(corpus, framesize, hops, statsIntervals=(1, 16)):
+    """
+    Compares the cost per frame of full FFTs and of the sliding DFT
+    backend, over a range of hop sizes, for the bins note analysis needs.
+    The backend is timed with each of statsIntervals; its default, 1,
+    gives exact deviations.
+    """
+    filenames = sorted(glob.glob(corpus + "/*.wav"));
+    maxFrequency = bandLimit(134.0, 36);
+    print("{0}: framesize {1}, sliding DFT anchored every {2} frames".format(
+                corpus, framesize,
+                " or ".join(str(interval) for interval in statsIntervals)));
+
+    for hop in hops:
+        fft = 0.0;
+        sliding = [0.0] * len(statsIntervals);
+        frames = 0;
+        for filename in filenames:
+            audioFile = AudioFile(filename, framesize, hop,
+                    maxFrequency=maxFrequency);
+            fft += timeSpectra(audioFile);
+            for i, interval in enumerate(statsIntervals):
+                slidingFile = SlidingDFTAudioFile(filename, framesize, hop,
+                        maxFrequency=maxFrequency, statsInterval=interval);
+                sliding[i] += timeSpectra(slidingFile);
+            frames += audioFile.numFrames();
+
+        print("  hop {0:4}: {1:6} frames, fft {2:6.1f}us/frame, ".format(hop,
+                    frames, 1e6*fft/frames) + ", ".join(
+                    "sliding/{0} {1:6.1f}us/frame ({2:.1f}x)".format(interval,
+                        1e6*seconds/frames, fft/seconds)
+                    for interval, seconds in zip(statsIntervals, sliding)));
+
+def _measure(stage, repeats):
+    """
+    Runs stage() repeats times, returning its result, the least time taken
+    (the least disturbed by the rest of the system), and the peak memory
+    it allocated, in bytes, measured by one more run under tracemalloc.
+    """
+    best = None;
+    for i in range(repeats):
+        start = time.time();
+        result = stage();
+        elapsed = time.time() - start;
+        if best is None or elapsed < best:
+            best = elapsed;
+
+    peak = None;
+    if tracemalloc is not None:
+        tracing = tracemalloc.is_tracing();
+        if not tracing:
+            tracemalloc.start();
+        tracemalloc.clear_traces();
+        stage();
+        peak = tracemalloc.get_traced_memory()[1];
+        if not tracing:
+            tracemalloc.stop();
+    return (result, best, peak);
+
+def _openAudio(filename, framesize, hop, window, maxFrequency):
+    """
+    Returns an AudioFile whose wav has been read but whose spectra haven't
+    yet been computed, so that the two can be timed separately.
+    """
+    audioFile = AudioFile.__new__(AudioFile);
+    audioFile.cache = None;
+    audioFile.framesize = framesize;
+    audioFile.hop = framesize if hop is None else hop;
+    audioFile.window = window;
+    audioFile.maxFrequency = maxFrequency;
+    audioFile._deviations = None;
+    audioFile._readWav(filename, "left");
+    return audioFile;
+
+class _Quiet:
+    """Discards whatever is printed within a with block"""
+
+    def __enter__(self):
+        self.stdout = sys.stdout;
+        sys.stdout = open(os.devnull, "w");
+
+    def __exit__(self, *exception):
+        sys.stdout.close();
+        sys.stdout = self.stdout;
+
+def benchCorpus(cls, indices, framesize=44100//8, hop=None, window=None,
+        repeats=3):
+    """
+    Times each of STAGES on the files of one corpus (a NoteSet subclass
+    and the indices of its files, as in testsets.allSets): reading the
+    wavs (AudioFile._readWav), their spectra (AudioFile._fft), NoteSet
+    features, NaiveBayes.learn on every feature vector, and classifying
+    them all.  Returns a dict giving, for each stage, the least seconds
+    taken over repeats runs, the count of its unit handled, the rate
+    (count/seconds) and the peak memory allocated (None where tracemalloc
+    isn't available).
+    """
+    reference = c3freq;
+    numNotes = testNoteCount;
+    maxFrequency = bandLimit(reference, numNotes);
+    filenames = [setPath(cls, i) for i in indices];
+
+    def readWavs():
+        return [_openAudio(filename, framesize, hop, window, maxFrequency)
+                for filename in filenames];
+
+    def ffts():
+        for audioFile in audioFiles:
+            audioFile._fft(framesize);
+
+    def features():
+        # Each run recomputes the deviation spectrograms features start from
+        for audioFile in audioFiles:
+            audioFile._deviations = None;
+        noteSets = [cls(i, framesize, reference, numNotes,
+                    audioFile=audioFile)
+                for i, audioFile in zip(indices, audioFiles)];
+        for noteSet in noteSets:
+            noteSet.memberFeatures();
+            noteSet.nonMemberFeatures();
+        return noteSets;
+
+    def learn():
+        with _Quiet():
+            nb.learn();
+
+    def classify():
+        return nb.predict(vectors);
+
+    results = {};
+    def record(name, count, seconds, peak):
+        results[name] = { "seconds": seconds, "count": count,
+                "rate": count/seconds if seconds > 0 else None,
+                "peakBytes": peak };
+
+    audioFiles, seconds, peak = _measure(readWavs, repeats);
+    record("readWav", sum(len(f.wav) for f in audioFiles), seconds, peak);
+
+    _, seconds, peak = _measure(ffts, repeats);
+    numFrames = sum(f.numFrames() for f in audioFiles);
+    record("fft", numFrames, seconds, peak);
+
+    noteSets, seconds, peak = _measure(features, repeats);
+    record("features", numFrames, seconds, peak);
+
+    nb = NaiveBayes();
+    nb.addLearningData(noteSets);
+    vectors = np.concatenate([nb.learnMembers, nb.learnNonMembers]);
+    _, seconds, peak = _measure(learn, repeats);
+    record("learn", len(vectors), seconds, peak);
+
+    _, seconds, peak = _measure(classify, repeats);
+    record("classify", len(vectors), seconds, peak);
+    return results;
+
+def benchSuite(corpora=None, framesize=44100//8, hop=None, window=None,
+        repeats=3):
+    """
+    Runs benchCorpus on each named corpus of testsets.allSets (by default,
+    all of them), returning a dict of the settings, the environment and
+    each corpus's results, which can be saved as JSON as a baseline.
+    """
+    ret = { "version": SUITE_VERSION,
+            "settings": { "framesize": framesize, "hop": hop,
+                "window": window, "repeats": repeats },
+            "environment": { "python": platform.python_version(),
+                "numpy": np.__version__, "machine": platform.machine(),
+                "system": platform.system() },
+            "corpora": {} };
+    for cls, indices, name in allSets:
+        if corpora is None or name in corpora:
+            ret["corpora"][name] = benchCorpus(cls, list(indices), framesize,
+                    hop, window, repeats);
+    return ret;
+
+def _corpusNames(suite):
+    """The corpora of a benchSuite result, in the order of allSets"""
+    return [name for cls, indices, name in allSets
+            if name in suite["corpora"]];
+
+def formatSuite(suite):
+    """Returns benchSuite's results as a table of text"""
+    lines = ["{0:14} {1:9} {2:>9} {3:>16} {4:>10} {5:>9}".format("corpus",
+            "stage", "seconds", "count", "rate/s", "peak MB")];
+    for corpus in _corpusNames(suite):
+        for stage, unit in STAGES:
+            result = suite["corpora"][corpus][stage];
+            peak = result["peakBytes"];
+            lines.append("{0:14} {1:9} {2:9.4f} {3:>8} {4:7} {5:10.4g} "
+                    "{6:>9}".format(corpus, stage, result["seconds"],
+                        result["count"], unit, result["rate"] or float("inf"),
+                        "-" if peak is None else
+                            "{0:.2f}".format(peak/1e6)));
+    return "\n".join(lines);
+
+def compareSuites(baseline, current, tolerance=0.1):
+    """
+    Compares two benchSuite results, returning a list of the regressions
+    found, as text: stages whose rate fell, or whose peak memory rose, by
+    more than the fraction tolerance of the baseline's.  Raises an
+    exception if the runs' settings differ, since then they can't be
+    compared.
+    """
+    if baseline.get("version") != current["version"]:
+        raise Exception("The baseline is from another version of the suite");
+    if baseline["settings"] != current["settings"]:
+        raise Exception("The baseline was run with other settings: {0}"
+                .format(baseline["settings"]));
+
+    regressions = [];
+    for corpus in _corpusNames(current):
+        if corpus not in baseline["corpora"]:
+            continue;
+        for stage, unit in STAGES:
+            old = baseline["corpora"][corpus][stage];
+            new = current["corpora"][corpus][stage];
+            if old["count"] != new["count"]:
+                raise Exception("The baseline handled {0} {1} in {2} {3}, "
+                        "not {4}".format(old["count"], unit, corpus, stage,
+                            new["count"]));
+            if old["rate"] and new["rate"] and \
+                    new["rate"] < old["rate"] * (1 - tolerance):
+                regressions.append("{0} {1}: {2:.4g} {3}/s, was {4:.4g} "
+                        "({5:+.0%})".format(corpus, stage, new["rate"], unit,
+                            old["rate"], new["rate"]/old["rate"] - 1));
+            if old["peakBytes"] and new["peakBytes"] and \
+                    new["peakBytes"] > old["peakBytes"] * (1 + tolerance):
+                regressions.append("{0} {1}: peak {2:.2f} MB, was {3:.2f} MB "
+                        "({4:+.0%})".format(corpus, stage,
+                            new["peakBytes"]/1e6, old["peakBytes"]/1e6,
+                            float(new["peakBytes"])/old["peakBytes"] - 1));
+    return regressions;
+
+def microbenchmarks():
+    """Compares current code with the older code it replaced"""
+    benchReadWav(["notes", "major-majors"]);
+    benchFft(["notes", "major-majors"], 44100//8, 44100//32);
+    benchSlidingDft("notes", 44100//8, [16, 32, 64, 128, 256, 1024]);
+
+
+if __name__ == "__main__":
+    import argparse;
+
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline "
+            "on the test corpora");
+    parser.add_argument("--corpora", nargs="+", default=None,
+            choices=[name for cls, indices, name in allSets]);
+    parser.add_argument("--framesize", type=int, default=44100//8);
+    parser.add_argument("--hop", type=int, default=None);
+    parser.add_argument("--window", default=None);
+    parser.add_argument("--repeats", type=int, default=3,
+            help="runs of each stage, of which the fastest is reported");
+    parser.add_argument("--save", default=None, metavar="JSON",
+            help="save the results as a baseline");
+    parser.add_argument("--compare", default=None, metavar="JSON",
+            help="compare the results with a saved baseline, exiting with "
+                "status 1 if any stage regressed");
+    parser.add_argument("--tolerance", type=float, default=0.1,
+            help="the fraction a rate may fall, or peak memory rise, by "
+                "before it's a regression (default 0.1)");
+    parser.add_argument("--micro", action="store_true",
+            help="run the microbenchmarks of older code instead");
+    args = parser.parse_args();
+
+    if args.micro:
+        microbenchmarks();
+        sys.exit(0);
+
+    suite = benchSuite(args.corpora, args.framesize, args.hop, args.window,
+            args.repeats);
+    print(formatSuite(suite));
+    if args.save is not None:
+        with open(args.save, "w") as outFile:
+            json.dump(suite, outFile, indent=2, sort_keys=True);
+    if args.compare is not None:
+        with open(args.compare, "r") as inFile:
+            regressions = compareSuites(json.load(inFile), suite,
+                    args.tolerance);
+        if regressions:
+            print("Regressions beyond {0:.0%}:".format(args.tolerance));
+            print("\n".join("  " + line for line in regressions));
+            sys.exit(1);
+        print("No regressions beyond {0:.0%}".format(args.tolerance));
@@ -0,0 +1,126 @@
+#!/usr/bin/python
+#
+#  cache.py
+#
+#  Provides a persistent on-disk cache for spectra and features computed
+#  from audio files, so that they needn't be recomputed on every run.
+#
+#  This program is distributed under the of the GNU Lesser Public License.
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+import os;
+import hashlib;
+import tempfile;
+import numpy as np;
+
+# Atomically replaces one file with another (os.rename won't on Windows)
+_replace = getattr(os, "replace", os.rename);
+
+class FeatureCache:
+    """
+    A directory of .npz files, each holding a set of named arrays under a
+    key.  Entries are written atomically, so concurrent runs never see
+    partial entries, and the least recently used entries are deleted when
+    the directory grows past maxBytes.
+    """
+
+    def __init__(self, directory, maxBytes=512*2**20):
+        self.directory = directory;
+        self.maxBytes = maxBytes;
+        if not os.path.isdir(directory):
+            os.makedirs(directory);
+
+    def key(self, *parts):
+        """
+        Returns a key identifying the given parts: strings, bytes, numbers,
+        None, numpy arrays, or other keys.
+        """
+        digest = hashlib.sha1();
+        for part in parts:
+            if isinstance(part, bytes):
+                digest.update(part);
+            elif isinstance(part, np.ndarray):
+                digest.update(str(part.dtype).encode("ascii"));
+                digest.update(np.ascontiguousarray(part).tobytes());
+            else:
+                digest.update(repr(part).encode("utf-8"));
+            digest.update(b"\0");
+        return digest.hexdigest();
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".npz");
+
+    def load(self, key):
+        """
+        Returns a dict of the arrays stored under key, or None if there are
+        none (or they can't be read).
+        """
+        path = self._path(key);
+        try:
+            data = np.load(path);
+            try:
+                arrays = dict((name, data[name]) for name in data.files);
+            finally:
+                data.close();
+        except Exception:
+            # Missing, or left by an incompatible version: recompute it.
+            return None;
+
+        # Mark the entry as recently used
+        try:
+            os.utime(path, None);
+        except OSError:
+            pass;
+        return arrays;
+
+    def store(self, key, arrays):
+        """Stores a dict of named arrays under key"""
+        fd, tmpPath = tempfile.mkstemp(dir=self.directory, suffix=".tmp");
+        try:
+            outFile = os.fdopen(fd, "wb");
+            try:
+                np.savez(outFile, **arrays);
+            finally:
+                outFile.close();
+            _replace(tmpPath, self._path(key));
+        except:
+            os.remove(tmpPath);
+            raise;
+
+        self.evict();
+
+    def evict(self):
+        """Deletes least recently used entries until within maxBytes"""
+        entries = [];
+        total = 0;
+        for name in os.listdir(self.directory):
+            if not name.endswith(".npz"):
+                continue;
+            try:
+                stat = os.stat(os.path.join(self.directory, name));
+            except OSError:
+                continue; # Evicted by someone else
+            entries.append((stat.st_mtime, stat.st_size, name));
+            total += stat.st_size;
+
+        entries.sort();
+        for mtime, size, name in entries:
+            if total <= self.maxBytes:
+                break;
+            try:
+                os.remove(os.path.join(self.directory, name));
+            except OSError:
+                pass;
+            total -= size;
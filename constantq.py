@@ -0,0 +1,157 @@
+#!/usr/bin/python
+#
+#  constantq.py
+#
+#  Provides a constant-Q style front end for NoteSet, which resamples each
+#  FFT frame onto log-spaced semitone bins before features are found.
+#
+#  This program is distributed under the of the GNU Lesser Public License.
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+import math;
+import numpy as np;
+
+from notes import bandFeatures, NUM_FUNDAMENTALS, ResolutionError;
+
+# scipy is optional: without it, kernels are stored as dense matrices, which
+# is slower but gives the same results.
+try:
+    import scipy.sparse as sparse;
+except ImportError:
+    sparse = None;
+
+# Semitones of log bins kept below the reference, enough for the bands of
+# the lowest note's subharmonics (24 semitones down) and their neighbours.
+BINS_BELOW = 26;
+
+# Log bins kept above the top note's band, so that the peakiness of a peak
+# at its top has a neighbour to compare with
+GUARD_BINS = 1;
+
+class SemitoneTable:
+    """
+    The log bin indices of the band around each note and its subharmonics,
+    laid out like a BandTable so that bandFeatures can use them.  Every band
+    is binsPerSemitone bins wide, so all of them can be resolved.
+    """
+
+    def __init__(self, binsPerSemitone, numNotes):
+        self.numNotes = numNotes;
+        offsets = np.arange(binsPerSemitone) - binsPerSemitone//2;
+
+        centers = (np.arange(numNotes) + BINS_BELOW) * binsPerSemitone;
+        self.noteBands = centers[:,np.newaxis] + offsets;
+
+        # Subharmonic i+2 lies 12*log2(i+2) semitones below its note
+        funCenters = np.concatenate([centers - int(round(
+                    12*math.log(i+2, 2)*binsPerSemitone))
+                for i in range(NUM_FUNDAMENTALS)]);
+        self.funBands = funCenters[:,np.newaxis] + offsets;
+        self.funResolved = np.ones(len(funCenters), dtype=bool);
+        self.funInx = funCenters.astype(np.float64);
+
+
+class SemitoneKernel:
+    """
+    Maps rows of a deviation spectrogram to log-spaced bins, with a single
+    matrix product.  Each log bin is a weighted average of the FFT bins
+    around its frequency, with triangular weights at least one FFT bin
+    wide, so a log bin narrower than an FFT bin is linearly interpolated.
+    Since the weights sum to one, the results are still deviations.
+    """
+
+    def __init__(self, framesize, sampleRate, numBins, reference, numNotes,
+            binsPerSemitone):
+        self.table = SemitoneTable(binsPerSemitone, numNotes);
+        self.numBins = numBins;
+
+        numLogBins = (BINS_BELOW + numNotes) * binsPerSemitone + GUARD_BINS;
+        semitones = np.arange(numLogBins, dtype=np.float64)/binsPerSemitone - \
+                BINS_BELOW;
+        centers = reference * np.power(2, semitones/12) * \
+                framesize / sampleRate;
+        halfWidths = np.maximum(centers * (pow(2, 1.0/(24*binsPerSemitone)) -
+                pow(2, -1.0/(24*binsPerSemitone))), 1);
+
+        rows = [];
+        cols = [];
+        weights = [];
+        for i in range(numLogBins):
+            first = max(int(math.floor(centers[i] - halfWidths[i])) + 1, 0);
+            last = min(int(math.ceil(centers[i] + halfWidths[i])) - 1,
+                    numBins - 1);
+            if last < first:
+                raise ResolutionError("FFT has too few bins for the note range");
+            bins = np.arange(first, last + 1);
+            binWeights = 1 - np.abs(bins - centers[i])/halfWidths[i];
+            rows += [i] * len(bins);
+            cols += bins.tolist();
+            weights += (binWeights / np.sum(binWeights)).tolist();
+
+        if sparse is not None:
+            self.matrix = sparse.csr_matrix((weights, (rows, cols)),
+                    shape=(numLogBins, numBins), dtype=np.float32);
+        else:
+            self.matrix = np.zeros([numLogBins, numBins], dtype=np.float32);
+            self.matrix[rows, cols] = weights;
+
+    def transform(self, deviations):
+        """
+        Maps a (frames x numBins) block of deviations to a (frames x log
+        bins) float32 array.
+        """
+        if deviations.shape[1] != self.numBins:
+            raise Exception("Deviations don't match the kernel's bins");
+        if sparse is not None:
+            return np.asarray(self.matrix.dot(deviations.T).T,
+                    dtype=np.float32);
+        return np.dot(deviations, self.matrix.T);
+
+    def features(self, deviations):
+        """
+        Computes features, like bandFeatures, from the log bins of a block
+        of deviations.
+        """
+        return bandFeatures(self.transform(deviations), self.table);
+
+
+# SemitoneKernels shared between NoteSets, by (framesize, sampleRate,
+# numBins, reference, numNotes, binsPerSemitone)
+_kernels = {};
+
+class ConstantQ:
+    """
+    A NoteSet front end which finds features in log-spaced bins, with
+    binsPerSemitone bins per semitone, rather than in FFT bins.  Notes whose
+    semitone band is narrower than an FFT bin are interpolated, so small
+    frames can be used with the full note range, although that doesn't give
+    them any more real frequency resolution.  Features are on a different
+    scale from those found in FFT bins, so a classifier must be trained on
+    the same front end it's used with.
+    """
+
+    def __init__(self, binsPerSemitone=3):
+        self.binsPerSemitone = binsPerSemitone;
+
+    def __repr__(self):
+        return "ConstantQ({0})".format(self.binsPerSemitone);
+
+    def kernel(self, framesize, sampleRate, numBins, reference, numNotes):
+        """Returns the SemitoneKernel for the given analysis parameters"""
+        key = (framesize, sampleRate, numBins, reference, numNotes,
+                self.binsPerSemitone);
+        if key not in _kernels:
+            _kernels[key] = SemitoneKernel(*key);
+        return _kernels[key];
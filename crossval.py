@@ -0,0 +1,232 @@
+#!/usr/bin/python
+#
+#  crossval.py
+#
+#  Provides k-fold cross-validation of NaiveBayes classifiers on the test
+#  sets, run in parallel over a memory-mapped FeatureStore.
+#
+#  This program is distributed under the of the GNU Lesser Public License.
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+import shutil;
+import tempfile;
+import multiprocessing;
+import numpy as np;
+
+from bayes import NaiveBayes;
+from store import FeatureStore;
+
+# FeatureStores opened by this process, by directory
+_stores = {};
+
+def _open(directory):
+    """
+    Opens a FeatureStore for crossValidate, once per process, so that all
+    worker processes share the same pages rather than copies.
+    """
+    if directory not in _stores:
+        _stores[directory] = FeatureStore(directory);
+    return _stores[directory];
+
+def foldsOf(length, folds, random):
+    """
+    Returns the fold (0 to folds-1) of each of length items, assigned at
+    random from random (a numpy RandomState), with fold sizes differing by
+    at most one.
+    """
+    return random.permutation(length) % folds;
+
+def _accuracy(nb, members, nonMembers):
+    """
+    Returns (correct members, members, correct nonMembers, nonMembers)
+    for nb classifying the given feature vectors.
+    """
+    corMembers = int(np.count_nonzero(nb.predict(members)));
+    corNonMembers = len(nonMembers) - int(np.count_nonzero(
+            nb.predict(nonMembers)));
+    return (corMembers, len(members), corNonMembers, len(nonMembers));
+
+def _split(job):
+    """
+    Returns the member and nonMember features of a job's dataset, each
+    split into (learning, testing) by the job's fold.
+    """
+    (directory, name, i), repeat, fold, folds, seed = job[:5];
+    random = np.random.RandomState([seed, repeat, i]);
+    store = _open(directory);
+    split = [];
+    for rows in store.memberRows(name):
+        learn = foldsOf(len(rows), folds, random) != fold;
+        split.append((store.features[rows[learn]],
+                store.features[rows[~learn]]));
+    return split;
+
+def _fitFold(job):
+    """
+    Fits a NaiveBayes to the learning rows of one fold of one dataset, in a
+    worker process.  Returns the classifier, and its accuracy on the
+    learning and testing rows (see _accuracy).
+    """
+    members, nonMembers = _split(job);
+    nb = NaiveBayes();
+    nb.partialFit(members[0], nonMembers[0]);
+    return (nb, _accuracy(nb, members[0], nonMembers[0]),
+            _accuracy(nb, members[1], nonMembers[1]));
+
+def _testFold(job):
+    """
+    Returns the accuracy of a job's classifier on the learning and testing
+    rows of one fold of one dataset, in a worker process.
+    """
+    members, nonMembers = _split(job);
+    nb = job[5];
+    return (_accuracy(nb, members[0], nonMembers[0]),
+            _accuracy(nb, members[1], nonMembers[1]));
+
+def _fractions(learning, testing):
+    """
+    Returns learning and testing accuracy counts (see _accuracy) as the
+    fractions of members and nonMembers correct, in the order proj.py
+    reports them.
+    """
+    return [float(learning[0])/learning[1], float(learning[2])/learning[3],
+            float(testing[0])/testing[1], float(testing[2])/testing[3]];
+
+
+def crossValidate(datasets, folds=5, repeats=1, seed=0, processes=None):
+    """
+    Cross-validates a NaiveBayes classifier on each of datasets (lists of
+    NoteSets, as testsets.readAll gives, or a FeatureStore, for each of its
+    datasets), and one on all of them together.
+    Each dataset's member and nonMember features are split into folds at
+    random, repeats times; each fold is tested on a classifier learnt from
+    the others.  The classifier for all datasets is learnt from the same
+    folds, by merging the per-dataset classifiers.
+    Returns a (len(datasets)+1 x folds*repeats x 4) array of the fraction
+    of learning members, learning nonMembers, testing members and testing
+    nonMembers classified correctly, with all datasets last.
+    Folds run in a pool of processes (by default, one per core), or in
+    this process if processes=1, reading the features from the store's
+    memory-mapped files (a temporary one, for NoteSets) rather than being
+    sent copies.
+    """
+    directory = None;
+    store = None;
+    pool = None;
+    try:
+        if isinstance(datasets, FeatureStore):
+            store = datasets;
+        else:
+            # Store each dataset's features once, for every worker to map
+            directory = tempfile.mkdtemp(prefix="crossval");
+            store = FeatureStore(directory);
+            for i in range(len(datasets)):
+                store.add(str(i), datasets[i]);
+        datasets = store.names();
+        paths = [(store.directory, datasets[i], i)
+                for i in range(len(datasets))];
+
+        jobs = [(paths[i], repeat, fold, folds, seed)
+                for repeat in range(repeats)
+                for fold in range(folds)
+                for i in range(len(datasets))];
+
+        if processes == 1:
+            mapJobs = lambda function, jobs: [function(job) for job in jobs];
+        else:
+            pool = multiprocessing.Pool(processes);
+            mapJobs = pool.map;
+
+        results = np.empty([len(datasets)+1, folds*repeats, 4]);
+        fitted = mapJobs(_fitFold, jobs);
+
+        # Merge each fold's classifiers into one for all datasets, and
+        # test it on every dataset
+        allJobs = [];
+        for run in range(folds*repeats):
+            runFits = fitted[run*len(datasets) : (run+1)*len(datasets)];
+            nb = NaiveBayes();
+            for i in range(len(datasets)):
+                nb.merge(runFits[i][0]);
+                results[i, run] = _fractions(runFits[i][1], runFits[i][2]);
+            allJobs += [job + (nb,) for job in
+                    jobs[run*len(datasets) : (run+1)*len(datasets)]];
+
+        tested = mapJobs(_testFold, allJobs);
+        for run in range(folds*repeats):
+            counts = np.sum(tested[run*len(datasets) : (run+1)*len(datasets)],
+                    0);
+            results[len(datasets), run] = _fractions(counts[0], counts[1]);
+    finally:
+        if pool is not None:
+            pool.close();
+            pool.join();
+        if store is not None:
+            _stores.pop(store.directory, None);
+        if directory is not None:
+            shutil.rmtree(directory, ignore_errors=True);
+
+    return results;
+
+def latexTable(titles, results):
+    """
+    Returns a LaTeX table body, like the one proj.py prints, of the mean
+    and standard deviation over folds of each accuracy in results (from
+    crossValidate), with a row titled from titles for each dataset.
+    """
+    table = "";
+    for i in range(len(results)):
+        table += titles[i];
+        means = np.mean(results[i], 0);
+        stDevs = np.std(results[i], 0);
+        for j in range(4):
+            table += " & {0:.3}\\% $\\pm$ {1:.1f}".format(100.0*means[j],
+                    100.0*stDevs[j]);
+        table += " \\\\ \n\\hline\n";
+    return table;
+
+
+if __name__ == "__main__":
+    import argparse;
+    from testsets import readAll;
+    from cache import FeatureCache;
+
+    parser = argparse.ArgumentParser(
+            description="Cross-validate classifiers on the test sets");
+    parser.add_argument("--framesize", type=int, default=44100//8);
+    parser.add_argument("--folds", type=int, default=5);
+    parser.add_argument("--repeats", type=int, default=1);
+    parser.add_argument("--seed", type=int, default=0);
+    parser.add_argument("--processes", type=int, default=None);
+    parser.add_argument("--store", default=None,
+            help="a FeatureStore directory to read the test sets from, "
+                "storing them there first if it's empty");
+    args = parser.parse_args();
+
+    titles = ["Single Notes", "Majors", "Octaves", "Octave-Majors",
+            "Double Majors", "All"];
+    if args.store is None:
+        datasets = readAll(args.framesize, FeatureCache(".cache"),
+                args.processes);
+    else:
+        datasets = FeatureStore(args.store);
+        if datasets.numRows() == 0:
+            for noteSets, title in zip(readAll(args.framesize,
+                    FeatureCache(".cache"), args.processes), titles):
+                datasets.add(title, noteSets);
+        titles = datasets.names() + ["All"];
+    results = crossValidate(datasets, args.folds, args.repeats, args.seed,
+            args.processes);
+    print(latexTable(titles, results));
@@ -0,0 +1,94 @@
+#!/usr/bin/python
+#
+#  gate.py
+#
+#  Provides a gate which finds the silent frames of a recording from their
+#  RMS levels, so they can be skipped before features are found.
+#
+#  This program is distributed under the of the GNU Lesser Public License.
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+import numpy as np;
+
+# Reported in place of the classifier's decisions for frames which are
+# skipped by a gate
+SILENT = "silent";
+
+def hysteresis(levels, onLevel, offLevel, active=False):
+    """
+    Returns an array of booleans, true for each level which is gated on:
+    the gate opens at a level of at least onLevel, and stays open until
+    the level falls below offLevel.  active is the state of the gate before
+    the first level.
+    """
+    levels = np.asarray(levels);
+    # 1 where the gate opens, 0 where it closes, and -1 where it holds
+    changes = np.where(levels >= onLevel, 1,
+            np.where(levels < offLevel, 0, -1));
+    changes = np.concatenate([[1 if active else 0], changes]);
+
+    # Each level takes the state from the last change at or before it
+    last = np.where(changes >= 0, np.arange(len(changes)), 0);
+    last = np.maximum.accumulate(last);
+    return changes[last][1:] == 1;
+
+
+class EnergyGate:
+    """
+    Gates frames on their RMS level, in dB relative to a reference level.
+    Frames are heard from the first reaching onLevel until one falls below
+    offLevel (by default, 6 dB lower), so decaying notes aren't chopped up
+    by a gate fluttering around its threshold.
+    """
+
+    def __init__(self, onLevel=-50.0, offLevel=None, reference=None):
+        """
+        reference is the RMS sample value of 0 dB.  If it's None, levels
+        are relative to the loudest frame: the loudest in the recording, or
+        the loudest so far in a stream.
+        """
+        self.onLevel = float(onLevel);
+        if offLevel is None:
+            offLevel = self.onLevel - 6;
+        self.offLevel = float(offLevel);
+        if self.offLevel > self.onLevel:
+            raise Exception("The gate can't close above its opening level");
+        self.reference = reference;
+
+    def __repr__(self):
+        return "EnergyGate({0}, {1}, {2})".format(self.onLevel, self.offLevel,
+                self.reference);
+
+    def levels(self, rms, loudest=None):
+        """
+        Converts RMS levels to dB, relative to the reference level, or
+        loudest if there's no reference (by default, the largest of rms).
+        """
+        reference = self.reference;
+        if reference is None:
+            reference = np.max(rms) if loudest is None else loudest;
+        # Digital silence is far below any threshold
+        tiny = np.finfo(np.float64).tiny;
+        return 20*np.log10(np.maximum(rms, tiny) / max(reference, tiny));
+
+    def mask(self, rms, loudest=None, active=False):
+        """
+        Returns an array of booleans, false for each frame which is silent,
+        given the frames' RMS levels (see AudioFile.frameRms).  To gate a
+        stream in pieces, pass the loudest RMS level so far (see levels) and
+        the gate's state (the last frame's entry) after the previous piece.
+        """
+        return hysteresis(self.levels(rms, loudest), self.onLevel,
+                self.offLevel, active);
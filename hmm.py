@@ -0,0 +1,330 @@
+#!/usr/bin/python
+#
+#  hmm.py
+#
+#  Provides temporal smoothing of a classifier's per-frame note decisions,
+#  with a two-state (off/on) hidden Markov model for each note, decoded by
+#  Viterbi over whole recordings or, for streams, with a fixed lag.
+#
+#  This program is distributed under the of the GNU Lesser Public License.
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+import math;
+import numpy as np;
+
+from stream import noteEvents;
+
+# The number of blocks NoteHmm.scores splits frames into, to scan
+SCAN_BLOCK = 64;
+
+def _compose(first, second):
+    """
+    Returns the map applying first, then second, where each is a map
+    x -> clip(x + shift, lower, upper) given as (shift, lower, upper), of
+    arrays which broadcast together.
+    """
+    shift1, lower1, upper1 = first;
+    shift2, lower2, upper2 = second;
+    lower = lower1 + shift2;
+    np.minimum(np.maximum(lower, lower2, out=lower), upper2, out=lower);
+    upper = upper1 + shift2;
+    np.minimum(np.maximum(upper, lower2, out=upper), upper2, out=upper);
+    return (shift1 + shift2, lower, upper);
+
+def _scanInPlace(shift, lower, upper):
+    """
+    Replaces maps (see _compose), held in arrays whose first axis is the
+    sequence, with the compositions of every prefix, in log2(length)
+    vectorised steps: at each, every map is composed with the one step
+    before it.
+    """
+    step = 1;
+    while step < len(shift):
+        composed = _compose((shift[:-step], lower[:-step], upper[:-step]),
+                (shift[step:], lower[step:], upper[step:]));
+        shift[step:], lower[step:], upper[step:] = composed;
+        step *= 2;
+
+def _scan(maps):
+    """
+    Returns the composition of every prefix of a sequence of maps (see
+    _compose), given as (shift, lower, upper) arrays whose first axis is
+    the sequence.  The maps are split into SCAN_BLOCK blocks, which are
+    scanned side by side (fewer steps over the whole sequence than one
+    scan of it), then each block's prefixes are composed with the
+    composition of all of the blocks before it.
+    """
+    length = len(maps[0]);
+    rest = maps[0].shape[1:];
+    blockLength = -(-length // SCAN_BLOCK);
+    padding = [(0, blockLength*SCAN_BLOCK - length)] + [(0, 0)] * len(rest);
+
+    # (position in block x block x ...), so each step slices contiguously
+    shift, lower, upper = [np.pad(np.asarray(part, dtype=np.float64),
+                padding, "edge").reshape((SCAN_BLOCK, blockLength) + rest)
+                .swapaxes(0, 1).copy()
+            for part in maps];
+    _scanInPlace(shift, lower, upper);
+
+    # What comes before each block is the composition of the blocks before
+    carry = [part[-1].copy() for part in (shift, lower, upper)];
+    _scanInPlace(*carry);
+    composed = _compose([part[np.newaxis, :-1] for part in carry],
+            (shift[:, 1:], lower[:, 1:], upper[:, 1:]));
+    shift[:, 1:], lower[:, 1:], upper[:, 1:] = composed;
+
+    return tuple(part.swapaxes(0, 1).reshape((-1,) + rest)[:length]
+            for part in (shift, lower, upper));
+
+
+class NoteHmm:
+    """
+    A two-state hidden Markov model of whether each note is sounding, with
+    the classifier's log-likelihood ratios (see
+    NaiveBayes.logLikelihoodRatio) as the evidence of each frame.  A note
+    which is off starts with probability onProbability per frame, and one
+    which is on stops with probability offProbability; notes are
+    independent.  These probabilities, and initialOn, are the model's
+    only priors; posterior log odds (NaiveBayes.logOdds) would count the
+    classifier's memberPrior again on every frame.
+
+    With two states, Viterbi only needs the difference between the scores
+    of the best paths ending on and off.  Each frame maps the difference
+    before it to the one after with x -> ratio + clip(x + c, low, high),
+    and those maps compose into maps of the same form, so the differences
+    for every frame and note are found by a vectorised scan (see _scan)
+    rather than a loop over frames.  The best path is then found backwards
+    from them without a loop too: each frame's state is fixed where the
+    difference is outside [offBelow, onAbove], and is otherwise the state
+    of the frame after.
+    """
+
+    def __init__(self, onProbability=0.01, offProbability=0.05,
+            initialOn=0.01):
+        """
+        initialOn is the probability that a note is on before the first
+        frame.  onProbability+offProbability must be less than one: more
+        would make notes likelier to change than not.
+        """
+        if not (0 < onProbability and 0 < offProbability and
+                onProbability + offProbability < 1):
+            raise Exception("Transition probabilities must be positive, and "
+                    "sum to less than one");
+        self.onProbability = onProbability;
+        self.offProbability = offProbability;
+        self.initialOn = initialOn;
+
+        stayOff = math.log(1 - onProbability);
+        turnOn = math.log(onProbability);
+        turnOff = math.log(offProbability);
+        stayOn = math.log(1 - offProbability);
+        self.initialLogOdds = math.log(initialOn) - math.log(1 - initialOn);
+
+        # The best path into on comes from on when the difference is above
+        # offBelow; the best path into off comes from on above onAbove
+        self.shift = stayOn - stayOff;
+        self.low = turnOn - stayOff;
+        self.high = stayOn - turnOff;
+        self.offBelow = turnOn - stayOn;
+        self.onAbove = stayOff - turnOff;
+
+    def __repr__(self):
+        return "NoteHmm({0}, {1}, {2})".format(self.onProbability,
+                self.offProbability, self.initialOn);
+
+    def scores(self, ratios, previous=None):
+        """
+        Returns the Viterbi score of being on less that of being off, for
+        each note of each frame of ratios (a frames x notes array of
+        log-likelihood ratios, with NaN or -inf for frames known to be
+        silent).  previous holds the scores of the frame before, if any.
+        """
+        ratios = np.array(ratios, dtype=np.float64);
+        ratios[np.isnan(ratios)] = -np.inf;
+        if len(ratios) == 0:
+            return ratios;
+        if previous is None:
+            first = self.initialLogOdds + ratios[:1];
+            return np.concatenate([first, self.scores(ratios[1:], first[0])]);
+
+        shift, lower, upper = _scan((self.shift + ratios,
+                self.low + ratios, self.high + ratios));
+        return np.clip(previous + shift, lower, upper);
+
+    def backtrack(self, scores, final=None):
+        """
+        Returns the states (true for on) of the best paths through frames
+        with the given scores.  final holds the states of the frame after
+        the last, if any; otherwise the last frame takes the better state.
+        """
+        if len(scores) == 0:
+            return np.zeros(scores.shape, dtype=bool);
+        if final is None:
+            final = scores[-1] > 0;
+
+        on = np.vstack([scores > self.onAbove, final]);
+        fixed = np.vstack([on[:-1] | (scores <= self.offBelow),
+                np.ones(len(final), dtype=bool)]);
+
+        # Each frame takes the state of the next fixed frame at or after it
+        numFrames = len(fixed);
+        nextFixed = np.where(fixed, np.arange(numFrames)[:,np.newaxis],
+                numFrames);
+        nextFixed = np.minimum.accumulate(nextFixed[::-1], 0)[::-1];
+        return on[nextFixed[:-1], np.arange(scores.shape[1])];
+
+    def decode(self, ratios):
+        """
+        Returns the most likely states (true for on) of each note of each
+        frame of ratios (see scores), as a frames x notes array.
+        """
+        return self.backtrack(self.scores(ratios));
+
+    def events(self, ratios, start=0):
+        """
+        Returns the note events of the decoded states (see decode and
+        stream.noteEvents), with frames numbered from start.
+        """
+        return noteEvents(self.decode(ratios), None, start);
+
+
+class FixedLagDecoder:
+    """
+    Decodes a NoteHmm online, as frames' log-likelihood ratios arrive:
+    each frame's states are decided once lag more frames have arrived,
+    from the best path to the newest frame, so decisions are at most lag
+    frames late.
+    With a lag as long as the stream, this is decode.
+    """
+
+    def __init__(self, hmm, numNotes, lag=8):
+        self.hmm = hmm;
+        self.lag = lag;
+        # Scores of the frames not yet decided, and of the frame before
+        self._scores = np.empty([0, numNotes]);
+        self._previous = None;
+        # The states of the last frame decided, and the frames decided
+        self._decided = np.zeros(numNotes, dtype=bool);
+        self.frameCount = 0;
+
+    def push(self, ratios):
+        """
+        Adds the log-likelihood ratios of the next frames (a frames x
+        notes array), returning the index of the first frame decided and
+        the states of the frames now decided, which may be none.
+        """
+        scores = self.hmm.scores(ratios, self._previous);
+        if len(scores) > 0:
+            self._previous = scores[-1];
+        self._scores = np.concatenate([self._scores, scores]);
+        return self._decide(max(len(self._scores) - self.lag, 0));
+
+    def flush(self):
+        """Decides every frame left, returning as push does"""
+        return self._decide(len(self._scores));
+
+    def _decide(self, count):
+        start = self.frameCount;
+        states = self.hmm.backtrack(self._scores)[:count];
+        self._scores = self._scores[count:];
+        self.frameCount += count;
+        return (start, states);
+
+    def pushEvents(self, ratios):
+        """
+        Adds frames' ratios as push does, returning the note events of
+        the frames decided (see stream.noteEvents).
+        """
+        return self._events(self.push(ratios));
+
+    def flushEvents(self):
+        """Decides every frame left, returning their note events"""
+        return self._events(self.flush());
+
+    def _events(self, decided):
+        start, states = decided;
+        events = noteEvents(states, self._decided, start);
+        if len(states) > 0:
+            self._decided = states[-1];
+        return events;
+
+
+def viterbi(hmm, ratios):
+    """
+    A plain Viterbi decoder, a frame at a time, for checking NoteHmm.decode
+    against.  Returns the same states.
+    """
+    numFrames, numNotes = ratios.shape;
+    ratios = np.where(np.isnan(ratios), -np.inf, ratios);
+    transitions = np.log([[1 - hmm.onProbability, hmm.onProbability],
+            [hmm.offProbability, 1 - hmm.offProbability]]);
+
+    best = np.zeros([numNotes, 2]);
+    best[:, 0] = math.log(1 - hmm.initialOn);
+    best[:, 1] = math.log(hmm.initialOn) + ratios[0];
+    cameFrom = np.zeros([numFrames, numNotes, 2], dtype=int);
+    for frame in range(1, numFrames):
+        # (notes x from x to)
+        paths = best[:, :, np.newaxis] + transitions;
+        cameFrom[frame] = np.argmax(paths, 1);
+        best = np.max(paths, 1);
+        best[:, 1] += ratios[frame];
+
+    states = np.zeros([numFrames, numNotes], dtype=bool);
+    state = np.argmax(best, 1);
+    for frame in range(numFrames - 1, -1, -1):
+        states[frame] = state == 1;
+        state = cameFrom[frame, np.arange(numNotes), state];
+    return states;
+
+
+if __name__ == "__main__":
+    import time;
+
+    # Check scores against the recurrence they come from, and decode
+    # against plain Viterbi, on noisy random evidence
+    random = np.random.RandomState(0);
+    hmm = NoteHmm();
+    truth = np.cumsum(random.rand(2000, 36) < 0.03, 0) % 2 == 1;
+    ratios = np.where(truth, 2.0, -2.0) + 3*random.randn(2000, 36);
+    scores = [hmm.initialLogOdds + ratios[0]];
+    for frame in range(1, len(ratios)):
+        scores.append(ratios[frame] + np.clip(scores[-1] + hmm.shift,
+                    hmm.low, hmm.high));
+    print("largest score error: {0:.3g}".format(np.max(np.abs(
+            hmm.scores(ratios) - scores))));
+
+    ratios[100:150] = np.nan;
+    decoded = hmm.decode(ratios);
+    print("decode matches Viterbi: {0}".format(
+            np.array_equal(decoded, viterbi(hmm, ratios))));
+    print("frames right: {0:.1%} per frame, {1:.1%} decoded".format(
+            np.mean((ratios > 0) == truth), np.mean(decoded == truth)));
+
+    decoder = FixedLagDecoder(hmm, 36, lag=16);
+    online = [];
+    for start in range(0, len(ratios), 7):
+        online.append(decoder.push(ratios[start : start+7])[1]);
+    online.append(decoder.flush()[1]);
+    online = np.concatenate(online);
+    print("fixed lag 16 agrees on {0:.2%} of states".format(
+            np.mean(online == decoded)));
+
+    # An hour of frames, at the default 8 frames per second
+    ratios = 3*random.randn(8*3600, 36);
+    start = time.time();
+    hmm.decode(ratios);
+    print("decoded {0} frames of 36 notes in {1:.3f}s".format(
+            len(ratios), time.time() - start));
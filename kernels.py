@@ -0,0 +1,275 @@
+#!/usr/bin/python
+#
+#  kernels.py
+#
+#  Provides the kernels computing note features from deviation spectra:
+#  the band peak search, peakiness and subharmonic comparison of every note
+#  of every frame.  By default numpy gathers every band at once; where
+#  numba is installed, a kernel which does this in one pass over each frame
+#  can be compiled instead, for live use, where frames arrive a few at a
+#  time.  Both give identical features: run this file to check.
+#
+#  This program is distributed under the of the GNU Lesser Public License.
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+import numpy as np;
+
+def numpyBandFeatures(deviations, table):
+    """
+    Computes the feature vector of every note of every frame of a deviation
+    spectrogram (frames x bins, see AudioFile.deviationSpectrogram), using
+    the bands in table (a notes.BandTable, or anything laid out like one).
+    Returns a (frames x notes x 3) float32 array; see NoteSet.feature.
+    """
+    numFrames = len(deviations);
+    frames = np.arange(numFrames)[:,np.newaxis];
+    numFundamentals = len(table.funBands) // table.numNotes;
+
+    # Peak deviation within each note's band, and where it was found
+    bands = deviations[:, table.noteBands];
+    peaks = np.max(bands, 2);
+    peakInx = table.noteBands[np.arange(table.numNotes), np.argmax(bands, 2)];
+
+    # Peakiness is the second difference at the peak
+    peakiness = peaks - 0.5*(deviations[frames, peakInx+1] +
+            deviations[frames, peakInx-1]);
+
+    # Subharmonic peaks, or interpolated values where the band is too
+    # narrow to find a peak in
+    funPeaks = np.max(deviations[:, table.funBands], 2);
+    lower = np.floor(table.funInx).astype(int);
+    fraction = (table.funInx - lower).astype(np.float32);
+    interpolated = deviations[:, lower] + fraction*(
+            deviations[:, lower+1] - deviations[:, lower]);
+    funPeaks = np.where(table.funResolved, funPeaks, interpolated);
+    funPeaks = funPeaks.reshape((numFrames, numFundamentals, table.numNotes));
+
+    features = np.empty([numFrames, table.numNotes, 3], dtype=np.float32);
+    features[:,:,0] = peaks;
+    features[:,:,1] = peakiness;
+    features[:,:,2] = peaks - np.max(funPeaks, 1);
+    return features;
+
+def checkTable(table, numBins):
+    """
+    Raises IndexError unless every bin the kernels read with table lies in
+    rows of numBins bins: each note band and the bins either side of it
+    (for peakiness), each resolved subharmonic band, and the two bins
+    interpolated between for each unresolved one.  Tables don't change
+    once built, so each remembers the numBins it was last found valid for,
+    and checking it again costs nothing.
+    """
+    if getattr(table, "checkedBins", None) == numBins:
+        return;
+    lower = np.floor(table.funInx[~table.funResolved]).astype(int);
+    funBands = table.funBands[table.funResolved];
+    if (np.min(table.noteBands) < 1 or np.max(table.noteBands) + 1 >= numBins
+            or (funBands.size and (np.min(funBands) < 0 or
+                np.max(funBands) >= numBins))
+            or (lower.size and (np.min(lower) < 0 or
+                np.max(lower) + 1 >= numBins))):
+        raise IndexError("The band table reads bins outside the {0} bins "
+                "of the deviations".format(numBins));
+    table.checkedBins = numBins;
+
+def _greater(value, best):
+    """
+    True if value replaces best as the maximum so far, as np.max and
+    np.argmax see it: the first NaN is the maximum.
+    """
+    return best == best and (value > best or value != value);
+
+def _bandMax(row, band):
+    """Returns the peak of row in a band of indices, and its index"""
+    inx = band[0];
+    peak = row[inx];
+    for k in range(1, len(band)):
+        if _greater(row[band[k]], peak):
+            inx = band[k];
+            peak = row[inx];
+    return (peak, inx);
+
+def _bandFeaturesLoop(deviations, noteBands, funBands, funResolved,
+        funLower, funFraction, features):
+    """
+    Fills features with what numpyBandFeatures returns, a note at a time,
+    doing the same float32 arithmetic in the same order.
+    """
+    numNotes = len(noteBands);
+    numFundamentals = len(funBands) // numNotes;
+    half = np.float32(0.5);
+    for i in range(len(deviations)):
+        row = deviations[i];
+        for j in range(numNotes):
+            peak, inx = _bandMax(row, noteBands[j]);
+
+            funPeak = row[0];
+            for k in range(numFundamentals):
+                f = k*numNotes + j;
+                if funResolved[f]:
+                    value = _bandMax(row, funBands[f])[0];
+                else:
+                    lower = funLower[f];
+                    value = row[lower] + funFraction[f]*(
+                            row[lower+1] - row[lower]);
+                if k == 0 or _greater(value, funPeak):
+                    funPeak = value;
+
+            features[i, j, 0] = peak;
+            features[i, j, 1] = peak - half*(row[inx+1] + row[inx-1]);
+            features[i, j, 2] = peak - funPeak;
+
+# The loop, once compileLoop has run: compiled, if numba is installed.
+# Importing numba and loading the compiled loop take about half a second,
+# which processes that never use the loop don't pay.
+_loop = None;
+
+def compileLoop():
+    """
+    Compiles the loop with numba, or loads it from numba's cache on disk,
+    unless that's been done.  Returns True if the loop is compiled, or
+    False if numba isn't installed, so the loop runs as plain Python.
+    """
+    global _loop, _greater, _bandMax;
+    if _loop is None:
+        try:
+            import numba;
+        except ImportError:
+            _loop = _bandFeaturesLoop;
+            return False;
+
+        # The helpers are compiled first, so that the loop calls the
+        # compiled versions
+        _greater = numba.njit(_greater);
+        _bandMax = numba.njit(_bandMax);
+        _loop = numba.njit(nogil=True, cache=True)(_bandFeaturesLoop);
+        # Compile for the types loopBandFeatures passes, with no frames
+        _loop(np.empty([0, 2], dtype=np.float32),
+                np.zeros([1, 1], dtype=np.int64),
+                np.zeros([1, 1], dtype=np.int64), np.zeros(1, dtype=bool),
+                np.zeros(1, dtype=np.int64), np.zeros(1, dtype=np.float32),
+                np.empty([0, 1, 3], dtype=np.float32));
+    return _loop is not _bandFeaturesLoop;
+
+def loopBandFeatures(deviations, table):
+    """
+    Computes what numpyBandFeatures does with a loop over every note of
+    every frame, compiled by numba (see compileLoop).  Without numba this
+    runs as plain Python, which is only fast enough to check results with.
+    The compiled loop doesn't check bounds, so the table is checked first
+    (see checkTable).
+    """
+    checkTable(table, deviations.shape[1]);
+    compileLoop();
+    lower = np.floor(table.funInx).astype(np.int64);
+    fraction = (table.funInx - lower).astype(np.float32);
+    features = np.empty([len(deviations), table.numNotes, 3],
+            dtype=np.float32);
+    _loop(np.ascontiguousarray(deviations, dtype=np.float32),
+            table.noteBands, table.funBands, table.funResolved, lower,
+            fraction, features);
+    return features;
+
+# The feature kernels, by name
+BACKENDS = { "numpy": numpyBandFeatures, "loop": loopBandFeatures };
+
+# The kernel bandFeatures uses
+_backend = "numpy";
+
+def setBackend(name):
+    """
+    Selects the kernel bandFeatures uses, by its name in BACKENDS.  The
+    loop is compiled now, rather than on the first frame, and needs numba:
+    as plain Python it's far slower than numpy.
+    """
+    global _backend;
+    if name not in BACKENDS:
+        raise Exception("No feature kernel " + str(name));
+    if name == "loop" and not compileLoop():
+        raise Exception("The loop kernel needs numba, which isn't installed");
+    _backend = name;
+
+def backend():
+    """The name of the kernel bandFeatures uses"""
+    return _backend;
+
+def bandFeatures(deviations, table):
+    """
+    Computes the feature vector of every note of every frame of a deviation
+    spectrogram, with the selected kernel (see numpyBandFeatures).
+    """
+    return BACKENDS[_backend](deviations, table);
+
+def checkParity(deviations, tables, maxFrames=None):
+    """
+    Checks that every kernel gives identical features for each of a list
+    of deviation spectrograms, with the table given for each.  maxFrames
+    limits the frames checked in each, for the uncompiled loop.  Returns
+    the indices of the spectrograms whose features differ.  Tables which
+    read outside their spectrograms raise IndexError (see checkTable),
+    since the kernels only agree on valid input.
+    """
+    differing = [];
+    for i in range(len(deviations)):
+        rows = deviations[i][:maxFrames];
+        checkTable(tables[i], rows.shape[1]);
+        results = [BACKENDS[name](rows, tables[i])
+                for name in sorted(BACKENDS)];
+        if not all(np.array_equal(results[0], result, equal_nan=True)
+                for result in results[1:]):
+            differing.append(i);
+    return differing;
+
+
+if __name__ == "__main__":
+    import time;
+    from audio import AudioFile;
+    from notes import bandTable, bandLimit;
+    from constantq import ConstantQ;
+    from testsets import allSets, setPath, c3freq, testNoteCount;
+
+    compiled = compileLoop();
+    maxFrames = None if compiled else 8;
+    framesize = 44100//8;
+    audioFiles = [];
+    for cls, indices, name in allSets:
+        audioFiles += [AudioFile(setPath(cls, i), framesize,
+                    maxFrequency=bandLimit(c3freq, testNoteCount))
+                for i in indices];
+
+    # Check the layouts of both FFT bands and constant-Q bins
+    fftTables = [bandTable(framesize, f.sampleRate, c3freq, testNoteCount)
+            for f in audioFiles];
+    cqKernels = [ConstantQ().kernel(framesize, f.sampleRate, f.numBins(),
+                c3freq, testNoteCount) for f in audioFiles];
+    for title, deviations, tables in (
+            ("FFT bands", [f.deviationSpectrogram() for f in audioFiles],
+                fftTables),
+            ("constant-Q", [kernel.transform(f.deviationSpectrogram())
+                    for f, kernel in zip(audioFiles, cqKernels)],
+                [kernel.table for kernel in cqKernels])):
+        differing = checkParity(deviations, tables, maxFrames);
+        print("{0}: {1} of {2} files differ".format(title, len(differing),
+                len(deviations)));
+
+        for name in sorted(BACKENDS):
+            start = time.time();
+            for rows, table in zip(deviations, tables):
+                BACKENDS[name](rows[:maxFrames], table);
+            print("  {0:6} {1:.4f}s".format(name, time.time() - start));
+
+    if not compiled:
+        print("numba isn't installed: the loop ran uncompiled, on {0} "
+                "frames of each file".format(maxFrames));
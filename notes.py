@@ -23,30 +23,131 @@
 import numpy as np;
 import math;
 from audio import *;
+from kernels import bandFeatures;
+import telemetry;
+
+def bandLimit(reference, numNotes):
+    """
+    The highest frequency read by a NoteSet with the given reference and
+    number of notes: a suitable maxFrequency for its AudioFile.
+    """
+    return reference*pow(2, float(numNotes)/12);
+
+def openAudio(filename, framesize, reference, numNotes, hop=None,
+        cache=None, spectrum=None):
+    """
+    Reads a wav file for a NoteSet with the given reference and number of
+    notes, keeping only the bins it reads.  spectrum selects how the
+    spectra are computed: None for full FFTs (an AudioFile), or a backend
+    with an open method like AudioFile's, such as sdft.SlidingDFT.
+    """
+    maxFrequency = bandLimit(reference, numNotes);
+    if spectrum is None:
+        return AudioFile(filename, framesize, hop, maxFrequency=maxFrequency,
+                cache=cache);
+    return spectrum.open(filename, framesize, hop, maxFrequency, cache);
+
+
+# Number of subharmonics compared against by relFundamental
+NUM_FUNDAMENTALS = 3;
+
+class ResolutionError(Exception):
+    """Raised when frames are too short to resolve the notes analysed"""
+
+# Version of the features computed by bandFeatures, part of their cache keys.
+# Increment this when changing how features are computed.
+FEATURE_VERSION = 1;
+
+class BandTable:
+    """
+    The FFT indices of the one-semitone bands around each note, and around
+    each note's subharmonics, laid out so that features for every note of
+    every frame can be gathered from a deviation spectrogram at once.
+    Use bandTable() to get a shared instance.
+    """
+
+    def __init__(self, framesize, sampleRate, reference, numNotes):
+        noteFreqs = np.array(
+                [reference*pow(2,float(i)/12) for i in range(numNotes)] );
+        self.numNotes = numNotes;
+
+        self.noteBands, resolved = self._bands(
+                noteFreqs, framesize, sampleRate);
+        if not np.all(resolved):
+            raise ResolutionError("Insufficient frequency resolution");
+
+        # Subharmonics are (NUM_FUNDAMENTALS x numNotes), flattened
+        funFreqs = np.concatenate(
+                [noteFreqs/(i+2) for i in range(NUM_FUNDAMENTALS)]);
+        self.funBands, self.funResolved = self._bands(
+                funFreqs, framesize, sampleRate);
+        # Fractional indices, used where a band is too narrow to resolve
+        self.funInx = funFreqs * framesize / sampleRate;
+
+    def _bands(self, freqs, framesize, sampleRate):
+        """
+        Returns a (len(freqs) x width) matrix of the FFT indices in the
+        band around each frequency, and a mask of the frequencies whose
+        band holds at least one index.  Narrower bands are padded with
+        their first index, which doesn't change their max or argmax.
+        Unresolvable bands hold only the index below the frequency.
+        """
+        lower = np.ceil(freqs/pow(2.0,1.0/24) * framesize / sampleRate);
+        upper = np.ceil(freqs*pow(2.0,1.0/24) * framesize / sampleRate);
+        lower = lower.astype(int);
+        widths = np.maximum(upper.astype(int) - lower, 1);
+
+        offsets = np.arange(np.max(widths));
+        bands = lower[:,np.newaxis] + np.where(
+                offsets < widths[:,np.newaxis], offsets, 0);
+        resolved = upper > lower;
+        bands[~resolved] = np.floor(
+                freqs[~resolved] * framesize / sampleRate)[:,np.newaxis];
+        return (bands, resolved);
+
+# BandTables shared between NoteSets, by (framesize, sampleRate, reference,
+# numNotes)
+_bandTables = {};
+
+def bandTable(framesize, sampleRate, reference, numNotes):
+    """Returns the BandTable for the given analysis parameters"""
+    key = (framesize, sampleRate, reference, numNotes);
+    if key not in _bandTables:
+        _bandTables[key] = BandTable(framesize, sampleRate, reference, numNotes);
+    return _bandTables[key];
 
 class NoteSet:
-    def __init__(self, audioFile, reference, numNotes):
+    def __init__(self, audioFile, reference, numNotes, frontEnd=None,
+            gate=None):
         """
         Create a set of not fundamental frequencies.  audioFile is the
-        AudioFile instance whose data will be analyzed.
+        AudioFile instance whose data will be analyzed (see openAudio).
         reference is the frequency of the bottommost reference note.
         noteCount is the number of semitones above the reference to
         be available for analysis.
+        frontEnd, if given, maps the spectrum to other bins before features
+        are found in them (see constantq.ConstantQ).
+        gate, if given, finds silent frames to skip (see gate.EnergyGate).
         """
         self.audioFile = audioFile;
         self.numNotes = numNotes;
+        self.frontEnd = frontEnd;
+        self.gate = gate;
 
+        self.reference = reference;
         self.noteFreqs = np.array(
                 [reference*pow(2,float(i)/12) for i in range(numNotes)] );
 
         # These are cached on first access
+        self.activeCache = None;
+        self.featureCache = None;
         self.memberCache = None;
         self.nonMemberCache = None;
 
-    def notePeak(self, frame, frequency):
+    def noteBand(self, frequency):
         """
-        Finds the peak deviation within a one-semitone band of
-        the given frequency, in the given FFT frame.
+        Returns the range of FFT indices within a one-semitone band of
+        the given frequency.
         """
         lowerInx = int(math.ceil(self.audioFile.indexOf(
                     frequency/pow(2.0,1.0/24))));
@@ -54,96 +155,170 @@ class NoteSet:
                     frequency*pow(2.0,1.0/24))));
 
         if(lowerInx == upperInx):
-            raise Exception("Insufficient frequency resolution");
+            raise ResolutionError("Insufficient frequency resolution");
 
-        return np.max([self.audioFile.deviation(frame,i)
-                for i in range(lowerInx, upperInx)]);
+        return (lowerInx, upperInx);
+
+    def notePeak(self, frame, frequency):
+        """
+        Finds the peak deviation within a one-semitone band of
+        the given frequency, in the given FFT frame.
+        """
+        lowerInx, upperInx = self.noteBand(frequency);
+        return np.max(self.audioFile.deviations(frame)[lowerInx:upperInx]);
 
     def notePeakInx(self, frame, frequency):
         """
         Finds the index of the peak deviation within a one-semitone band
         of the given frequency, in the given FFT frame
         """
-        lowerInx = int(math.ceil(self.audioFile.indexOf(
-                    frequency/pow(2.0,1.0/24))));
-        upperInx = int(math.ceil(self.audioFile.indexOf(
-                    frequency*pow(2.0,1.0/24))));
-
-        if(lowerInx == upperInx):
-            raise Exception("Insufficient frequency resolution");
+        lowerInx, upperInx = self.noteBand(frequency);
+        return lowerInx + int(np.argmax(
+                self.audioFile.deviations(frame)[lowerInx:upperInx]));
 
-        maxInx = lowerInx;
-        for i in range(lowerInx+1,upperInx):
-            if(self.audioFile.deviation(frame,i) >
-                    self.audioFile.deviation(frame, maxInx)):
-                maxInx = i;
-
-        return maxInx;
 
+    def detach(self):
+        """
+        Computes all features, then drops the AudioFile, keeping only compact
+        arrays (so the NoteSet is cheap to pickle, e.g. between processes).
+        Methods which need the spectrum itself, like notePeak, can't be
+        used on a detached NoteSet.
+        """
+        self.activeFrames();
+        self.featureTensor();
+        self.audioFile = None;
 
     def getNumFrames(self):
         """Convenience providing access to the AudioFile frame count"""
+        if self.audioFile is None:
+            return len(self.featureCache);
         return self.audioFile.numFrames();
 
     def getNumNotes(self):
         """Get the number of notes available for analysis."""
         return self.numNotes;
 
+    def bandTable(self):
+        """The BandTable describing this NoteSet's note bands"""
+        return bandTable(self.audioFile.framesize, self.audioFile.sampleRate,
+                self.reference, self.numNotes);
+
+    def activeFrames(self):
+        """
+        Returns an array of booleans, false for each frame which the gate
+        finds silent (all true if there's no gate).
+        """
+        if self.activeCache is None:
+            numFrames = self.getNumFrames();
+            if self.gate is None:
+                self.activeCache = np.ones(numFrames, dtype=bool);
+            else:
+                self.activeCache = self.gate.mask(
+                        self.audioFile.frameRms(0, numFrames));
+        return self.activeCache;
+
+    def featureTensor(self):
+        """
+        Returns the feature vectors of every note in every frame, as a
+        (frames x notes x featureLen()) float32 array.  This is computed on
+        first access, then cached, on disk too if the AudioFile has a cache.
+        Features aren't computed for silent frames (see activeFrames): they
+        are NaN.
+        """
+        if self.featureCache is not None:
+            return self.featureCache;
+
+        cache = self.audioFile.cache;
+        if cache is not None:
+            key = cache.key("features", FEATURE_VERSION,
+                    self.audioFile.cacheKey, self.reference, self.numNotes,
+                    self.frontEnd, self.gate);
+            arrays = cache.load(key);
+            if arrays is not None:
+                self.featureCache = arrays["features"];
+                return self.featureCache;
+
+        self.featureCache = self._computeFeatures();
+        if cache is not None:
+            cache.store(key, { "features": self.featureCache });
+        return self.featureCache;
+
+    @telemetry.timed("notes.features")
+    def _computeFeatures(self):
+        """
+        Computes the array featureTensor returns, a block of frames at a
+        time (on several threads, if the AudioFile's mapBlocks uses them).
+        """
+        active = self.activeFrames();
+        features = np.full(
+                [self.getNumFrames(), self.numNotes, self.featureLen()],
+                np.nan, dtype=np.float32);
+
+        def featuresOf(start, deviations):
+            # Returns the frames of a block which have features, and those
+            blockActive = active[start : start+len(deviations)];
+            if np.all(blockActive):
+                return (slice(start, start+len(deviations)),
+                        self.blockFeatures(deviations));
+            if np.any(blockActive):
+                return (start + np.flatnonzero(blockActive),
+                        self.blockFeatures(deviations[blockActive]));
+            return (slice(0, 0), features[0:0]);
+
+        for frames, blockFeatures in self.audioFile.mapBlocks(featuresOf,
+                active):
+            features[frames] = blockFeatures;
+        telemetry.count("notes.frames", len(features));
+        return features;
+
+    def blockFeatures(self, deviations):
+        """
+        Computes the features of every note for a block of rows of the
+        AudioFile's deviation spectrogram.
+        """
+        if self.frontEnd is None:
+            return bandFeatures(deviations, self.bandTable());
+
+        audioFile = self.audioFile;
+        kernel = self.frontEnd.kernel(audioFile.framesize,
+                audioFile.sampleRate, audioFile.numBins(), self.reference,
+                self.numNotes);
+        return kernel.features(deviations);
+
     def deviation(self, frame, note):
         """The deviation from the mean for a given note"""
-        return self.notePeak(frame, self.noteFreqs[note]);
+        return self.featureTensor()[frame, note, 0];
 
     def deviations(self, frame):
         """Convenience returning deviations for all notes"""
-        return np.array(
-                [self.notePeak(frame, i) for i in self.noteFreqs] );
+        return self.featureTensor()[frame, :, 0];
 
     def peakiness(self, frame, note):
         """
         Measure of how much of a peak is located within a given note band.
         This is just the second derivative at the peak
         """
-        peakInx = self.notePeakInx(frame, self.noteFreqs[note]);
-        left = self.audioFile.deviation(frame, peakInx-1);
-        center = self.audioFile.deviation(frame, peakInx);
-        right = self.audioFile.deviation(frame, peakInx+1);
-        return center - 0.5*(right + left);
+        return self.featureTensor()[frame, note, 1];
 
     def peakinesses(self, frame):
         """Convenience returning peakinesses for all notes"""
-        return np.array(
-                [self.peakiness(frame,i) for i in range(self.numNotes)]);
+        return self.featureTensor()[frame, :, 1];
 
     def relFundamental(self, frame, note):
         """
         How large is the note, relative to its fundamentals?
+        Where a fundamental's band is too narrow to resolve from the next,
+        the interpolated deviation at its frequency is used instead.
         """
-
-        numFuns = 3;
-        funMags = np.empty(numFuns);
-        for i in range(numFuns):
-            try:
-                funMags[i] = self.notePeak(frame, self.noteFreqs[note]/(i+2));
-            except Exception: # "Insufficient Frequency Resolution"
-                # We'll be less fussy about frequency resolution here and
-                # just go with it if we can't resolve this note's fundamental
-                # from the next
-                funMags[i] = self.audioFile.deviation(frame,
-                        self.audioFile.indexOf(self.noteFreqs[note]/(i+2)));
-
-        noteMag = self.notePeak(frame, self.noteFreqs[note]);
-
-        return noteMag - np.max(funMags);
+        return self.featureTensor()[frame, note, 2];
 
     def relFundamentals(self, frame):
         """Convenience returning fundamentalRels for all notes"""
-        return np.array(
-                [self.relFundamental(frame,i) for i in range(self.numNotes)]);
+        return self.featureTensor()[frame, :, 2];
 
     def feature(self, frame, note):
         """Returns a feature vector for a given note in a given frame"""
-        return np.array([ self.deviation(frame, note),
-                self.peakiness(frame, note), self.relFundamental(frame, note)]);
+        return self.featureTensor()[frame, note];
 
     def featureLen(self):
         """Returns the length of feature vectors given by feature()"""
@@ -163,36 +338,60 @@ class NoteSet:
         """
         return np.empty(0);
 
-    def memberFeatures(self):
+    def _gatherIndices(self, notesOf):
         """
-        Returns an array of all feature vectors which correspond to member notes.
+        Returns arrays of the frame and note indices of the notes listed by
+        notesOf(frame), for every frame which isn't silent.
+        """
+        frames = [];
+        notes = [];
+        for i in np.flatnonzero(self.activeFrames()).tolist():
+            frameNotes = notesOf(i);
+            frames += [i] * len(frameNotes);
+            notes += [int(j) for j in frameNotes];
+
+        return (np.array(frames, dtype=int), np.array(notes, dtype=int));
+
+    def _gatherFeatures(self, notesOf):
+        """
+        Returns an array of the feature vectors of the notes listed by
+        notesOf(frame), for every frame which isn't silent.
         """
-        if not self.memberCache is None:
-            return self.memberCache;
+        frames, notes = self._gatherIndices(notesOf);
+        return self.featureTensor()[frames, notes];
 
-        members = np.empty([0,self.featureLen()]);
-        for i in range(self.getNumFrames()):
-            if(len(self.memberNotes(i)) > 0):
-                members = np.concatenate( (members,
-                            [self.feature(i,j) for j in self.memberNotes(i)]) );
+    def memberIndices(self):
+        """
+        Returns the frame and note indices of the feature vectors given by
+        memberFeatures, as two arrays.
+        """
+        return self._gatherIndices(self.memberNotes);
+
+    def nonMemberIndices(self):
+        """
+        Returns the frame and note indices of the feature vectors given by
+        nonMemberFeatures, as two arrays.
+        """
+        return self._gatherIndices(self.nonMemberNotes);
 
-        self.memberCache = members;
-        return members;
+    @telemetry.timed("notes.memberFeatures")
+    def memberFeatures(self):
+        """
+        Returns an array of all feature vectors which correspond to member notes.
+        """
+        if self.memberCache is None:
+            self.memberCache = self._gatherFeatures(self.memberNotes);
+            telemetry.count("notes.memberVectors", len(self.memberCache));
+        return self.memberCache;
 
+    @telemetry.timed("notes.nonMemberFeatures")
     def nonMemberFeatures(self):
         """
         Returns an array of all feature vectors which do not correspond to
         member notes.
         """
-        if not self.nonMemberCache is None:
-            return self.nonMemberCache;
-
-        nonmem = np.empty([0,self.featureLen()]);
-        for i in range(self.getNumFrames()):
-            if(len(self.nonMemberNotes(i)) > 0):
-                nonmem = np.concatenate( (nonmem,
-                            [self.feature(i,j) for j in self.nonMemberNotes(i)]) );
-
-        self.nonMemberCache = nonmem;
-        return nonmem;
-
+        if self.nonMemberCache is None:
+            self.nonMemberCache = self._gatherFeatures(self.nonMemberNotes);
+            telemetry.count("notes.nonMemberVectors",
+                    len(self.nonMemberCache));
+        return self.nonMemberCache;
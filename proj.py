@@ -25,29 +25,11 @@ from audio import *;
 from notes import *;
 from testsets import *;
 from bayes import *;
+from cache import FeatureCache;
+from crossval import crossValidate, latexTable;
 
 framesize = 44100/8;
 
-# Read all data
-datasets = [
-    readNotes(range(0,25), framesize),
-    readMajors(range(0,25), framesize),
-    readOctaves(range(0,13), framesize),
-    readOctMajors(range(0,13), framesize),
-    readMajorMajors(range(0,13), framesize)
-    ];
-
-# Construct Naive Bayes classifiers for all datasets
-nbs = [NaiveBayes() for i in range(6)];
-# The single-dataset NBs:
-for i in range(5):
-    nbs[i].addLabelledData(datasets[i]);
-    nbs[i].learn();
-# The 'all' NB:
-for data in datasets:
-    nbs[5].addLabelledData(datasets[i]);
-nbs[5].learn();
-
 # Titles for all datasets:
 titles = [
     "Single Notes",
@@ -58,17 +40,16 @@ titles = [
     "All"
     ];
 
-# Print a lovely Latex table of results.
-table = "";
-for i in range(len(nbs)):
-    table += titles[i];
-    learn = nbs[i].learningAccuracy();
-    table += " & {0:.3}\\%".format(100.0*learn[0]/learn[1]);
-    table += " & {0:.3}\\%".format(100.0*learn[2]/learn[3]);
-    test = nbs[i].testingAccuracy();
-    table += " & {0:.3}\\%".format(100.0*test[0]/test[1]);
-    table += " & {0:.3}\\%".format(100.0*test[2]/test[3]);
-    table += " \\\\ \n\\hline\n";
+# Files are read in worker processes, which may import this module, so only
+# run the experiment when this is the main script.
+if __name__ == "__main__":
+    # Spectra and features are kept here between runs
+    cache = FeatureCache(".cache");
 
-print(table);
+    # Read all data
+    datasets = readAll(framesize, cache);
 
+    # Cross-validate Naive Bayes classifiers for each dataset, and for all
+    # of them together, and print a lovely Latex table of results.
+    results = crossValidate(datasets, folds=5, repeats=2);
+    print(latexTable(titles, results));
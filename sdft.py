@@ -0,0 +1,165 @@
+#!/usr/bin/python
+#
+#  sdft.py
+#
+#  Provides a sliding DFT spectral backend, which computes only the
+#  low-frequency bins needed for note analysis, updating them from one
+#  frame to the next rather than running a full FFT for every frame.
+#
+#  This program is distributed under the of the GNU Lesser Public License.
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+import numpy as np;
+import math;
+
+from audio import *;
+import telemetry;
+
+class SlidingDFTAudioFile(AudioFile):
+    """
+    An AudioFile whose spectra are computed with a sliding DFT: each bin
+    of a frame is derived from the same bin of the frame before, by
+    adding the samples which entered the frame and removing those which
+    left it.  This costs hop*numBins() operations per frame, rather than
+    a full FFT, so it's much cheaper for small hops when maxFrequency
+    limits the bins needed (as it should, for note analysis).
+
+    The deviations still need the mean and stdev of each frame's whole
+    spectrum, which the DFT bins can't provide.  The mean square of the
+    spectrum comes exactly from the frame's energy, but the mean doesn't:
+    a full FFT is run on every statsInterval'th frame (an anchor), a block
+    at a time, keeping only its low bins.  Each anchor's FFT also resets
+    the sliding bins, so rounding errors don't accumulate.
+
+    By default every frame is an anchor, so the statistics, and the
+    deviations, match AudioFile's exactly.  The bins then come straight
+    from the FFTs, and the cost is that of AudioFile, but only the low
+    bins are held.  A larger statsInterval slides the bins between anchors
+    and interpolates the ratio of mean to rms.  That is what makes the
+    sliding DFT cheaper, but it's only approximate: at note onsets, where
+    the shape of the spectrum changes between anchors, deviations can be
+    several units out.
+
+    fftFrames only holds bins below numBins().  Only rectangular windows
+    are supported.
+    """
+
+    def __init__(self, filename, framesize, hop=None, channel="left",
+            maxFrequency=None, statsInterval=1, cache=None):
+        """See AudioFile for the other arguments"""
+        self.statsInterval = statsInterval;
+        AudioFile.__init__(self, filename, framesize, hop, None, channel,
+                False, maxFrequency, cache);
+
+    def _spectraKey(self, channel, magnitudes):
+        """The cache key of the spectra, which differ from AudioFile's"""
+        return self.cache.key(AudioFile._spectraKey(self, channel, magnitudes),
+                "sliding", self.statsInterval);
+
+    @telemetry.timed("audio.fft")
+    def _fft(self, framesize, magnitudes=False):
+        """
+        Calculates the low bins of the DFT of each frame, and the
+        statistics of the full spectra.
+        """
+        numFrames = countFrames(len(self.wav), framesize, self.hop);
+        numBins = self.numBins();
+        frames = frameSignal(self.wav, framesize, self.hop);
+        self.fftFrames = np.empty([numFrames, numBins], dtype=np.complex64);
+        self.fftFreqs = np.arange(numBins) * (
+                float(self.sampleRate)/framesize);
+        telemetry.count("audio.frames", numFrames);
+
+        # Full FFTs of the anchor frames, a block at a time, keeping only
+        # their low bins
+        anchors = self._anchors(numFrames);
+        anchorMeans = np.empty(len(anchors));
+        anchorStDevs = np.empty(len(anchors));
+        for start in range(0, len(anchors), FFT_BLOCK):
+            block = anchors[start : start+FFT_BLOCK];
+            spectrum = rfft(frames[block], axis=1);
+            anchorMeans[start : start+len(block)], \
+                    anchorStDevs[start : start+len(block)] = spectrumStats(
+                            np.absolute(spectrum), framesize);
+            self.fftFrames[block] = spectrum[:, :numBins];
+        if len(anchors) == numFrames:
+            self.fftMeans = anchorMeans;
+            self.fftStDevs = anchorStDevs;
+            return;
+
+        # By Parseval's theorem, the mean square of each frame's spectrum is
+        # the energy of its samples, which is cheap to get exactly.  Only
+        # the ratio of the mean to the rms, which depends on the shape of
+        # the spectrum rather than its level, is interpolated.
+        squares = np.concatenate([[0], np.cumsum(np.square(self.wav))]);
+        starts = np.arange(numFrames) * self.hop;
+        rms = np.sqrt(np.maximum(
+                squares[starts + framesize] - squares[starts], 0));
+        with np.errstate(invalid="ignore", divide="ignore"):
+            ratios = np.nan_to_num(anchorMeans / rms[anchors]);
+        ratios = np.minimum(np.interp(np.arange(numFrames), anchors, ratios), 1);
+        self.fftMeans = ratios * rms;
+        self.fftStDevs = np.sqrt(1 - np.square(ratios)) * rms;
+
+        # Moving one hop along rotates each bin k by rotation[k]...
+        bins = np.arange(numBins);
+        rotation = np.exp(2j*math.pi*bins*self.hop/framesize);
+        # ...and adds the difference between each sample entering the
+        # frame and the one leaving, weighted by its (rotated) phase.
+        weights = np.exp(2j*math.pi*np.outer(self.hop - np.arange(self.hop),
+                bins)/framesize);
+        leaving = frameSignal(self.wav, self.hop, self.hop);
+        entering = frameSignal(self.wav[framesize:], self.hop, self.hop);
+
+        stops = np.append(anchors[1:], numFrames);
+        powers = np.power(rotation,
+                np.arange(np.max(stops - anchors))[:,np.newaxis]);
+        for start, stop in zip(anchors.tolist(), stops.tolist()):
+            anchor = self.fftFrames[start].astype(np.complex128);
+
+            # Frame start+n is the anchor rotated n times, plus each update
+            # rotated by the number of hops since it was added.
+            updates = np.dot(entering[start : stop-1] - leaving[start : stop-1],
+                    weights);
+            updates /= powers[1 : stop-start];
+            self.fftFrames[start+1 : stop] = powers[1 : stop-start] * (
+                    anchor + np.cumsum(updates, 0));
+
+    def _anchors(self, numFrames):
+        """The indices of the frames whose full FFTs are run"""
+        return np.arange(0, numFrames, self.statsInterval);
+
+
+class SlidingDFT:
+    """
+    Selects the sliding DFT as the spectrum of NoteSets (see
+    notes.openAudio), with the given statsInterval (see
+    SlidingDFTAudioFile).
+    """
+
+    def __init__(self, statsInterval=1):
+        if statsInterval < 1:
+            raise Exception("statsInterval must be at least 1");
+        self.statsInterval = int(statsInterval);
+
+    def __repr__(self):
+        return "SlidingDFT({0})".format(self.statsInterval);
+
+    def open(self, filename, framesize, hop=None, maxFrequency=None,
+            cache=None):
+        """Reads a wav file into a SlidingDFTAudioFile"""
+        return SlidingDFTAudioFile(filename, framesize, hop,
+                maxFrequency=maxFrequency, statsInterval=self.statsInterval,
+                cache=cache);
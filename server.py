@@ -0,0 +1,347 @@
+#!/usr/bin/python3
+#
+#  server.py
+#
+#  Provides transcription as a service: clients stream PCM audio over a
+#  socket, and are sent note-on/note-off events as notes are found.
+#
+#  This program is distributed under the of the GNU Lesser Public License.
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>
+#
+#  Protocol: the client sends one line of JSON describing its PCM data,
+#  e.g. {"sampleRate": 44100, "channels": 2, "sampleWidth": 2}, with
+#  optional "float": true and "channel": "left"/"right"/"mid", followed by
+#  the raw little-endian PCM data.  The server sends back lines of JSON:
+#      {"event": "on"/"off", "note": 12, "name": "c4", "frame": 40,
+#       "time": 1.25}
+#  as notes start and stop.  If the server gates silence,
+#      {"event": "silent"/"sound", "frame": 52, "time": 1.625}
+#  reports where silence starts and ends; notes stop during silence.
+#  If the server smooths decisions, events are sent some frames late.
+#  When the client closes its side,
+#      {"event": "end", "frames": 120, "latency": {...}}
+#  or {"event": "error", "message": "..."} if the session can't continue.
+
+import asyncio;
+import argparse;
+import concurrent.futures;
+import json;
+import logging;
+import time;
+import numpy as np;
+
+from stream import StreamAnalyser, pcmInfo, noteEvents;
+from gate import SILENT, EnergyGate;
+from hmm import NoteHmm, FixedLagDecoder;
+from testsets import noteName;
+
+log = logging.getLogger("transcriber");
+
+class LatencyStats:
+    """
+    Running statistics of the time between receiving a chunk of audio and
+    sending the events for the frames it completed.
+    """
+
+    def __init__(self):
+        self.count = 0;
+        self.total = 0.0;
+        self.max = 0.0;
+
+    def add(self, latency):
+        self.count += 1;
+        self.total += latency;
+        self.max = max(self.max, latency);
+
+    def summary(self):
+        """The statistics, in milliseconds, as a dict for reporting"""
+        mean = self.total / self.count if self.count > 0 else 0.0;
+        return { "batches": self.count, "meanMs": 1000*mean,
+                "maxMs": 1000*self.max };
+
+
+def noteMessage(frame, note, on, secondsPerFrame):
+    """The message reporting a note event (see stream.noteEvents)"""
+    return { "event": "on" if on else "off", "note": note,
+            "name": noteName(note), "frame": frame,
+            "time": frame*secondsPerFrame };
+
+def silenceMessage(frame, silent, secondsPerFrame):
+    """The message reporting that silence starts or ends at a frame"""
+    return { "event": "silent" if silent else "sound", "frame": frame,
+            "time": frame*secondsPerFrame };
+
+def write(writer, message):
+    """Writes a message to a client, as a line of JSON"""
+    writer.write((json.dumps(message) + "\n").encode("utf-8"));
+
+
+class TranscriptionServer:
+    """
+    Serves transcription sessions over TCP or a Unix socket.  All sessions
+    share one classifier, and the FFT and feature work for all sessions
+    runs on a shared pool of worker threads (numpy releases the GIL for it),
+    so the event loop only has to split chunks into frames.
+    """
+
+    def __init__(self, classifier, framesize, reference, numNotes, hop=None,
+            window=None, maxSessions=16, workers=None, queueSize=8,
+            chunkSize=8192, gate=None, hmm=None, lag=8):
+        """
+        classifier is a trained NaiveBayes.  See StreamAnalyser for the
+        analysis parameters, and the gate.  At most maxSessions clients are
+        served at once.  Each session may have queueSize batches of frames
+        waiting for analysis before reading from its client stops, which
+        pushes back on the client.  hmm, a NoteHmm, smooths each session's
+        decisions with a FixedLagDecoder, deciding each frame once lag more
+        frames have arrived.
+        """
+        self.classifier = classifier;
+        self.framesize = framesize;
+        self.reference = reference;
+        self.numNotes = numNotes;
+        self.hop = hop;
+        self.window = window;
+        self.maxSessions = maxSessions;
+        self.queueSize = queueSize;
+        self.chunkSize = chunkSize;
+        self.gate = gate;
+        self.hmm = hmm;
+        self.lag = lag;
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers);
+
+        self.activeSessions = 0;
+        self.nextSession = 0;
+        # Latency statistics of all finished sessions
+        self.latency = LatencyStats();
+
+    async def serve(self, host=None, port=None, path=None):
+        """
+        Serves clients forever, on a Unix socket if path is given, or
+        otherwise on a TCP port.
+        """
+        if path is not None:
+            server = await asyncio.start_unix_server(self.handle, path=path);
+        else:
+            server = await asyncio.start_server(self.handle, host, port);
+        async with server:
+            await server.serve_forever();
+
+    async def handle(self, reader, writer):
+        """Runs one client session"""
+        if self.activeSessions >= self.maxSessions:
+            await self._send(writer, { "event": "error",
+                    "message": "Too many sessions" });
+            writer.close();
+            return;
+
+        self.activeSessions += 1;
+        session = self.nextSession;
+        self.nextSession += 1;
+        try:
+            await self._session(session, reader, writer);
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            log.info("Session %d lost: %s", session, e);
+        except Exception as e:
+            log.exception("Session %d failed", session);
+            try:
+                await self._send(writer, { "event": "error",
+                        "message": str(e) });
+            except ConnectionError:
+                pass;
+        finally:
+            self.activeSessions -= 1;
+            writer.close();
+
+    async def _send(self, writer, message):
+        write(writer, message);
+        await writer.drain();
+
+    async def _put(self, queue, item, analysis):
+        """
+        Waits to put item on queue, unless the analysis task consuming it
+        finishes first (if it failed).
+        """
+        put = asyncio.ensure_future(queue.put(item));
+        await asyncio.wait([put, analysis],
+                return_when=asyncio.FIRST_COMPLETED);
+        if not put.done():
+            put.cancel();
+
+    async def _session(self, session, reader, writer):
+        header = json.loads((await reader.readline()).decode("utf-8"));
+        info = pcmInfo(int(header["sampleRate"]), int(header["channels"]),
+                int(header["sampleWidth"]), bool(header.get("float", False)));
+        decoder = None;
+        if self.hmm is not None:
+            decoder = FixedLagDecoder(self.hmm, self.numNotes, self.lag);
+        analyser = StreamAnalyser(info, self.framesize, self.reference,
+                self.numNotes, self.hop, self.window,
+                header.get("channel", "left"), self.classifier, self.gate,
+                decoder);
+        log.info("Session %d started: %s", session, header);
+
+        # Batches of frames, with the time their last chunk arrived
+        queue = asyncio.Queue(self.queueSize);
+        latency = LatencyStats();
+        analysis = asyncio.ensure_future(
+                self._analyse(analyser, queue, writer, latency));
+
+        try:
+            while True:
+                chunk = await reader.read(self.chunkSize);
+                if len(chunk) == 0:
+                    break;
+                received = time.monotonic();
+                frames = analyser.splitFrames(chunk);
+                if len(frames) > 0:
+                    await self._put(queue, (frames, received), analysis);
+                if analysis.done():
+                    break;
+            await self._put(queue, None, analysis);
+            frameCount = await analysis;
+        finally:
+            analysis.cancel();
+
+        self.latency.count += latency.count;
+        self.latency.total += latency.total;
+        self.latency.max = max(self.latency.max, latency.max);
+        log.info("Session %d ended after %d frames: %s", session, frameCount,
+                latency.summary());
+        await self._send(writer, { "event": "end", "frames": frameCount,
+                "latency": latency.summary() });
+
+    def _sendEvents(self, writer, results, previous, wasSilent,
+            secondsPerFrame):
+        """
+        Writes the note and silence events of the analyses of consecutive
+        frames (see StreamAnalyser.analyseFrames), given the decisions and
+        silence of the frame before.  Returns the decisions and silence of
+        the last frame, for the next results.
+        """
+        if len(results) == 0:
+            return (previous, wasSilent);
+        start = results[0][0];
+
+        # No notes sound in silent frames
+        silent = np.array([result[2] is SILENT for result in results]);
+        decisions = np.zeros((len(results), self.numNotes), dtype=bool);
+        for i in np.flatnonzero(~silent).tolist():
+            decisions[i] = results[i][2];
+
+        messages = [(frame, noteMessage(frame, note, on, secondsPerFrame))
+                for frame, note, on in noteEvents(decisions, previous, start)];
+        changes = np.diff(np.concatenate([[wasSilent], silent]).astype(
+                    np.int8));
+        messages += [(start + i, silenceMessage(start + i, silent[i],
+                    secondsPerFrame))
+                for i in np.flatnonzero(changes).tolist()];
+        messages.sort(key=lambda message: message[0]);
+
+        for frame, message in messages:
+            write(writer, message);
+        return (decisions[-1], bool(silent[-1]));
+
+    async def _analyse(self, analyser, queue, writer, latency):
+        """
+        Analyses the batches of frames in queue, until None, in the worker
+        pool, sending note and silence events to the client.  Returns the
+        frame count.
+        """
+        loop = asyncio.get_event_loop();
+        secondsPerFrame = float(analyser.hop) / analyser.info.sampleRate;
+        previous = None;
+        wasSilent = False;
+
+        while True:
+            batch = await queue.get();
+            if batch is None:
+                break;
+            frames, received = batch;
+
+            results = await loop.run_in_executor(self.executor,
+                    analyser.analyseFrames, frames);
+            previous, wasSilent = self._sendEvents(writer, results, previous,
+                    wasSilent, secondsPerFrame);
+            await writer.drain();
+            latency.add(time.monotonic() - received);
+
+        # Frames the decoder is still waiting for are decided now, and notes
+        # still sounding stop at the end of the stream
+        results = await loop.run_in_executor(self.executor, analyser.flush);
+        previous, wasSilent = self._sendEvents(writer, results, previous,
+                wasSilent, secondsPerFrame);
+        if previous is not None:
+            for frame, note, on in noteEvents(
+                    np.zeros((1, len(previous)), dtype=bool), previous,
+                    analyser.frameCount):
+                write(writer, noteMessage(frame, note, on, secondsPerFrame));
+        return analyser.frameCount;
+
+
+if __name__ == "__main__":
+    from testsets import trainClassifier, c3freq, testNoteCount;
+    from cache import FeatureCache;
+    import kernels;
+
+    parser = argparse.ArgumentParser(description="Serve note transcription");
+    parser.add_argument("--host", default="127.0.0.1");
+    parser.add_argument("--port", type=int, default=4422);
+    parser.add_argument("--unix", help="serve on this Unix socket instead");
+    parser.add_argument("--model",
+            help="serve a classifier saved by transcribe.py, rather than "
+                "training one");
+    parser.add_argument("--framesize", type=int, default=44100//8);
+    parser.add_argument("--hop", type=int, default=44100//32);
+    parser.add_argument("--max-sessions", type=int, default=16);
+    parser.add_argument("--workers", type=int, default=None);
+    parser.add_argument("--gate", type=float, default=None,
+            help="gate out frames below this level, in dB relative to the "
+                "loudest frame (e.g. -50)");
+    parser.add_argument("--smooth", type=float, nargs=2, default=None,
+            metavar=("ON", "OFF"), help="smooth decisions over time with a "
+                "NoteHmm, whose notes start and stop with these "
+                "probabilities per frame (e.g. 0.01 0.05)");
+    parser.add_argument("--lag", type=int, default=8,
+            help="with --smooth, the frames each decision waits for");
+    parser.add_argument("--kernel", choices=sorted(kernels.BACKENDS),
+            default="numpy", help="compute features with this kernel "
+                "(see kernels.py); loop, compiled by numba, is faster for "
+                "a few frames at a time");
+    args = parser.parse_args();
+    kernels.setBackend(args.kernel);
+
+    logging.basicConfig(level=logging.INFO);
+    if args.model is not None:
+        from transcribe import loadClassifier;
+        classifier, settings = loadClassifier(args.model);
+        if settings.get("binsPerSemitone") is not None:
+            raise Exception("Streams can't be analysed with a constant-Q "
+                    "front end");
+        framesize = settings["framesize"];
+        reference = settings["reference"];
+        numNotes = settings["numNotes"];
+    else:
+        classifier = trainClassifier(args.framesize, FeatureCache(".cache"));
+        framesize = args.framesize;
+        reference = c3freq;
+        numNotes = testNoteCount;
+    server = TranscriptionServer(classifier, framesize, reference,
+            numNotes, hop=args.hop, maxSessions=args.max_sessions,
+            workers=args.workers,
+            gate=None if args.gate is None else EnergyGate(args.gate),
+            hmm=None if args.smooth is None else NoteHmm(*args.smooth),
+            lag=args.lag);
+    asyncio.run(server.serve(args.host, args.port, args.unix));
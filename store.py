@@ -0,0 +1,219 @@
+#!/usr/bin/python
+#
+#  store.py
+#
+#  Provides a store of the labelled feature vectors of whole corpora, kept
+#  on disk as memory-mapped columns, for classifiers to learn and be tested
+#  from without holding NoteSets or copies of their features.
+#
+#  This program is distributed under the of the GNU Lesser Public License.
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+import os;
+import json;
+import numpy as np;
+
+# Atomically replaces one file with another (os.rename won't on Windows)
+_replace = getattr(os, "replace", os.rename);
+
+# The columns of a FeatureStore besides its features, and their types
+COLUMNS = [
+    ("labels", np.bool_),
+    ("datasets", np.int16),
+    ("files", np.int32),
+    ("frames", np.int32),
+    ("notes", np.int16) ];
+
+class FeatureStore:
+    """
+    The member and nonMember feature vectors of a number of named datasets
+    (lists of NoteSets), kept in a directory as one float32 feature matrix
+    and columns giving, for each row: whether it's a member (labels), the
+    index of its dataset, the index of its NoteSet among all the store's
+    NoteSets (files), and the frame and note it came from.
+    The rows of each dataset are contiguous, so a dataset's rows are a
+    view of the memory-mapped files, and only the pages used are read.
+    Datasets can be added at any time, without reading those already
+    stored.
+    """
+
+    def __init__(self, directory):
+        """Opens the store in directory, creating an empty one if needed"""
+        self.directory = directory;
+        if not os.path.isdir(directory):
+            os.makedirs(directory);
+
+        indexPath = os.path.join(directory, "index.json");
+        if os.path.exists(indexPath):
+            with open(indexPath, "r") as inFile:
+                self.index = json.load(inFile);
+        else:
+            self.index = { "featureLen": None, "numRows": 0, "numFiles": 0,
+                    "datasets": [] };
+        self._map();
+
+    def _path(self, column):
+        return os.path.join(self.directory, column + ".bin");
+
+    def _map(self):
+        """Maps the columns, read-only, as they are in the index"""
+        numRows = self.index["numRows"];
+        featureLen = self.index["featureLen"] or 0;
+        if numRows == 0:
+            # Empty files can't be mapped
+            self.features = np.empty([0, featureLen], dtype=np.float32);
+            for column, dtype in COLUMNS:
+                setattr(self, column, np.empty(0, dtype=dtype));
+            return;
+
+        self.features = np.memmap(self._path("features"), np.float32, "r",
+                shape=(numRows, featureLen));
+        for column, dtype in COLUMNS:
+            setattr(self, column, np.memmap(self._path(column), dtype, "r",
+                        shape=(numRows,)));
+
+    def numRows(self):
+        """The number of feature vectors stored"""
+        return self.index["numRows"];
+
+    def names(self):
+        """The names of the stored datasets, in the order they were added"""
+        return [dataset["name"] for dataset in self.index["datasets"]];
+
+    def add(self, name, noteSets):
+        """
+        Appends the member and nonMember features of each of a list of
+        NoteSets, as the dataset name.  Each NoteSet's rows are written as
+        they're found, so only one NoteSet's are held at once.
+        """
+        if name in self.names():
+            raise Exception("The store already has a dataset " + name);
+        featureLen = noteSets[0].featureLen();
+        if self.index["featureLen"] not in (None, featureLen):
+            raise Exception("Features don't match those in the store");
+
+        # Whatever is past numRows is left by an interrupted add: drop it
+        numRows = self.index["numRows"];
+        files = dict((column, open(self._path(column), "ab"))
+                for column in ["features"] + [c for c, t in COLUMNS]);
+        try:
+            for column, outFile in files.items():
+                itemSize = (np.dtype(np.float32).itemsize * featureLen
+                        if column == "features" else
+                        np.dtype(dict(COLUMNS)[column]).itemsize);
+                outFile.truncate(numRows * itemSize);
+
+            datasetIndex = len(self.index["datasets"]);
+            fileIndex = self.index["numFiles"];
+            for noteSet in noteSets:
+                for isMember in (True, False):
+                    if isMember:
+                        frames, notes = noteSet.memberIndices();
+                    else:
+                        frames, notes = noteSet.nonMemberIndices();
+                    count = len(frames);
+                    noteSet.featureTensor()[frames, notes].astype(
+                            np.float32).tofile(files["features"]);
+                    for column, values in (
+                            ("labels", np.full(count, isMember)),
+                            ("datasets", np.full(count, datasetIndex)),
+                            ("files", np.full(count, fileIndex)),
+                            ("frames", frames),
+                            ("notes", notes)):
+                        values.astype(dict(COLUMNS)[column]).tofile(
+                                files[column]);
+                    numRows += count;
+                fileIndex += 1;
+        finally:
+            for outFile in files.values():
+                outFile.close();
+
+        self.index["datasets"].append({ "name": name,
+                "start": self.index["numRows"], "stop": numRows });
+        self.index["featureLen"] = featureLen;
+        self.index["numRows"] = numRows;
+        self.index["numFiles"] = fileIndex;
+        self._writeIndex();
+        self._map();
+
+    def _writeIndex(self):
+        """Replaces the index, atomically, so it always matches the columns"""
+        path = os.path.join(self.directory, "index.json");
+        with open(path + ".tmp", "w") as outFile:
+            json.dump(self.index, outFile);
+        _replace(path + ".tmp", path);
+
+    def rows(self, names=None):
+        """
+        Returns the rows of the named datasets (by default, all of them):
+        a slice if they're contiguous, or otherwise an array of row indices.
+        names may also be a single name.
+        """
+        if names is None:
+            return slice(0, self.numRows());
+        if isinstance(names, str):
+            names = [names];
+
+        ranges = [];
+        for name in names:
+            if name not in self.names():
+                raise Exception("The store has no dataset " + name);
+            dataset = self.index["datasets"][self.names().index(name)];
+            ranges.append((dataset["start"], dataset["stop"]));
+        ranges.sort();
+
+        if all(ranges[i][1] == ranges[i+1][0] for i in range(len(ranges)-1)):
+            return slice(ranges[0][0], ranges[-1][1]);
+        return np.concatenate([np.arange(start, stop)
+                for start, stop in ranges]);
+
+    def memberRows(self, names=None):
+        """
+        Returns arrays of the indices of the member rows, and of the
+        nonMember rows, of the named datasets (see rows).
+        """
+        rows = self.rows(names);
+        if isinstance(rows, slice):
+            labels = self.labels[rows];
+            members = rows.start + np.flatnonzero(labels);
+            nonMembers = rows.start + np.flatnonzero(~labels);
+        else:
+            labels = self.labels[rows];
+            members = rows[labels];
+            nonMembers = rows[~labels];
+        return (members, nonMembers);
+
+    def fit(self, nb, names=None, chunkRows=2**16):
+        """
+        Adds the rows of the named datasets (see rows) to what the
+        NaiveBayes nb has learnt, chunkRows at a time (see
+        NaiveBayes.partialFit), so memory use doesn't depend on the size
+        of the store.  Returns nb.
+        """
+        rows = self.rows(names);
+        if not isinstance(rows, slice):
+            for start in range(0, len(rows), chunkRows):
+                chunk = rows[start : start+chunkRows];
+                labels = self.labels[chunk];
+                features = self.features[chunk];
+                nb.partialFit(features[labels], features[~labels]);
+            return nb;
+
+        for start in range(rows.start, rows.stop, chunkRows):
+            stop = min(start + chunkRows, rows.stop);
+            labels = np.asarray(self.labels[start:stop]);
+            features = self.features[start:stop];
+            nb.partialFit(features[labels], features[~labels]);
+        return nb;
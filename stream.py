@@ -0,0 +1,315 @@
+#!/usr/bin/python
+#
+#  stream.py
+#
+#  Provides note analysis of audio arriving as a stream of raw PCM data,
+#  such as from a pipe, without first storing it in a file.
+#
+#  This program is distributed under the of the GNU Lesser Public License.
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+import sys;
+import math;
+import numpy as np;
+
+from audio import *;
+from notes import bandTable, bandFeatures, bandLimit;
+from gate import SILENT;
+
+def pcmInfo(sampleRate, numChannels, sampleWidth, floating=False):
+    """
+    Returns a WavInfo describing headerless PCM data with the given layout.
+    sampleWidth is in bytes.
+    """
+    formatTag = WAVE_FORMAT_IEEE_FLOAT if floating else WAVE_FORMAT_PCM;
+    return WavInfo(formatTag, numChannels, sampleRate, sampleWidth, 0, None);
+
+
+class StreamAnalyser:
+    """
+    Splits PCM data, fed in chunks of any size, into frames, and analyses
+    each frame as soon as it's complete.  Only the samples of one frame
+    and one hop are kept between chunks, so memory use is constant.
+    """
+
+    def __init__(self, info, framesize, reference, numNotes, hop=None,
+            window=None, channel="left", classifier=None, gate=None,
+            decoder=None):
+        """
+        info is a WavInfo describing the PCM data.  See AudioFile for the
+        analysis parameters, and NoteSet for reference and numNotes.
+        If a trained NaiveBayes classifier is given, frames are classified.
+        If a gate (see gate.EnergyGate) is given, silent frames are skipped.
+        If a decoder (see hmm.FixedLagDecoder) is given, the classifier's
+        log-likelihood ratios are smoothed by it, and each frame's
+        decisions are only returned once the decoder has decided them (see
+        analyseFrames).
+        """
+        self.info = info;
+        self.framesize = int(framesize);
+        self.hop = self.framesize if hop is None else int(hop);
+        if self.hop > self.framesize:
+            raise Exception("Streams can't be analysed with gaps between frames");
+        self.window = window;
+        self.channel = channel;
+        self.classifier = classifier;
+        self.gate = gate;
+        self.decoder = decoder;
+        if decoder is not None and classifier is None:
+            raise Exception("Decisions can't be smoothed without a classifier");
+
+        self.table = bandTable(self.framesize, info.sampleRate, reference,
+                numNotes);
+        self.numBins = min(self.framesize // 2 + 1, int(math.ceil(
+                    bandLimit(reference, numNotes) * self.framesize /
+                    info.sampleRate)) + 2);
+
+        # Samples not yet consumed by a frame, and bytes of an incomplete
+        # sample frame left at the end of the last chunk
+        self._buffer = np.empty(self.framesize + self.hop);
+        self._fill = 0;
+        self._partial = b"";
+
+        # Number of frames analysed so far
+        self.frameCount = 0;
+        # The gate's state, and the loudest frame so far
+        self._active = False;
+        self._loudest = 0.0;
+        # Analyses of the frames the decoder hasn't decided yet
+        self._undecided = [];
+
+    def feed(self, chunk):
+        """
+        Adds a chunk of raw PCM data, returning the analyses of all the
+        frames it completes (see analyseFrames).
+        """
+        results = [];
+        frames = self.splitFrames(chunk);
+        for start in range(0, len(frames), FFT_BLOCK):
+            results += self.analyseFrames(frames[start : start+FFT_BLOCK]);
+        return results;
+
+    def splitFrames(self, chunk):
+        """
+        Adds a chunk of raw PCM data, returning a list of the frames of
+        samples it completes, ready for analyseFrames.
+        """
+        data = self._partial + chunk;
+        usable = len(data) - len(data) % self.info.frameWidth();
+        self._partial = data[usable:];
+        samples = decodeSamples(data[:usable], self.info, self.channel);
+
+        frames = [];
+        pos = 0;
+        while pos < len(samples):
+            count = min(len(self._buffer) - self._fill, len(samples) - pos);
+            self._buffer[self._fill : self._fill+count] = \
+                    samples[pos : pos+count];
+            self._fill += count;
+            pos += count;
+
+            while self._fill >= self.framesize:
+                frames.append(self._buffer[:self.framesize].copy());
+                self._buffer[:self._fill-self.hop] = \
+                        self._buffer[self.hop:self._fill];
+                self._fill -= self.hop;
+
+        return frames;
+
+    def analyseFrames(self, frames):
+        """
+        Analyses a list of consecutive frames of samples, returning a list
+        of (frame index, features, decisions) for each.  Frames must be
+        analysed in order, one list at a time.  features is a
+        (numNotes x 3) array, as NoteSet.featureTensor gives for a frame;
+        decisions is an array of numNotes booleans, true for each note
+        the classifier finds, or None if there's no classifier.  Frames
+        the gate finds silent aren't analysed further: their features are
+        None, and their decisions are SILENT.
+        With a decoder, decisions are its smoothed states, and the list
+        holds the frames decided so far, in order, which lag behind the
+        frames given; flush returns the rest at the end of the stream.
+        """
+        # Laid end to end, the frames can be transformed in one batch
+        mags, means, stDevs = stft(np.concatenate(frames), self.framesize,
+                self.framesize, self.window, True);
+
+        active = np.ones(len(frames), dtype=bool);
+        if self.gate is not None:
+            rms = rmsOf(means, stDevs, self.framesize);
+            self._loudest = max(self._loudest, np.max(rms));
+            active = self.gate.mask(rms, self._loudest, self._active);
+            self._active = bool(active[-1]);
+        analysed = np.flatnonzero(active);
+
+        features = [None] * len(frames);
+        decisions = [SILENT] * len(frames);
+        if len(analysed) > 0:
+            found = bandFeatures(deviationsOf(mags[analysed, :self.numBins],
+                    means[analysed], stDevs[analysed]), self.table);
+            foundDecisions = [None] * len(analysed);
+            if self.decoder is not None:
+                foundDecisions = self.classifier.logLikelihoodRatio(
+                        found.reshape((-1, found.shape[2])));
+                foundDecisions = foundDecisions.reshape(found.shape[:2]);
+            elif self.classifier is not None:
+                foundDecisions = self.classifier.predict(
+                        found.reshape((-1, found.shape[2])));
+                foundDecisions = foundDecisions.reshape(found.shape[:2]);
+            for i, frame in enumerate(analysed.tolist()):
+                features[frame] = found[i];
+                decisions[frame] = foundDecisions[i];
+
+        start = self.frameCount;
+        self.frameCount += len(frames);
+        results = [(start + i, features[i], decisions[i])
+                for i in range(len(frames))];
+        if self.decoder is None:
+            return results;
+
+        # Silent frames have no evidence for any note
+        ratios = np.full((len(frames), self.table.numNotes), np.nan);
+        for i in analysed.tolist():
+            ratios[i] = decisions[i];
+        self._undecided += results;
+        return self._decided(self.decoder.push(ratios)[1]);
+
+    def flush(self):
+        """
+        Returns the analyses of the frames the decoder hasn't decided yet,
+        deciding them, at the end of the stream.  Without a decoder, every
+        frame is returned by analyseFrames, and this returns none.
+        """
+        if self.decoder is None:
+            return [];
+        return self._decided(self.decoder.flush()[1]);
+
+    def _decided(self, states):
+        """
+        Removes the analyses of the oldest undecided frames, one per row of
+        the decoder's states, returning them with those states as their
+        decisions.  Silent frames stay SILENT.
+        """
+        results = self._undecided[:len(states)];
+        self._undecided = self._undecided[len(states):];
+        return [(frame, features, SILENT if decisions is SILENT else
+                    states[i])
+                for i, (frame, features, decisions) in enumerate(results)];
+
+
+def noteEvents(activations, previous=None, start=0):
+    """
+    Finds where notes start and stop sounding in a (frames x notes) array
+    of booleans, such as the decisions for consecutive frames.  previous
+    holds the activations of the frame before, if any; frames are numbered
+    from start.  Returns a list of (frame, note, on) ordered by frame, where
+    on is True for a note-on event and False for a note-off event.
+    """
+    activations = np.asarray(activations, dtype=bool);
+    if previous is None:
+        previous = np.zeros(activations.shape[1], dtype=bool);
+
+    changes = np.diff(np.vstack([previous, activations]).astype(np.int8),
+            axis=0);
+    frames, notes = np.nonzero(changes);
+    return [(start + frame, note, bool(changes[frame, note] > 0))
+            for frame, note in zip(frames.tolist(), notes.tolist())];
+
+def readChunks(inFile, chunkSize=4096, limit=None):
+    """
+    Generates chunks of data from inFile as they become available, up to
+    chunkSize bytes each, until the end of the file or limit bytes.
+    """
+    # read1 returns what's available, rather than waiting for a full chunk
+    read = getattr(inFile, "read1", inFile.read);
+    while limit is None or limit > 0:
+        size = chunkSize if limit is None else min(chunkSize, limit);
+        chunk = read(size);
+        if len(chunk) == 0:
+            return;
+        if limit is not None:
+            limit -= len(chunk);
+        yield chunk;
+
+def analyseStream(inFile, framesize, reference, numNotes, info=None,
+        chunkSize=4096, **kwargs):
+    """
+    Generates analyses (see StreamAnalyser.analyseFrames) of the frames of
+    PCM data read from inFile, which may be a pipe.  Unless info (a WavInfo)
+    describes headerless data, inFile must start with a wav header.
+    Other arguments are passed to StreamAnalyser.
+    """
+    limit = None;
+    if info is None:
+        info = readWavHeader(inFile);
+        # Streamed wav files often don't know their length
+        if info.dataSize not in (0, 0xFFFFFFFF):
+            limit = info.dataSize;
+
+    analyser = StreamAnalyser(info, framesize, reference, numNotes, **kwargs);
+    for chunk in readChunks(inFile, chunkSize, limit):
+        for result in analyser.feed(chunk):
+            yield result;
+    for result in analyser.flush():
+        yield result;
+
+
+if __name__ == "__main__":
+    # Print the notes found in a wav file, or stdin, as they're found
+    import argparse;
+    from testsets import trainClassifier, noteName, c3freq, testNoteCount;
+    from cache import FeatureCache;
+    from gate import EnergyGate;
+    from hmm import NoteHmm, FixedLagDecoder;
+    import kernels;
+
+    parser = argparse.ArgumentParser(
+            description="Print the notes found in a wav stream");
+    parser.add_argument("file", nargs="?", default="-",
+            help="the wav file to read (by default, stdin)");
+    parser.add_argument("--smooth", type=float, nargs=2, default=None,
+            metavar=("ON", "OFF"), help="smooth decisions over time with a "
+                "NoteHmm, whose notes start and stop with these "
+                "probabilities per frame (e.g. 0.01 0.05)");
+    parser.add_argument("--lag", type=int, default=8,
+            help="with --smooth, the frames each decision waits for");
+    parser.add_argument("--kernel", choices=sorted(kernels.BACKENDS),
+            default="numpy", help="compute features with this kernel "
+                "(see kernels.py); loop, compiled by numba, is faster for "
+                "a few frames at a time");
+    args = parser.parse_args();
+    kernels.setBackend(args.kernel);
+
+    framesize = 44100//8;
+    classifier = trainClassifier(framesize, FeatureCache(".cache"));
+    decoder = None;
+    if args.smooth is not None:
+        decoder = FixedLagDecoder(NoteHmm(*args.smooth), testNoteCount,
+                args.lag);
+
+    if args.file == "-":
+        inFile = getattr(sys.stdin, "buffer", sys.stdin);
+    else:
+        inFile = open(args.file, "rb");
+
+    for frame, features, decisions in analyseStream(inFile, framesize,
+            c3freq, testNoteCount, hop=framesize//4, classifier=classifier,
+            gate=EnergyGate(), decoder=decoder):
+        if decisions is SILENT:
+            print("{0}: {1}".format(frame, SILENT));
+        else:
+            print("{0}: {1}".format(frame,
+                    " ".join(noteName(i) for i in np.flatnonzero(decisions))));
+        sys.stdout.flush();
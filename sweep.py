@@ -0,0 +1,253 @@
+#!/usr/bin/python
+#
+#  sweep.py
+#
+#  Compares analysis parameters (framesize, hop, window, number of notes,
+#  reference frequency, front end) by cross-validating a classifier on the
+#  test sets with each combination, decoding the test set files only once.
+#
+#  This program is distributed under the of the GNU Lesser Public License.
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+import os;
+import time;
+import shutil;
+import tempfile;
+import itertools;
+import multiprocessing;
+from sys import stdout;
+import numpy as np;
+
+from audio import readWavHeader, decodeSamples, SampleAudioFile;
+from notes import bandLimit, ResolutionError;
+from testsets import allSets, setPath, c3freq, testNoteCount;
+from constantq import ConstantQ;
+from crossval import crossValidate;
+
+# Analysis parameters used where a sweep's settings don't give them.
+# numNotes must cover every note in the test sets.  binsPerSemitone
+# selects a ConstantQ front end, rather than FFT bands.
+DEFAULTS = { "framesize": 44100//8, "hop": None, "window": None,
+        "numNotes": testNoteCount, "reference": c3freq,
+        "binsPerSemitone": None };
+
+# Samples mapped by this process, by path
+_mapped = {};
+
+def _open(path):
+    """Maps the samples saved by decodeAll, read-only"""
+    if path not in _mapped:
+        _mapped[path] = np.load(path, mmap_mode="r");
+    return _mapped[path];
+
+def decodeAll(directory, channel="left"):
+    """
+    Decodes every test set file once, saving all of their samples (of the
+    given channel) end to end in a .npy file in directory.  Returns the
+    path of that file, and a dict giving the (start, stop, sampleRate) of
+    each wav file's samples in it.
+    """
+    samples = [];
+    index = {};
+    start = 0;
+    for cls, indices, name in allSets:
+        for i in indices:
+            filename = setPath(cls, i);
+            inFile = open(filename, "rb");
+            try:
+                info = readWavHeader(inFile);
+                wav = decodeSamples(inFile.read(info.dataSize), info, channel);
+            finally:
+                inFile.close();
+            samples.append(wav);
+            index[filename] = (start, start + len(wav), info.sampleRate);
+            start += len(wav);
+
+    path = os.path.join(directory, "samples.npy");
+    np.save(path, np.concatenate(samples));
+    return (path, index);
+
+def grid(**options):
+    """
+    Returns a settings dict for each combination of the given lists of
+    values, e.g. grid(framesize=[2048, 4096], window=[None, "hann"]).
+    """
+    names = sorted(options);
+    return [dict(zip(names, values))
+            for values in itertools.product(*[options[name]
+                for name in names])];
+
+def _evaluate(job):
+    """
+    Cross-validates a classifier for one set of analysis settings, in a
+    worker process, timing each stage.  Returns a row of sweep's results.
+    """
+    samplesPath, index, settings, folds, seed = job;
+    result = dict(DEFAULTS);
+    result.update(settings);
+    try:
+        _stages(result, _open(samplesPath), index, folds, seed);
+    except ResolutionError as e:
+        # Settings with too small a framesize to resolve the notes are
+        # reported rather than ending the sweep; anything else is a bug
+        result["error"] = str(e);
+    return result;
+
+def _stages(result, samples, index, folds, seed):
+    """Runs the stages of _evaluate, adding their results to result"""
+    framesize = result["framesize"];
+    reference = result["reference"];
+    numNotes = result["numNotes"];
+    frontEnd = None;
+    if result["binsPerSemitone"] is not None:
+        frontEnd = ConstantQ(result["binsPerSemitone"]);
+
+    stftTime = 0.0;
+    featureTime = 0.0;
+    datasets = [];
+    for cls, indices, name in allSets:
+        noteSets = [];
+        for i in indices:
+            start, stop, sampleRate = index[setPath(cls, i)];
+            began = time.time();
+            audioFile = SampleAudioFile(samples[start:stop], sampleRate,
+                    framesize, result["hop"], result["window"],
+                    maxFrequency=bandLimit(reference, numNotes));
+            stftTime += time.time() - began;
+
+            began = time.time();
+            noteSet = cls(i, framesize, reference, numNotes,
+                    frontEnd=frontEnd, audioFile=audioFile);
+            noteSet.memberFeatures();
+            noteSet.nonMemberFeatures();
+            noteSet.detach();
+            featureTime += time.time() - began;
+            noteSets.append(noteSet);
+        datasets.append(noteSets);
+
+    began = time.time();
+    accuracy = crossValidate(datasets, folds, 1, seed, processes=1)[-1];
+    result["classifyTime"] = time.time() - began;
+    result["stftTime"] = stftTime;
+    result["featureTime"] = featureTime;
+
+    means = np.mean(accuracy, 0);
+    stDevs = np.std(accuracy, 0);
+    result["members"] = means[2];
+    result["membersStDev"] = stDevs[2];
+    result["nonMembers"] = means[3];
+    result["nonMembersStDev"] = stDevs[3];
+
+def sweep(settings, folds=5, seed=0, processes=None):
+    """
+    Cross-validates a classifier on all of the test sets together (see
+    crossval.crossValidate) for each of a list of dicts of analysis
+    settings (see DEFAULTS, and grid).  The test set files are decoded
+    once, to a temporary file which every worker process maps, and
+    settings are tried in a pool of processes (by default, one per core),
+    or in this process if processes=1.  Returns a list of dicts, one per
+    settings: the settings, the fraction of testing members and
+    nonMembers classified correctly (mean and stdev over folds), and the
+    time taken for the STFTs, features and classification; or, if the
+    frames were too short to resolve the notes, an "error".  Any other
+    exception ends the sweep.  Also returns the time taken to decode the
+    files.
+    """
+    directory = tempfile.mkdtemp(prefix="sweep");
+    pool = None;
+    try:
+        began = time.time();
+        samplesPath, index = decodeAll(directory);
+        decodeTime = time.time() - began;
+
+        jobs = [(samplesPath, index, dict(item), folds, seed)
+                for item in settings];
+        if processes == 1:
+            results = (_evaluate(job) for job in jobs);
+        else:
+            pool = multiprocessing.Pool(processes);
+            results = pool.imap(_evaluate, jobs);
+
+        ret = [];
+        for result in results:
+            ret.append(result);
+            stdout.write("\r{0}/{1}".format(len(ret), len(jobs)));
+            stdout.flush();
+        stdout.write("\n");
+    finally:
+        if pool is not None:
+            pool.close();
+            pool.join();
+        _mapped.pop(os.path.join(directory, "samples.npy"), None);
+        shutil.rmtree(directory, ignore_errors=True);
+
+    return (ret, decodeTime);
+
+def formatTable(results):
+    """Returns sweep's results as a table of text, best first"""
+    columns = ["framesize", "hop", "window", "numNotes", "reference",
+            "binsPerSemitone"];
+    row = "{0:>9} {1:>6} {2:>8} {3:>5} {4:>9} {5:>4} ";
+    lines = [(row + "{6:>15} {7:>15} {8:>7} {9:>7} {10:>7}").format(
+            "framesize", "hop", "window", "notes", "reference", "cq",
+            "members", "nonMembers", "stft s", "feat s", "class s")];
+
+    ordered = sorted(results, key=lambda result:
+            -(result["members"] + result["nonMembers"])
+            if "error" not in result else 0);
+    for result in ordered:
+        values = [str(result[column]) for column in columns];
+        if "error" in result:
+            lines.append((row + "{6}").format(*(values + [result["error"]])));
+            continue;
+        lines.append((row + "{6:>8.2%} +/-{7:4.1%} {8:>7.2%} +/-{9:4.1%} "
+                "{10:>7.2f} {11:>7.2f} {12:>7.2f}").format(*(values + [
+                    result["members"], result["membersStDev"],
+                    result["nonMembers"], result["nonMembersStDev"],
+                    result["stftTime"], result["featureTime"],
+                    result["classifyTime"]])));
+    return "\n".join(lines);
+
+if __name__ == "__main__":
+    import argparse;
+
+    parser = argparse.ArgumentParser(
+            description="Compare analysis parameters on the test sets");
+    parser.add_argument("--framesize", type=int, nargs="+",
+            default=[DEFAULTS["framesize"]]);
+    parser.add_argument("--overlap", type=int, nargs="+", default=[1],
+            help="frames per framesize: the hop is framesize/overlap");
+    parser.add_argument("--window", nargs="+", default=["rect"]);
+    parser.add_argument("--notes", type=int, nargs="+",
+            default=[DEFAULTS["numNotes"]]);
+    parser.add_argument("--reference", type=float, nargs="+",
+            default=[DEFAULTS["reference"]]);
+    parser.add_argument("--cq", type=int, nargs="+", default=[0],
+            help="constant-Q bins per semitone, or 0 for FFT bands");
+    parser.add_argument("--folds", type=int, default=5);
+    parser.add_argument("--processes", type=int, default=None);
+    args = parser.parse_args();
+
+    settings = grid(framesize=args.framesize, overlap=args.overlap,
+            window=args.window, numNotes=args.notes,
+            reference=args.reference, binsPerSemitone=args.cq);
+    for item in settings:
+        item["hop"] = item["framesize"] // item.pop("overlap");
+        item["binsPerSemitone"] = item["binsPerSemitone"] or None;
+
+    results, decodeTime = sweep(settings, args.folds,
+            processes=args.processes);
+    print("Decoded the test sets in {0:.2f}s".format(decodeTime));
+    print(formatTable(results));
@@ -0,0 +1,226 @@
+#!/usr/bin/python
+#
+#  telemetry.py
+#
+#  Provides timers and counters around the stages of the analysis pipeline
+#  (decoding, spectra, features, learning and classification), reported to
+#  pluggable sinks, to find where the time of a slow job goes.  With no
+#  sinks added, the instrumented code pays one check per call.
+#
+#  This program is distributed under the of the GNU Lesser Public License.
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+import os;
+import json;
+import time;
+import threading;
+
+try:
+    import tracemalloc;
+except ImportError:
+    # Python 2: memory isn't traced
+    tracemalloc = None;
+
+# The sinks every event is sent to; while it's empty, nothing is measured
+_sinks = [];
+
+# Each thread's timed calls in progress while memory is traced, innermost
+# last, as [bytes traced at the start, greatest peak of the calls within]
+_traced = threading.local();
+
+def addSink(sink):
+    """
+    Sends every following event to sink, an object with an event(dict)
+    method, such as a Registry or a JsonLinesSink.  Returns sink.
+    """
+    _sinks.append(sink);
+    return sink;
+
+def removeSink(sink):
+    """Stops sending events to sink"""
+    if sink in _sinks:
+        _sinks.remove(sink);
+
+def enabled():
+    """True if events are being measured, i.e. there are sinks"""
+    return len(_sinks) > 0;
+
+def _emit(event):
+    event["time"] = time.time();
+    event["pid"] = os.getpid();
+    for sink in list(_sinks):
+        sink.event(event);
+
+def timed(name):
+    """
+    A decorator timing each call of a function as a "timer" event called
+    name.  Calls which raise aren't reported.  When memory is being traced
+    (see traceMemory), the event also has the bytes allocated during the
+    call, and their peak.
+    """
+    def decorate(function):
+        def wrapper(*args, **kwargs):
+            if not _sinks:
+                return function(*args, **kwargs);
+
+            tracing = tracemalloc is not None and tracemalloc.is_tracing();
+            if tracing:
+                calls = _traced.__dict__.setdefault("calls", []);
+                calls.append([tracemalloc.get_traced_memory()[0], 0]);
+                if hasattr(tracemalloc, "reset_peak"):
+                    tracemalloc.reset_peak();
+            start = time.time();
+            try:
+                result = function(*args, **kwargs);
+            finally:
+                seconds = time.time() - start;
+                if tracing:
+                    # The peak was reset by any timed calls within
+                    current, peak = tracemalloc.get_traced_memory();
+                    before, innerPeak = calls.pop();
+                    peak = max(peak, innerPeak);
+                    if calls:
+                        calls[-1][1] = max(calls[-1][1], peak);
+
+            event = { "event": "timer", "name": name, "seconds": seconds };
+            if tracing:
+                event["allocatedBytes"] = current - before;
+                event["peakBytes"] = peak - before;
+            _emit(event);
+            return result;
+
+        wrapper.__name__ = function.__name__;
+        wrapper.__doc__ = function.__doc__;
+        return wrapper;
+    return decorate;
+
+def count(name, value=1):
+    """Adds value to the counter called name, as a "counter" event"""
+    if _sinks:
+        _emit({ "event": "counter", "name": name, "value": value });
+
+def traceMemory(enable=True):
+    """
+    Starts (or, given False, stops) tracing memory allocations with
+    tracemalloc, so that timers report the memory their calls allocate and
+    snapshot can be used.  Tracing slows Python code down considerably.
+    Does nothing where tracemalloc isn't available.
+    """
+    if tracemalloc is None:
+        return;
+    if enable and not tracemalloc.is_tracing():
+        tracemalloc.start();
+    elif not enable and tracemalloc.is_tracing():
+        tracemalloc.stop();
+
+def snapshot(name, limit=10):
+    """
+    Reports the limit source lines which have allocated the most memory
+    still in use, as a "snapshot" event called name, if memory is being
+    traced (see traceMemory).
+    """
+    if not _sinks or tracemalloc is None or not tracemalloc.is_tracing():
+        return;
+    stats = tracemalloc.take_snapshot().statistics("lineno")[:limit];
+    _emit({ "event": "snapshot", "name": name,
+            "lines": [{ "line": str(stat.traceback), "bytes": stat.size,
+                "blocks": stat.count } for stat in stats] });
+
+
+class Registry:
+    """
+    A sink keeping totals of the events in this process: the calls, total,
+    least and greatest seconds of each timer, and each counter's total.
+    Events in worker processes (e.g. of testsets.readSets) aren't seen
+    here; a JsonLinesSink collects those.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock();
+        self.timers = {};
+        self.counters = {};
+        self.snapshots = {};
+
+    def event(self, event):
+        name = event["name"];
+        with self._lock:
+            if event["event"] == "timer":
+                seconds = event["seconds"];
+                if name not in self.timers:
+                    self.timers[name] = { "calls": 0, "seconds": 0.0,
+                            "min": seconds, "max": seconds, "peakBytes": 0 };
+                timer = self.timers[name];
+                timer["calls"] += 1;
+                timer["seconds"] += seconds;
+                timer["min"] = min(timer["min"], seconds);
+                timer["max"] = max(timer["max"], seconds);
+                timer["peakBytes"] = max(timer["peakBytes"],
+                        event.get("peakBytes", 0));
+            elif event["event"] == "counter":
+                self.counters[name] = self.counters.get(name, 0) + \
+                        event["value"];
+            elif event["event"] == "snapshot":
+                self.snapshots[name] = event["lines"];
+
+    def clear(self):
+        """Forgets every event so far"""
+        with self._lock:
+            self.timers.clear();
+            self.counters.clear();
+            self.snapshots.clear();
+
+    def report(self):
+        """Returns the totals as a table of text, slowest timers first"""
+        with self._lock:
+            lines = ["{0:24} {1:>7} {2:>10} {3:>10} {4:>10} {5:>9}".format(
+                    "timer", "calls", "total s", "mean ms", "max ms",
+                    "peak MB")];
+            for name in sorted(self.timers,
+                    key=lambda name: -self.timers[name]["seconds"]):
+                timer = self.timers[name];
+                lines.append("{0:24} {1:7} {2:10.4f} {3:10.3f} {4:10.3f} "
+                        "{5:9.2f}".format(name, timer["calls"],
+                            timer["seconds"],
+                            1e3*timer["seconds"]/timer["calls"],
+                            1e3*timer["max"], timer["peakBytes"]/1e6));
+            if self.counters:
+                lines.append("{0:24} {1:>18}".format("counter", "total"));
+                for name in sorted(self.counters):
+                    lines.append("{0:24} {1:18}".format(name,
+                            self.counters[name]));
+        return "\n".join(lines);
+
+
+class JsonLinesSink:
+    """
+    A sink writing each event as a line of JSON to a file, e.g. for a
+    dashboard to collect.  The file is appended to, a whole line at a
+    time, so processes forked after the sink is added can share it.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename;
+        self._lock = threading.Lock();
+        self._file = open(filename, "a");
+
+    def event(self, event):
+        line = json.dumps(event) + "\n";
+        with self._lock:
+            self._file.write(line);
+            self._file.flush();
+
+    def close(self):
+        removeSink(self);
+        self._file.close();
@@ -22,8 +22,9 @@
 
 
 from sys import stdout;
-from notes import NoteSet;
-from audio import AudioFile;
+import multiprocessing;
+from notes import NoteSet, openAudio;
+from bayes import NaiveBayes;
 
 # Reference frequency, for c3
 c3freq = 134.0;
@@ -57,12 +58,117 @@ noteNames = [
     "b4",
     "c5" ];
 
+def noteName(note):
+    """Name of any note index, continuing the pattern of noteNames"""
+    return noteNames[note % 12][:-1] + str(3 + note // 12);
+
+def setPath(cls, index):
+    """
+    The wav file read by the NoteSet subclass cls for the given index.
+    Passing a NoteSet subclass an audioFile analyses it instead.
+    """
+    return cls.directory + noteNames[index] + ".wav";
+
+def _openSet(job):
+    """Constructs the NoteSet described by a job from readSets or fitSets"""
+    cls, index, framesize, cache, frontEnd, gate, spectrum = job;
+    return cls(index, framesize, cache=cache, frontEnd=frontEnd, gate=gate,
+            spectrum=spectrum);
+
+def _readSet(job):
+    """
+    Reads a single NoteSet, in a worker process.  The NoteSet is detached
+    from its AudioFile, so only its features are sent back.
+    """
+    noteSet = _openSet(job);
+    noteSet.detach();
+    return noteSet;
+
+def _fitSet(job):
+    """
+    Reads a single NoteSet, in a worker process, and returns a NaiveBayes
+    fitted to all of it, so only the classifier's statistics are sent back.
+    """
+    noteSet = _openSet(job);
+    nb = NaiveBayes();
+    nb.partialFit(noteSet.memberFeatures(), noteSet.nonMemberFeatures());
+    return nb;
+
+def _mapSets(function, jobs, name, processes=None):
+    """
+    Generates function(job) for each job, in order, in a pool of processes
+    (by default, one per core), or in this process if processes=1,
+    providing progress feedback.
+    """
+    stdout.write("Reading {0}...\n".format(name));
+
+    pool = None;
+    if processes == 1:
+        results = (function(job) for job in jobs);
+    else:
+        pool = multiprocessing.Pool(processes);
+        results = pool.imap(function, jobs);
+
+    count = 0;
+    try:
+        for result in results:
+            count += 1;
+            stdout.write("\r{0}/{1}".format(count,len(jobs)));
+            stdout.flush();
+            yield result;
+    finally:
+        if pool is not None:
+            pool.close();
+            pool.join();
+
+    stdout.write("\nDone\n");
+
+def readSets(cls, indices, framesize, name, cache=None, processes=None,
+        frontEnd=None, gate=None, spectrum=None):
+    """
+    Reads an instance of the NoteSet subclass cls for each of the specified
+    indices, providing progress feedback.  Files are read and analyzed in a
+    pool of processes (by default, one per core); processes=1 reads them
+    in this process instead.  The NoteSets returned are detached.
+    frontEnd and gate are passed to each NoteSet, and spectrum selects how
+    its spectra are computed (see notes.openAudio).
+    """
+    jobs = [(cls, index, framesize, cache, frontEnd, gate, spectrum)
+            for index in indices];
+    return list(_mapSets(_readSet, jobs, name, processes));
+
+def fitSets(cls, indices, framesize, name, cache=None, processes=None,
+        frontEnd=None, gate=None, nb=None, spectrum=None):
+    """
+    Like readSets, but rather than returning the NoteSets, fits a NaiveBayes
+    (nb, or a new one) to all of their features, which is returned.  Each
+    worker process fits its own NoteSets, and only their statistics are
+    merged, so the features are never all held at once.
+    """
+    if nb is None:
+        nb = NaiveBayes();
+    jobs = [(cls, index, framesize, cache, frontEnd, gate, spectrum)
+            for index in indices];
+    for fitted in _mapSets(_fitSet, jobs, name, processes):
+        nb.merge(fitted);
+    return nb;
+
+
 class SingleNote(NoteSet):
-    def __init__(self, note, framesize, reference=c3freq, numNotes= testNoteCount):
+    directory = "notes/";
+
+    def __init__(self, note, framesize, reference=c3freq, numNotes= testNoteCount,
+            cache=None, frontEnd=None, gate=None, audioFile=None,
+            spectrum=None):
+        if audioFile is None:
+            audioFile = openAudio(setPath(SingleNote, note), framesize, reference,
+                    numNotes, cache=cache, spectrum=spectrum);
         NoteSet.__init__(self,
-                AudioFile("notes/"+noteNames[note]+".wav", framesize),
+                audioFile,
                 reference,
-                numNotes);
+                numNotes,
+                frontEnd,
+                gate);
 
         self.note = note;
 
@@ -70,27 +176,32 @@ class SingleNote(NoteSet):
         return [self.note];
 
     def nonMemberNotes(self, frame):
-        return range(self.note) + range(self.note+1, self.numNotes);
+        return [n for n in range(self.numNotes)
+                if n not in self.memberNotes(frame)];
 
 
-def readNotes(notes, framesize):
+def readNotes(notes, framesize, cache=None, processes=None,
+        frontEnd=None, gate=None, spectrum=None):
     """Reads the specified note indices, providing progress feedback"""
-    stdout.write("Reading notes...\n");
-    ret = [];
-    for i in range(len(notes)):
-        ret += [SingleNote(notes[i], framesize)];
-        stdout.write("\r{0}/{1}".format(i+1,len(notes)));
-        stdout.flush();
-    stdout.write("\nDone\n");
-    return ret;
+    return readSets(SingleNote, notes, framesize, "notes",
+            cache, processes, frontEnd, gate, spectrum);
 
 
 class Octave(NoteSet):
-    def __init__(self, root, framesize, reference=c3freq, numNotes= testNoteCount):
+    directory = "octaves/";
+
+    def __init__(self, root, framesize, reference=c3freq, numNotes= testNoteCount,
+            cache=None, frontEnd=None, gate=None, audioFile=None,
+            spectrum=None):
+        if audioFile is None:
+            audioFile = openAudio(setPath(Octave, root), framesize, reference,
+                    numNotes, cache=cache, spectrum=spectrum);
         NoteSet.__init__(self,
-                AudioFile("octaves/"+noteNames[root]+".wav", framesize),
+                audioFile,
                 reference,
-                numNotes);
+                numNotes,
+                frontEnd,
+                gate);
 
         self.root = root;
 
@@ -98,27 +209,31 @@ class Octave(NoteSet):
         return[self.root, self.root+12];
 
     def nonMemberNotes(self, frame):
-        return range(self.root+12) + range(self.root+13,self.numNotes);
+        return [n for n in range(self.numNotes) if n != self.root+12];
 
 
-def readOctaves(roots, framesize):
+def readOctaves(roots, framesize, cache=None, processes=None,
+        frontEnd=None, gate=None, spectrum=None):
     """Reads the specified note indices, providing progress feedback"""
-    stdout.write("Reading octaves...\n");
-    ret = [];
-    for i in range(len(roots)):
-        ret += [Octave(roots[i], framesize)];
-        stdout.write("\r{0}/{1}".format(i+1,len(roots)));
-        stdout.flush();
-    stdout.write("\nDone\n");
-    return ret;
+    return readSets(Octave, roots, framesize, "octaves",
+            cache, processes, frontEnd, gate, spectrum);
 
 
 class Major(NoteSet):
-    def __init__(self, root, framesize, reference=c3freq, numNotes= testNoteCount):
+    directory = "majors/";
+
+    def __init__(self, root, framesize, reference=c3freq, numNotes= testNoteCount,
+            cache=None, frontEnd=None, gate=None, audioFile=None,
+            spectrum=None):
+        if audioFile is None:
+            audioFile = openAudio(setPath(Major, root), framesize, reference,
+                    numNotes, cache=cache, spectrum=spectrum);
         NoteSet.__init__(self,
-                AudioFile("majors/"+noteNames[root]+".wav", framesize),
+                audioFile,
                 reference,
-                numNotes);
+                numNotes,
+                frontEnd,
+                gate);
 
         self.root = root;
 
@@ -126,30 +241,32 @@ class Major(NoteSet):
         return [self.root, self.root+4, self.root+7];
 
     def nonMemberNotes(self, frame):
-        return range(self.root) + \
-            range(self.root+1, self.root+4) + \
-            range(self.root+5, self.root+7) + \
-            range(self.root+8, self.numNotes);
+        return [n for n in range(self.numNotes)
+                if n not in self.memberNotes(frame)];
 
 
-def readMajors(roots, framesize):
+def readMajors(roots, framesize, cache=None, processes=None,
+        frontEnd=None, gate=None, spectrum=None):
     """Reads the specified note indices, providing progress feedback"""
-    stdout.write("Reading majors...\n");
-    ret = [];
-    for i in range(len(roots)):
-        ret += [Major(roots[i], framesize)];
-        stdout.write("\r{0}/{1}".format(i+1,len(roots)));
-        stdout.flush();
-    stdout.write("\nDone\n");
-    return ret;
+    return readSets(Major, roots, framesize, "majors",
+            cache, processes, frontEnd, gate, spectrum);
 
 
 class OctMajor(NoteSet):
-    def __init__(self, root, framesize, reference=c3freq, numNotes=testNoteCount):
+    directory = "oct-majors/";
+
+    def __init__(self, root, framesize, reference=c3freq, numNotes=testNoteCount,
+            cache=None, frontEnd=None, gate=None, audioFile=None,
+            spectrum=None):
+        if audioFile is None:
+            audioFile = openAudio(setPath(OctMajor, root), framesize, reference,
+                    numNotes, cache=cache, spectrum=spectrum);
         NoteSet.__init__(self,
-                AudioFile("oct-majors/"+noteNames[root]+".wav", framesize),
+                audioFile,
                 reference,
-                numNotes);
+                numNotes,
+                frontEnd,
+                gate);
 
         self.root = root;
 
@@ -157,31 +274,32 @@ class OctMajor(NoteSet):
         return [self.root, self.root+12, self.root+16, self.root+19];
 
     def nonMemberNotes(self, frame):
-        return range(self.root) + \
-            range(self.root+1, self.root+12) + \
-            range(self.root+13, self.root+16) + \
-            range(self.root+17, self.root+19) + \
-            range(self.root+20, self.numNotes);
+        return [n for n in range(self.numNotes)
+                if n not in self.memberNotes(frame)];
 
 
-def readOctMajors(roots, framesize):
+def readOctMajors(roots, framesize, cache=None, processes=None,
+        frontEnd=None, gate=None, spectrum=None):
     """Reads the specified note indices, providing progress feedback"""
-    stdout.write("Reading octave-majors...\n");
-    ret = [];
-    for i in range(len(roots)):
-        ret += [OctMajor(roots[i], framesize)];
-        stdout.write("\r{0}/{1}".format(i+1,len(roots)));
-        stdout.flush();
-    stdout.write("\nDone\n");
-    return ret;
+    return readSets(OctMajor, roots, framesize, "octave-majors",
+            cache, processes, frontEnd, gate, spectrum);
 
 
 class MajorMajor(NoteSet):
-    def __init__(self, root, framesize, reference=c3freq, numNotes=testNoteCount):
+    directory = "major-majors/";
+
+    def __init__(self, root, framesize, reference=c3freq, numNotes=testNoteCount,
+            cache=None, frontEnd=None, gate=None, audioFile=None,
+            spectrum=None):
+        if audioFile is None:
+            audioFile = openAudio(setPath(MajorMajor, root), framesize, reference,
+                    numNotes, cache=cache, spectrum=spectrum);
         NoteSet.__init__(self,
-                AudioFile("major-majors/"+noteNames[root]+".wav", framesize),
+                audioFile,
                 reference,
-                numNotes);
+                numNotes,
+                frontEnd,
+                gate);
 
         self.root = root;
 
@@ -190,24 +308,42 @@ class MajorMajor(NoteSet):
             self.root+12, self.root+16, self.root+19];
 
     def nonMemberNotes(self, frame):
-        return range(self.root) + \
-            range(self.root+1, self.root+4) + \
-            range(self.root+5, self.root+7) + \
-            range(self.root+8, self.root+12) + \
-            range(self.root+13, self.root+16) + \
-            range(self.root+17, self.root+19) + \
-            range(self.root+20, self.numNotes);
+        return [n for n in range(self.numNotes)
+                if n not in self.memberNotes(frame)];
 
 
-def readMajorMajors(roots, framesize):
+def readMajorMajors(roots, framesize, cache=None, processes=None,
+        frontEnd=None, gate=None, spectrum=None):
     """Reads the specified note indices, providing progress feedback"""
-    stdout.write("Reading major-majors...\n");
-    ret = [];
-    for i in range(len(roots)):
-        ret += [MajorMajor(roots[i], framesize)];
-        stdout.write("\r{0}/{1}".format(i+1,len(roots)));
-        stdout.flush();
-    stdout.write("\nDone\n");
-    return ret;
-
-
+    return readSets(MajorMajor, roots, framesize, "major-majors",
+            cache, processes, frontEnd, gate, spectrum);
+
+
+# Every test set, as (NoteSet subclass, indices, name), in readAll's order
+allSets = [
+    (SingleNote, range(0,25), "notes"),
+    (Major, range(0,25), "majors"),
+    (Octave, range(0,13), "octaves"),
+    (OctMajor, range(0,13), "octave-majors"),
+    (MajorMajor, range(0,13), "major-majors")
+    ];
+
+def readAll(framesize, cache=None, processes=None, frontEnd=None,
+        gate=None, spectrum=None):
+    """
+    Reads every test set: single notes, majors, octaves, octave-majors and
+    major-majors, in that order.
+    """
+    return [readSets(cls, indices, framesize, name, cache, processes,
+                frontEnd, gate, spectrum)
+            for cls, indices, name in allSets];
+
+def trainClassifier(framesize, cache=None, processes=None, frontEnd=None,
+        gate=None, spectrum=None):
+    """Returns a NaiveBayes classifier trained on every test set"""
+    nb = NaiveBayes();
+    for cls, indices, name in allSets:
+        fitSets(cls, indices, framesize, name, cache, processes, frontEnd,
+                gate, nb, spectrum);
+    nb.printResults();
+    return nb;
@@ -0,0 +1,266 @@
+#!/usr/bin/python
+#
+#  transcribe.py
+#
+#  Transcribes wav files with a saved classifier, without reading the test
+#  sets.  The classifier is trained and saved with the "train" command:
+#      python transcribe.py train model.npz
+#      python transcribe.py run model.npz song.wav [more.wav ...] --events
+#
+#  This program is distributed under the of the GNU Lesser Public License.
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+import os;
+import sys;
+import argparse;
+import numpy as np;
+
+from audio import MappedAudioFile;
+from notes import NoteSet, bandLimit, openAudio, FEATURE_VERSION;
+from bayes import loadModel;
+from constantq import ConstantQ;
+from gate import EnergyGate, SILENT;
+from sdft import SlidingDFT;
+from stream import noteEvents;
+from hmm import NoteHmm;
+from testsets import noteName;
+import telemetry;
+
+# Help for the --sliding-dft option of both commands
+SLIDING_DFT_HELP = ("compute spectra with a sliding DFT (see sdft.py); "
+        "given an INTERVAL above 1, frame statistics are interpolated "
+        "between full FFTs every INTERVAL frames, which is faster but "
+        "approximate");
+
+def modelSettings(framesize, reference, numNotes, binsPerSemitone=None):
+    """
+    The settings saved with a classifier (see NaiveBayes.save), describing
+    the features it was trained on.  binsPerSemitone is that of the
+    ConstantQ front end, or None for FFT bands.
+    """
+    return { "framesize": framesize, "reference": reference,
+            "numNotes": numNotes, "binsPerSemitone": binsPerSemitone,
+            "featureVersion": FEATURE_VERSION };
+
+def frontEndOf(settings):
+    """The NoteSet front end described by a classifier's settings"""
+    if settings.get("binsPerSemitone") is None:
+        return None;
+    return ConstantQ(settings["binsPerSemitone"]);
+
+def loadClassifier(filename):
+    """
+    Loads a classifier saved by the train command, returning it and its
+    settings, after checking that its features are still computed the
+    same way.
+    """
+    classifier, settings = loadModel(filename);
+    if settings.get("featureVersion") != FEATURE_VERSION:
+        raise Exception("{0} was trained on features of version {1}, not "
+                "{2}: retrain it".format(filename,
+                    settings.get("featureVersion"), FEATURE_VERSION));
+    return (classifier, settings);
+
+def transcribeFile(filename, classifier, settings, hop=None, gate=None,
+        mapped=False, threads=1, hmm=None, spectrum=None):
+    """
+    Classifies every note in every frame of a wav file, returning a
+    (frames x notes) array of booleans, true where a note is sounding,
+    an array of booleans, true for each frame the gate found silent, and
+    the time between frames in seconds.
+    mapped reads the file with a MappedAudioFile, for long recordings,
+    analysed on the given number of threads.
+    hmm, a NoteHmm, smooths the classifier's decisions over time, decoding
+    its log-likelihood ratios.
+    spectrum selects how the spectra are computed (see notes.openAudio).
+    """
+    framesize = settings["framesize"];
+    reference = settings["reference"];
+    numNotes = settings["numNotes"];
+    if mapped:
+        if spectrum is not None:
+            raise Exception("Mapped files are only analysed with full FFTs");
+        audioFile = MappedAudioFile(filename, framesize, hop,
+                maxFrequency=bandLimit(reference, numNotes), threads=threads);
+    else:
+        audioFile = openAudio(filename, framesize, reference, numNotes, hop,
+                spectrum=spectrum);
+
+    noteSet = NoteSet(audioFile, reference, numNotes, frontEndOf(settings),
+            gate);
+    features = noteSet.featureTensor();
+    active = noteSet.activeFrames();
+    if hmm is None:
+        activations = np.zeros((len(features), numNotes), dtype=bool);
+        activations[active] = classifier.predict(
+                features[active].reshape((-1, noteSet.featureLen()))).reshape(
+                (-1, numNotes));
+    else:
+        ratios = np.full((len(features), numNotes), np.nan);
+        ratios[active] = classifier.logLikelihoodRatio(
+                features[active].reshape((-1, noteSet.featureLen()))).reshape(
+                (-1, numNotes));
+        activations = hmm.decode(ratios);
+
+    secondsPerFrame = float(audioFile.hop) / audioFile.sampleRate;
+    if mapped:
+        audioFile.close();
+    return (activations, ~active, secondsPerFrame);
+
+def writeActivations(outFile, activations, silent, secondsPerFrame):
+    """
+    Writes a CSV table of activations, with a row for each frame: its time,
+    whether it's silent, then a 1 for each note sounding.
+    """
+    numNotes = activations.shape[1];
+    outFile.write(",".join(["time", SILENT] +
+            [noteName(i) for i in range(numNotes)]) + "\n");
+    for frame in range(len(activations)):
+        outFile.write("{0:.4f},{1},{2}\n".format(frame*secondsPerFrame,
+                int(silent[frame]),
+                ",".join("1" if on else "0" for on in activations[frame])));
+
+def writeEvents(outFile, activations, silent, secondsPerFrame):
+    """
+    Writes a CSV list of events, ordered by frame: notes starting ("on")
+    and stopping ("off"), and silence starting ("silent") and ending
+    ("sound").  Notes still sounding at the end stop after the last frame.
+    """
+    numFrames, numNotes = activations.shape;
+    events = [(frame, note, "on" if on else "off") for frame, note, on in
+            noteEvents(np.vstack([activations,
+                    np.zeros((1, numNotes), dtype=bool)]))];
+    changes = np.diff(np.concatenate([[False], silent]).astype(np.int8));
+    events += [(frame, None, SILENT if silent[frame] else "sound")
+            for frame in np.flatnonzero(changes).tolist()];
+    events.sort(key=lambda event: event[0]);
+
+    outFile.write("time,frame,note,name,event\n");
+    for frame, note, event in events:
+        if note is None:
+            outFile.write("{0:.4f},{1},,,{2}\n".format(
+                    frame*secondsPerFrame, frame, event));
+        else:
+            outFile.write("{0:.4f},{1},{2},{3},{4}\n".format(
+                    frame*secondsPerFrame, frame, note, noteName(note),
+                    event));
+
+def spectrumOf(args):
+    """The spectrum backend selected by the --sliding-dft option"""
+    if args.sliding_dft is None:
+        return None;
+    return SlidingDFT(args.sliding_dft);
+
+def train(args):
+    """The train command: trains a classifier on the test sets, and saves it"""
+    from testsets import trainClassifier, c3freq, testNoteCount;
+    from cache import FeatureCache;
+
+    frontEnd = None;
+    if args.cq is not None:
+        frontEnd = ConstantQ(args.cq);
+    classifier = trainClassifier(args.framesize, FeatureCache(args.cache),
+            args.processes, frontEnd, spectrum=spectrumOf(args));
+    classifier.save(args.model, modelSettings(args.framesize, c3freq,
+            testNoteCount, args.cq));
+
+def run(args):
+    """The run command: transcribes wav files with a saved classifier"""
+    classifier, settings = loadClassifier(args.model);
+    gate = None if args.gate is None else EnergyGate(args.gate);
+    hmm = None;
+    if args.smooth is not None:
+        hmm = NoteHmm(*args.smooth);
+    write = writeEvents if args.events else writeActivations;
+    suffix = ".events.csv" if args.events else ".notes.csv";
+
+    for filename in args.wavs:
+        activations, silent, secondsPerFrame = transcribeFile(filename,
+                classifier, settings, args.hop, gate, args.mapped,
+                args.threads, hmm, spectrumOf(args));
+
+        if args.output is None:
+            sys.stdout.write("# {0}\n".format(filename));
+            write(sys.stdout, activations, silent, secondsPerFrame);
+        else:
+            name = os.path.splitext(os.path.basename(filename))[0];
+            with open(os.path.join(args.output, name + suffix), "w") as \
+                    outFile:
+                write(outFile, activations, silent, secondsPerFrame);
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Transcribe wav files");
+    parser.add_argument("--telemetry", default=None, metavar="JSONL",
+            help="append timings of each stage to this file, as JSON lines");
+    parser.add_argument("--profile", action="store_true",
+            help="print the total time of each stage to stderr at the end");
+    parser.add_argument("--trace-memory", action="store_true",
+            help="also report the memory each stage allocates (slow)");
+    commands = parser.add_subparsers(dest="command");
+    commands.required = True;
+
+    trainParser = commands.add_parser("train",
+            help="train a classifier on the test sets, and save it");
+    trainParser.add_argument("model", help="the .npz file to save");
+    trainParser.add_argument("--framesize", type=int, default=44100//8);
+    trainParser.add_argument("--cq", type=int, default=None,
+            metavar="BINS", help="use a constant-Q front end, with BINS "
+                "bins per semitone");
+    trainParser.add_argument("--cache", default=".cache");
+    trainParser.add_argument("--processes", type=int, default=None);
+    trainParser.add_argument("--sliding-dft", type=int, nargs="?", const=1,
+            default=None, metavar="INTERVAL", help=SLIDING_DFT_HELP);
+    trainParser.set_defaults(function=train);
+
+    runParser = commands.add_parser("run",
+            help="transcribe wav files with a saved classifier");
+    runParser.add_argument("model", help="a .npz file saved by train");
+    runParser.add_argument("wavs", nargs="+");
+    runParser.add_argument("--hop", type=int, default=None,
+            help="samples between frames (default: the framesize)");
+    runParser.add_argument("--events", action="store_true",
+            help="write note events rather than per-frame activations");
+    runParser.add_argument("--gate", type=float, default=None,
+            help="gate out frames below this level, in dB relative to the "
+                "loudest frame (e.g. -50)");
+    runParser.add_argument("--mapped", action="store_true",
+            help="map the files rather than reading them, for long ones");
+    runParser.add_argument("--threads", type=int, default=1,
+            help="with --mapped, analyse each file on this many threads");
+    runParser.add_argument("--smooth", type=float, nargs=2, default=None,
+            metavar=("ON", "OFF"), help="smooth decisions over time with a "
+                "NoteHmm, whose notes start and stop with these "
+                "probabilities per frame (e.g. 0.01 0.05)");
+    runParser.add_argument("--sliding-dft", type=int, nargs="?", const=1,
+            default=None, metavar="INTERVAL", help=SLIDING_DFT_HELP);
+    runParser.add_argument("-o", "--output", default=None,
+            help="write a CSV per file to this directory, rather than "
+                "to stdout");
+    runParser.set_defaults(function=run);
+
+    args = parser.parse_args();
+
+    registry = None;
+    if args.telemetry is not None:
+        telemetry.addSink(telemetry.JsonLinesSink(args.telemetry));
+    if args.profile:
+        registry = telemetry.addSink(telemetry.Registry());
+    if args.trace_memory:
+        telemetry.traceMemory();
+
+    args.function(args);
+    if registry is not None:
+        sys.stderr.write(registry.report() + "\n");